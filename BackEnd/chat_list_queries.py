@@ -0,0 +1,166 @@
+"""
+Список чатов без готовых строк dialog_summaries (CHAT_LIST_SOURCE=window).
+
+Последнее сообщение - один запрос с ROW_NUMBER() на тип чата, непрочитанные - один агрегат на все типы.
+Непрочитанные считаются по тем же отметкам прочтения, что и dialog_summaries (last_read_message_id),
+поэтому оба источника дают одинаковые счетчики; отметки личных чатов хранятся только там.
+
+Модели передаются в ChatListQueries из main.py - модуль не импортирует main (иначе при запуске
+python main.py приложение загрузилось бы второй раз).
+"""
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import String, and_, cast, desc, func, literal, or_, select, union_all
+from sqlalchemy.orm import Session
+
+
+class ChatListRow:
+    """Строка списка чатов с теми же полями, что и DialogSummary"""
+    __slots__ = (
+        "chat_type", "chat_id", "last_message_id", "last_message_preview", "last_message_type",
+        "last_message_sender_id", "last_message_at", "unread_count", "is_muted", "is_pinned"
+    )
+
+    def __init__(self, chat_type: str, chat_id: int, is_muted: bool = False):
+        self.chat_type = chat_type
+        self.chat_id = chat_id
+        self.last_message_id = None
+        self.last_message_preview = None
+        self.last_message_type = None
+        self.last_message_sender_id = None
+        self.last_message_at = None
+        self.unread_count = 0
+        self.is_muted = is_muted
+        self.is_pinned = False
+
+
+def dialog_partner(dialog_key: str, user_id: int) -> int:
+    """Собеседник пользователя по ключу личного чата "меньший_id:больший_id" """
+    low, high = (int(part) for part in dialog_key.split(":"))
+    return high if low == user_id else low
+
+
+class ChatListQueries:
+    """Запросы списка чатов по messages, записям участия и отметкам прочтения"""
+
+    def __init__(self, message, group_member, channel_subscription, dialog_summary, preview_length: int):
+        self.Message = message
+        self.GroupMember = group_member
+        self.ChannelSubscription = channel_subscription
+        self.DialogSummary = dialog_summary
+        self.preview_length = preview_length
+        self.chat_columns = {"group": message.group_id, "channel": message.channel_id, "private": message.dialog_key}
+
+    def user_chats_subquery(self, chat_type: str, user_id: int):
+        """id групп/каналов пользователя (без банов) или ключи его личных чатов"""
+        Message = self.Message
+        if chat_type == "group":
+            return select(self.GroupMember.group_id).where(
+                self.GroupMember.user_id == user_id, self.GroupMember.is_banned == False
+            )
+        if chat_type == "channel":
+            return select(self.ChannelSubscription.channel_id).where(
+                self.ChannelSubscription.user_id == user_id, self.ChannelSubscription.is_banned == False
+            )
+        return select(Message.dialog_key).where(
+            or_(Message.from_user_id == user_id, Message.to_user_id == user_id),
+            Message.dialog_key.isnot(None)
+        )
+
+    def last_messages_query(self, chat_type: str, user_id: int):
+        """Последнее неудаленное сообщение каждого чата пользователя одним запросом"""
+        Message = self.Message
+        chat_column = self.chat_columns[chat_type]
+        ranked = select(
+            chat_column.label("chat_ref"),
+            Message.id,
+            Message.content,
+            Message.message_type,
+            Message.from_user_id,
+            Message.created_at,
+            func.row_number().over(
+                partition_by=chat_column,
+                order_by=(desc(Message.created_at), desc(Message.id))
+            ).label("position")
+        ).where(
+            chat_column.in_(self.user_chats_subquery(chat_type, user_id)),
+            Message.is_deleted == False
+        ).subquery()
+        return select(ranked).where(ranked.c.position == 1)
+
+    def unread_counts_query(self, user_id: int):
+        """
+        Непрочитанные по всем чатам пользователя одним агрегатом (chat_type, chat_ref, count):
+        чужие неудаленные сообщения после last_read_message_id строки списка чатов.
+        """
+        Message, DialogSummary = self.Message, self.DialogSummary
+        counted = (Message.is_deleted == False, or_(Message.from_user_id.is_(None), Message.from_user_id != user_id))
+
+        def read_marker(chat_type: str, chat_match):
+            return and_(
+                DialogSummary.user_id == user_id,
+                DialogSummary.chat_type == chat_type,
+                chat_match,
+                Message.id > DialogSummary.last_read_message_id
+            )
+
+        groups = select(
+            literal("group").label("chat_type"), cast(Message.group_id, String).label("chat_ref"), func.count(Message.id)
+        ).join(DialogSummary, read_marker("group", DialogSummary.chat_id == Message.group_id)).where(
+            *counted
+        ).group_by(Message.group_id)
+        channels = select(
+            literal("channel"), cast(Message.channel_id, String), func.count(Message.id)
+        ).join(DialogSummary, read_marker("channel", DialogSummary.chat_id == Message.channel_id)).where(
+            *counted
+        ).group_by(Message.channel_id)
+        # chat_ref личного чата - "private:" + dialog_key (как ключ счетчика изменений чата)
+        private = select(
+            literal("private"), Message.dialog_key, func.count(Message.id)
+        ).join(DialogSummary, read_marker("private", DialogSummary.chat_ref == literal("private:") + Message.dialog_key)).where(
+            Message.dialog_key.isnot(None), *counted
+        ).group_by(Message.dialog_key)
+        return union_all(groups, channels, private)
+
+    def load_rows(self, db: Session, user_id: int) -> List[ChatListRow]:
+        """Строки списка чатов, по убыванию времени последнего сообщения"""
+        rows: Dict[Tuple[str, str], ChatListRow] = {}
+
+        # Группы и каналы показываются и без сообщений; mute - из настроек уведомлений участия
+        memberships = (
+            ("group", self.GroupMember, self.GroupMember.group_id),
+            ("channel", self.ChannelSubscription, self.ChannelSubscription.channel_id)
+        )
+        for chat_type, model, chat_column in memberships:
+            for chat_id, notification_settings in db.execute(
+                select(chat_column, model.notification_settings).where(model.user_id == user_id, model.is_banned == False)
+            ):
+                muted = bool(notification_settings.get("muted")) if isinstance(notification_settings, dict) else False
+                rows[(chat_type, str(chat_id))] = ChatListRow(chat_type, chat_id, muted)
+
+        for chat_type in ("private", "group", "channel"):
+            for last in db.execute(self.last_messages_query(chat_type, user_id)):
+                key = (chat_type, str(last.chat_ref))
+                row = rows.get(key)
+                if row is None:
+                    if chat_type != "private":
+                        continue
+                    row = rows[key] = ChatListRow("private", dialog_partner(last.chat_ref, user_id))
+                row.last_message_id = last.id
+                row.last_message_preview = last.content[:self.preview_length] if last.content else None
+                row.last_message_type = last.message_type
+                row.last_message_sender_id = last.from_user_id
+                row.last_message_at = last.created_at
+
+        for chat_type, chat_ref, unread_count in db.execute(self.unread_counts_query(user_id)):
+            row = rows.get((chat_type, str(chat_ref)))
+            if row is not None:
+                row.unread_count = unread_count
+
+        # Чаты без сообщений - в конце, как NULL в индексе dialog_summaries
+        return sorted(
+            rows.values(),
+            key=lambda row: (row.last_message_at is not None, row.last_message_at or datetime.min),
+            reverse=True
+        )
@@ -3,23 +3,30 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, JSONResponse, HTMLResponse, RedirectResponse, StreamingResponse
 from sqlalchemy.orm import Session, relationship, joinedload
-from sqlalchemy import desc, func, or_, and_, text, Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, LargeBinary, Float
+from sqlalchemy import desc, func, or_, and_, text, Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, LargeBinary, Float, UniqueConstraint, Index, event, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect as sa_inspect
 from sqlalchemy.orm import sessionmaker
 import json
-from datetime import datetime, timedelta
+import csv
+import re
+import html
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 import uvicorn 
 import os
 import sys
 import shutil
 import uuid
-from typing import Optional, List, Dict, Any, Tuple, Set
+from typing import Optional, List, Dict, Any, Tuple, Set, Callable
 import hashlib
+import sqlite3
 import secrets
 import asyncio
 import time
+import math
+import unicodedata
 from io import BytesIO
 from PIL import Image
 import logging
@@ -36,8 +43,23 @@ import zipfile
 import tarfile
 import mimetypes
 from typing import Tuple
+from chat_list_queries import ChatListQueries
 from concurrent.futures import ThreadPoolExecutor
 import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import socket
+from urllib.parse import urlparse
+
+try:
+    import msgpack
+except ImportError:  # Без msgpack бинарный протокол не предлагается, клиенты остаются на JSON
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # Без orjson ответы кодируются стандартным json
+    orjson = None
 
 # ========== НАСТРОЙКА ЛОГГИРОВАНИЯ ==========
 
@@ -66,6 +88,38 @@ MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 100 * 1024 * 1024))  # 1
 MAX_MESSAGE_LENGTH = int(os.environ.get("MAX_MESSAGE_LENGTH", 10000))
 MAX_USERS_PER_GROUP = int(os.environ.get("MAX_USERS_PER_GROUP", 1000))
 MAX_SUBSCRIBERS_PER_CHANNEL = int(os.environ.get("MAX_SUBSCRIBERS_PER_CHANNEL", 10000))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", 5000))  # Чатов в индексе участников
+MESSAGE_TAIL_SIZE = int(os.environ.get("MESSAGE_TAIL_SIZE", 100))  # Последних сообщений в кэше на один чат
+MESSAGE_TAIL_MAX_BYTES = int(os.environ.get("MESSAGE_TAIL_MAX_BYTES", 64 * 1024 * 1024))  # Предел кэша хвостов (по JSON-размеру)
+SYNC_MAX_CHATS = int(os.environ.get("SYNC_MAX_CHATS", 100))  # Чатов в одном запросе дельта-синхронизации
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 2000))  # Строк на одну выборку курсора при экспорте чата
+CHAT_LIST_SOURCE = os.environ.get("CHAT_LIST_SOURCE", "summaries")  # summaries - таблица dialog_summaries, window - запросы по messages без нее
+MESSAGE_SEARCH_LANGUAGE = os.environ.get("MESSAGE_SEARCH_LANGUAGE", "simple")  # Конфигурация полнотекстового поиска PostgreSQL
+SEARCH_SNIPPET_WORDS = int(os.environ.get("SEARCH_SNIPPET_WORDS", 12))  # Слов во фрагменте с найденным текстом
+SEARCH_RANK_WINDOW = int(os.environ.get("SEARCH_RANK_WINDOW", 1000))  # Сколько последних совпадений в чате ранжируется по релевантности
+UNREAD_DISPLAY_CAP = int(os.environ.get("UNREAD_DISPLAY_CAP", 99))  # Больше показываем как "99+"
+UNREAD_RECONCILE_INTERVAL = float(os.environ.get("UNREAD_RECONCILE_INTERVAL", 900))  # Период сверки счетчиков непрочитанных, сек (0 - выключено)
+UNREAD_RECONCILE_BATCH = int(os.environ.get("UNREAD_RECONCILE_BATCH", 2000))  # Строк списка чатов на одну транзакцию сверки
+SCHEMA_LOCK_TIMEOUT = float(os.environ.get("SCHEMA_LOCK_TIMEOUT", 600))  # Сколько воркер ждет, пока другой воркер обновляет схему, сек
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 256))  # Кадров в очереди на одно соединение
+WS_SEND_QUEUE_BYTES = int(os.environ.get("WS_SEND_QUEUE_BYTES", 1024 * 1024))  # 1 MB в очереди на одно соединение
+WS_CLOSE_RESYNC = 4000  # Код закрытия: клиент отстал и должен полностью пересинхронизироваться
+WS_REPLAY_SIZE = int(os.environ.get("WS_REPLAY_SIZE", 256))  # Событий в журнале повтора на пользователя или чат (0 - выключено)
+WS_REPLAY_TTL = float(os.environ.get("WS_REPLAY_TTL", 300))  # Сколько секунд событие доступно для повтора
+WS_REPLAY_STREAMS = int(os.environ.get("WS_REPLAY_STREAMS", 20000))  # Пользователей и чатов в журнале повтора
+WS_MSGPACK_PROTOCOL = "devnet.msgpack.v1"  # Бинарный подпротокол: MessagePack, короткие ключи, epoch-время
+BACKPLANE_URL = os.environ.get("BACKPLANE_URL", "")  # "", unix:///path/to/dir или redis://host:6379
+BACKPLANE_CHANNEL = os.environ.get("BACKPLANE_CHANNEL", "devnet:events")
+BACKPLANE_HEARTBEAT_SECONDS = float(os.environ.get("BACKPLANE_HEARTBEAT_SECONDS", 5))
+BACKPLANE_MAX_EVENT_BYTES = int(os.environ.get("BACKPLANE_MAX_EVENT_BYTES", 200 * 1024))  # Предел датаграммы unix backplane
+BACKPLANE_OUTBOX_SIZE = int(os.environ.get("BACKPLANE_OUTBOX_SIZE", 10000))  # Событий в очереди на публикацию в Redis
+PRESENCE_BATCH_INTERVAL = float(os.environ.get("PRESENCE_BATCH_INTERVAL", 0.5))  # Период рассылки presence_batch, сек
+PRESENCE_AUDIENCE_TTL = int(os.environ.get("PRESENCE_AUDIENCE_TTL", 60))  # Время жизни кэша "кому интересен статус", сек
+PRESENCE_AUDIENCE_CACHE_SIZE = int(os.environ.get("PRESENCE_AUDIENCE_CACHE_SIZE", 20000))
+PRESENCE_SUBSCRIPTION_LIMIT = int(os.environ.get("PRESENCE_SUBSCRIPTION_LIMIT", 500))  # Пользователей в подписке одного соединения
+TYPING_THROTTLE_SECONDS = float(os.environ.get("TYPING_THROTTLE_SECONDS", 3))  # Не чаще одной рассылки "печатает" на (пользователь, чат)
+TYPING_TIMEOUT_SECONDS = float(os.environ.get("TYPING_TIMEOUT_SECONDS", 6))  # Без новых событий набор считается законченным
+TYPING_WHEEL_TICK = 0.5  # Точность колеса таймеров, сек
 
 logger.info(f"🌍 Domain: {DOMAIN}")
 logger.info(f"🚀 Production mode: {IS_PRODUCTION}")
@@ -173,10 +227,27 @@ class RefreshToken(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    # Ленты чатов по (created_at, id) только среди неудаленных сообщений
+    __table_args__ = (
+        Index("ix_messages_group_timeline", "group_id", "created_at", "id",
+              sqlite_where=text("is_deleted = 0"), postgresql_where=text("is_deleted = false")),
+        Index("ix_messages_channel_timeline", "channel_id", "created_at", "id",
+              sqlite_where=text("is_deleted = 0"), postgresql_where=text("is_deleted = false")),
+        Index("ix_messages_dialog_timeline", "dialog_key", "created_at", "id",
+              sqlite_where=text("is_deleted = 0"), postgresql_where=text("is_deleted = false")),
+        # Поиск собеседников и счетчики по отправителю - покрывающие индексы без частичного условия
+        Index("ix_messages_sender_dialog", "from_user_id", "dialog_key", "is_deleted"),
+        Index("ix_messages_recipient_dialog", "to_user_id", "dialog_key"),
+        # Дельта-синхронизация по номеру изменения, включая удаленные сообщения
+        Index("ix_messages_group_seq", "group_id", "seq"),
+        Index("ix_messages_channel_seq", "channel_id", "seq"),
+        Index("ix_messages_dialog_seq", "dialog_key", "seq"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     from_user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))
     to_user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    dialog_key = Column(String(41), nullable=True)  # "min_id:max_id" пары собеседников личного чата
     group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"), nullable=True)
     channel_id = Column(Integer, ForeignKey("channels.id", ondelete="CASCADE"), nullable=True)
     reply_to_id = Column(Integer, ForeignKey("messages.id", ondelete="SET NULL"), nullable=True)
@@ -204,6 +275,7 @@ class Message(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     deleted_at = Column(DateTime)
+    seq = Column(Integer, nullable=True)  # номер последнего изменения в пределах чата
     
     # Связи - ВАЖНО: указываем явные foreign_keys
     sender = relationship("User", foreign_keys=[from_user_id], back_populates="sent_messages")
@@ -292,6 +364,10 @@ class Channel(Base):
 
 class GroupMember(Base):
     __tablename__ = "group_members"
+    __table_args__ = (
+        Index("ix_group_members_user_group", "user_id", "group_id"),
+        Index("ix_group_members_group", "group_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"))
@@ -322,6 +398,10 @@ class GroupMember(Base):
 
 class ChannelSubscription(Base):
     __tablename__ = "channel_subscriptions"
+    __table_args__ = (
+        Index("ix_channel_subscriptions_user_channel", "user_id", "channel_id"),
+        Index("ix_channel_subscriptions_channel", "channel_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     channel_id = Column(Integer, ForeignKey("channels.id", ondelete="CASCADE"))
@@ -348,6 +428,7 @@ class ChannelSubscription(Base):
 
 class MessageReaction(Base):
     __tablename__ = "message_reactions"
+    __table_args__ = (Index("ix_message_reactions_message", "message_id"),)
     
     id = Column(Integer, primary_key=True, index=True)
     message_id = Column(Integer, ForeignKey("messages.id", ondelete="CASCADE"))
@@ -423,6 +504,7 @@ class File(Base):
 
 class Notification(Base):
     __tablename__ = "notifications"
+    __table_args__ = (Index("ix_notifications_user_read_created", "user_id", "is_read", "created_at"),)
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
@@ -441,6 +523,7 @@ class Notification(Base):
 
 class Contact(Base):
     __tablename__ = "contacts"
+    __table_args__ = (Index("ix_contacts_user_contact_blocked", "user_id", "contact_id", "is_blocked"),)
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
@@ -562,11 +645,974 @@ class AuditLog(Base):
     # Связи
     user = relationship("User")
 
+class MessageClientId(Base):
+    """Временный id сообщения на клиенте - для идемпотентной повторной отправки"""
+    __tablename__ = "message_client_ids"
+    __table_args__ = (UniqueConstraint("user_id", "client_id", name="uq_message_client_ids_user_client"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    client_id = Column(String(64), nullable=False)
+    message_id = Column(Integer, ForeignKey("messages.id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ChatSequence(Base):
+    """Счетчик изменений сообщений чата - для дельта-синхронизации клиентов"""
+    __tablename__ = "chat_sequences"
+    
+    chat_key = Column(String(64), primary_key=True)  # "group:1", "channel:5", "private:2:3"
+    last_seq = Column(Integer, nullable=False, default=0)
+
+class DialogSummary(Base):
+    """Строка списка чатов пользователя: последнее сообщение, непрочитанные и флаги"""
+    __tablename__ = "dialog_summaries"
+    __table_args__ = (
+        UniqueConstraint("user_id", "chat_type", "chat_id", name="uq_dialog_summaries_user_chat"),
+        # Список чатов - один диапазон по user_id
+        Index("ix_dialog_summaries_user_last", "user_id", "last_message_at"),
+        # Обновления всех участников чата при новом сообщении
+        Index("ix_dialog_summaries_chat_ref", "chat_ref"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    chat_type = Column(String(10), nullable=False)
+    chat_id = Column(Integer, nullable=False)  # для личного чата - id собеседника
+    chat_ref = Column(String(64), nullable=False)  # "group:1", "channel:5", "private:2:3" - общий для всех участников
+    last_message_id = Column(Integer)
+    last_message_preview = Column(String(200))
+    last_message_type = Column(String(20))
+    last_message_sender_id = Column(Integer)
+    last_message_at = Column(DateTime)
+    unread_count = Column(Integer, nullable=False, default=0)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    is_muted = Column(Boolean, nullable=False, default=False)
+    is_pinned = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+def make_dialog_key(user_a: int, user_b: int) -> str:
+    """Ключ личного чата, одинаковый для обоих собеседников"""
+    return f"{min(user_a, user_b)}:{max(user_a, user_b)}"
+
+def dialog_partner(dialog_key: str, user_id: int) -> int:
+    """Собеседник пользователя по ключу личного чата"""
+    low, high = (int(part) for part in dialog_key.split(":"))
+    return high if low == user_id else low
+
+def message_chat_ref(message: "Message") -> Optional[Tuple[str, Any]]:
+    """Тип чата сообщения и его group_id/channel_id/dialog_key"""
+    if message.group_id:
+        return ("group", message.group_id)
+    if message.channel_id:
+        return ("channel", message.channel_id)
+    if message.dialog_key:
+        return ("private", message.dialog_key)
+    return None
+
+def chat_seq_key(chat_type: str, chat_ref: Any) -> str:
+    """Ключ счетчика изменений чата; для личных чатов chat_ref - dialog_key"""
+    return f"{chat_type}:{chat_ref}"
+
+def chat_message_filter(chat_type: str, chat_ref: Any):
+    """Условие на сообщения чата по типу и group_id/channel_id/dialog_key"""
+    if chat_type == "group":
+        return Message.group_id == chat_ref
+    if chat_type == "channel":
+        return Message.channel_id == chat_ref
+    return Message.dialog_key == chat_ref
+
+def next_chat_seq(session, chat_type: str, chat_ref: Any) -> int:
+    """Следующий номер изменения чата в текущей транзакции"""
+    conn = session.connection()
+    params = {"key": chat_seq_key(chat_type, chat_ref)}
+    bump = text("UPDATE chat_sequences SET last_seq = last_seq + 1 WHERE chat_key = :key RETURNING last_seq")
+    row = conn.execute(bump, params).first()
+    if row is None:
+        # Первое изменение чата после миграции - продолжаем с уже проставленных номеров
+        start = conn.execute(
+            select(func.coalesce(func.max(Message.seq), 0)).where(chat_message_filter(chat_type, chat_ref))
+        ).scalar()
+        conn.execute(
+            text("INSERT INTO chat_sequences (chat_key, last_seq) VALUES (:key, :start) ON CONFLICT (chat_key) DO NOTHING"),
+            {**params, "start": start}
+        )
+        row = conn.execute(bump, params).first()
+    return row[0]
+
+@event.listens_for(SessionLocal, "before_flush")
+def stamp_message_seq(session, flush_context, instances):
+    """Каждое изменение сообщения получает новый номер в своем чате"""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Message) or (obj not in session.new and not session.is_modified(obj)):
+            continue
+        key = message_chat_ref(obj)
+        if key is not None:
+            obj.seq = next_chat_seq(session, *key)
+
+# ---------- Список чатов (dialog_summaries) ----------
+
+DIALOG_PREVIEW_LENGTH = 100
+
+DIALOG_LAST_MESSAGE_COLUMNS = (
+    ("last_message_id", "message_id"),
+    ("last_message_preview", "preview"),
+    ("last_message_type", "message_type"),
+    ("last_message_sender_id", "sender_id"),
+    ("last_message_at", "created_at"),
+)
+
+DIALOG_LAST_MESSAGE_SQL = ", ".join(f"{column} = :{param}" for column, param in DIALOG_LAST_MESSAGE_COLUMNS)
+
+# Новое сообщение становится последним, только если оно не старше текущего (импорт и начальные данные пишутся задним числом)
+DIALOG_NEWER_MESSAGE_SQL = ", ".join(
+    f"{column} = CASE WHEN dialog_summaries.last_message_at IS NULL OR dialog_summaries.last_message_at <= :created_at "
+    f"THEN :{param} ELSE dialog_summaries.{column} END"
+    for column, param in DIALOG_LAST_MESSAGE_COLUMNS
+)
+
+def dialog_message_params(message: Optional["Message"]) -> Dict[str, Any]:
+    """Поля последнего сообщения для строки списка чатов (None - сообщений нет)"""
+    if message is None:
+        return {"message_id": None, "preview": None, "message_type": None, "sender_id": None, "created_at": None}
+    return {
+        "message_id": message.id,
+        "preview": message.content[:DIALOG_PREVIEW_LENGTH] if message.content else None,
+        "message_type": message.message_type,
+        "sender_id": message.from_user_id,
+        "created_at": message.created_at
+    }
+
+def dialog_last_message(chat_type: str, viewer_id: int, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """last_message элемента списка чатов в том же виде, что и в /api/chats/all"""
+    if params.get("message_id") is None:
+        return None
+    created_at = params.get("created_at")
+    last_message = {
+        "content": params.get("preview"),
+        "type": params.get("message_type"),
+        "timestamp": created_at.isoformat() if isinstance(created_at, datetime) else created_at
+    }
+    if chat_type == "private":
+        last_message["is_my_message"] = params.get("sender_id") == viewer_id
+    elif chat_type == "group":
+        last_message["sender_id"] = params.get("sender_id")
+    return last_message
+
+def dialog_list_id(chat_type: str, chat_ref: Any, user_id: int) -> Any:
+    """id чата в списке пользователя: для личного чата - собеседник"""
+    return dialog_partner(chat_ref, user_id) if chat_type == "private" else chat_ref
+
+def queue_dialog_update(session, user_id: int, chat_type: str, chat_id: int, changes: Dict[str, Any]):
+    """Изменение элемента списка чатов пользователя; уходит кадром dialog_updated после коммита"""
+    updates = session.info.setdefault("dialog_updates", {})
+    key = (user_id, chat_type, chat_id)
+    if "added" in changes or "removed" in changes:
+        updates[key] = dict(changes)
+    else:
+        updates.setdefault(key, {}).update(changes)
+
+def unread_changes(unread_count: int) -> Dict[str, Any]:
+    return {"unread_count": unread_count, "unread_badge": unread_badge(unread_count)}
+
+def latest_chat_message(conn, chat_type: str, chat_ref: Any):
+    """Последнее неудаленное сообщение чата (по индексу ленты)"""
+    return conn.execute(
+        select(Message.id, Message.content, Message.message_type, Message.from_user_id, Message.created_at)
+        .where(chat_message_filter(chat_type, chat_ref), Message.is_deleted == False)
+        .order_by(desc(Message.created_at), desc(Message.id))
+        .limit(1)
+    ).first()
+
+def max_chat_message_id(conn, chat_type: str, chat_ref: Any) -> int:
+    """Отметка "прочитано все": последнее сообщение по id (оно может не совпадать с последним по времени)"""
+    return conn.execute(select(func.max(Message.id)).where(chat_message_filter(chat_type, chat_ref))).scalar() or 0
+
+def dialog_on_message_created(session, message: "Message", chat_type: str, chat_ref: Any):
+    """Новое сообщение: последнее сообщение у всех участников, +1 непрочитанное всем, кроме отправителя"""
+    conn = session.connection()
+    params = {**dialog_message_params(message), "ref": chat_seq_key(chat_type, chat_ref), "now": datetime.utcnow()}
+    # Писатели одного чата упорядочены блокировкой chat_sequences, строки чата обновляются без гонок
+    if chat_type != "private":
+        rows = conn.execute(text(f"""
+            UPDATE dialog_summaries SET {DIALOG_NEWER_MESSAGE_SQL},
+                unread_count = CASE WHEN user_id = :sender_id THEN 0 ELSE unread_count + 1 END,
+                last_read_message_id = CASE WHEN user_id = :sender_id THEN :message_id ELSE last_read_message_id END,
+                updated_at = :now
+            WHERE chat_ref = :ref
+            RETURNING user_id, unread_count, last_message_id
+        """), params).all()
+        last_message = dialog_last_message(chat_type, None, params)
+        for user_id, unread_count, last_message_id in rows:
+            changes = unread_changes(unread_count)
+            if last_message_id == message.id:
+                changes["last_message"] = last_message
+            queue_dialog_update(session, user_id, chat_type, chat_ref, changes)
+        return
+    
+    # Строки личного чата появляются с первым сообщением
+    existing = set(conn.execute(
+        text("SELECT user_id FROM dialog_summaries WHERE chat_ref = :ref"), {"ref": params["ref"]}
+    ).scalars())
+    for owner_id, partner_id in ((message.from_user_id, message.to_user_id), (message.to_user_id, message.from_user_id)):
+        is_sender = owner_id == message.from_user_id
+        unread_count, last_message_id = conn.execute(text(f"""
+            INSERT INTO dialog_summaries (
+                user_id, chat_type, chat_id, chat_ref, last_message_id, last_message_preview, last_message_type,
+                last_message_sender_id, last_message_at, unread_count, last_read_message_id, is_muted, is_pinned, updated_at
+            ) VALUES (
+                :owner_id, 'private', :partner_id, :ref, :message_id, :preview, :message_type,
+                :sender_id, :created_at, :unread, :last_read, :no, :no, :now
+            )
+            ON CONFLICT (user_id, chat_type, chat_id) DO UPDATE SET {DIALOG_NEWER_MESSAGE_SQL},
+                unread_count = CASE WHEN :is_sender THEN 0 ELSE dialog_summaries.unread_count + 1 END,
+                last_read_message_id = CASE WHEN :is_sender THEN :message_id ELSE dialog_summaries.last_read_message_id END,
+                updated_at = :now
+            RETURNING unread_count, last_message_id
+        """), {
+            **params,
+            "owner_id": owner_id,
+            "partner_id": partner_id,
+            "unread": 0 if is_sender else 1,
+            "last_read": message.id if is_sender else 0,
+            "is_sender": is_sender,
+            "no": False
+        }).first()
+        if owner_id in existing:
+            changes = unread_changes(unread_count)
+            if last_message_id == message.id:
+                changes["last_message"] = dialog_last_message("private", owner_id, params)
+            queue_dialog_update(session, owner_id, "private", partner_id, changes)
+        else:
+            queue_dialog_update(session, owner_id, "private", partner_id, {"added": True})
+
+def dialog_on_message_changed(session, message: "Message", chat_type: str, chat_ref: Any, deleted: bool):
+    """Правка или удаление сообщения: непрочитанные и последнее сообщение чата"""
+    conn = session.connection()
+    ref = chat_seq_key(chat_type, chat_ref)
+    if deleted:
+        # Удаленное непрочитанное сообщение больше не ждет прочтения
+        not_sender = "" if message.from_user_id is None else "AND user_id != :sender_id"
+        rows = conn.execute(text(f"""
+            UPDATE dialog_summaries SET unread_count = unread_count - 1
+            WHERE chat_ref = :ref AND last_read_message_id < :changed_id AND unread_count > 0 {not_sender}
+            RETURNING user_id, unread_count
+        """), {"ref": ref, "changed_id": message.id, "sender_id": message.from_user_id}).all()
+        for user_id, unread_count in rows:
+            queue_dialog_update(session, user_id, chat_type, dialog_list_id(chat_type, chat_ref, user_id), unread_changes(unread_count))
+        replacement = latest_chat_message(conn, chat_type, chat_ref)
+        params = dialog_message_params(replacement)
+    else:
+        params = dialog_message_params(message)
+    user_ids = conn.execute(text(f"""
+        UPDATE dialog_summaries SET {DIALOG_LAST_MESSAGE_SQL}, updated_at = :now
+        WHERE chat_ref = :ref AND last_message_id = :changed_id
+        RETURNING user_id
+    """), {**params, "ref": ref, "changed_id": message.id, "now": datetime.utcnow()}).scalars().all()
+    for user_id in user_ids:
+        queue_dialog_update(session, user_id, chat_type, dialog_list_id(chat_type, chat_ref, user_id), {
+            "last_message": dialog_last_message(chat_type, user_id, params)
+        })
+
+# Строка списка чатов, в которой все сообщения считаются прочитанными
+DIALOG_READ_ROW_INSERT = text("""
+    INSERT INTO dialog_summaries (
+        user_id, chat_type, chat_id, chat_ref, last_message_id, last_message_preview, last_message_type,
+        last_message_sender_id, last_message_at, unread_count, last_read_message_id, is_muted, is_pinned, updated_at
+    ) VALUES (
+        :user_id, :chat_type, :chat_id, :ref, :message_id, :preview, :message_type,
+        :sender_id, :created_at, 0, :last_read, :muted, :no, :now
+    )
+    ON CONFLICT (user_id, chat_type, chat_id) DO NOTHING
+""")
+
+def dialog_read_row(user_id: int, chat_type: str, chat_id: int, chat_ref: Any, last, last_read: int, notification_settings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
+        **dialog_message_params(last),
+        "user_id": user_id,
+        "chat_type": chat_type,
+        "chat_id": chat_id,
+        "ref": chat_seq_key(chat_type, chat_ref),
+        "last_read": last_read,
+        "muted": bool(notification_settings.get("muted")) if isinstance(notification_settings, dict) else False,
+        "no": False,
+        "now": datetime.utcnow()
+    }
+
+def dialog_on_member_added(session, user_id: int, chat_type: str, chat_id: int, notification_settings: Optional[Dict[str, Any]]):
+    """Вступление в группу/канал: строка с текущим последним сообщением и без непрочитанных"""
+    conn = session.connection()
+    last = latest_chat_message(conn, chat_type, chat_id)
+    last_read = max_chat_message_id(conn, chat_type, chat_id)
+    conn.execute(DIALOG_READ_ROW_INSERT, dialog_read_row(user_id, chat_type, chat_id, chat_id, last, last_read, notification_settings))
+    queue_dialog_update(session, user_id, chat_type, chat_id, {"added": True})
+
+def dialog_on_member_removed(session, user_id: int, chat_type: str, chat_id: int):
+    session.connection().execute(
+        text("DELETE FROM dialog_summaries WHERE user_id = :user_id AND chat_type = :chat_type AND chat_id = :chat_id"),
+        {"user_id": user_id, "chat_type": chat_type, "chat_id": chat_id}
+    )
+    queue_dialog_update(session, user_id, chat_type, chat_id, {"removed": True})
+
+# Поля группы и канала, которые видны в списке чатов
+DIALOG_CHAT_FIELDS = {
+    "group": ("name", "avatar_url", "members_count", "online_count", "is_encrypted", "is_public"),
+    "channel": ("name", "avatar_url", "subscribers_count", "online_count", "is_encrypted", "is_public", "is_verified"),
+}
+
+# Настройки и счетчики строки списка чатов, которые меняются через ORM (прочтение, mute/pin)
+DIALOG_SUMMARY_FIELDS = ("unread_count", "is_muted", "is_pinned")
+
+def queue_chat_dialog_update(session, obj):
+    """Переименование, аватар, счетчики участников группы/канала - всем участникам"""
+    chat_type = "group" if isinstance(obj, Group) else "channel"
+    state = sa_inspect(obj)
+    if state.attrs.is_active.history.has_changes() and not obj.is_active:
+        changes = {"removed": True}
+    else:
+        changes = {
+            field: getattr(obj, field) for field in DIALOG_CHAT_FIELDS[chat_type]
+            if state.attrs[field].history.has_changes()
+        }
+    if changes:
+        session.info.setdefault("dialog_chat_updates", {}).setdefault((chat_type, obj.id), {}).update(changes)
+
+def membership_chat(obj) -> Optional[Tuple[str, int]]:
+    """Тип и id чата для записи участия в группе или подписки на канал"""
+    if isinstance(obj, GroupMember):
+        return ("group", obj.group_id)
+    if isinstance(obj, ChannelSubscription):
+        return ("channel", obj.channel_id)
+    return None
+
+@event.listens_for(SessionLocal, "after_flush")
+def maintain_dialog_summaries(session, flush_context):
+    """Список чатов обновляется в той же транзакции, что и сообщения и участие в чатах"""
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if not any(isinstance(obj, (Message, GroupMember, ChannelSubscription, DialogSummary, Group, Channel)) for obj in changed):
+        return
+    
+    # Сначала сообщения: новый участник получает строку уже с ними и без непрочитанных
+    for obj in changed:
+        if not isinstance(obj, Message):
+            continue
+        key = message_chat_ref(obj)
+        if key is None:
+            continue
+        if obj in session.new:
+            if not obj.is_deleted:
+                dialog_on_message_created(session, obj, *key)
+        elif obj in session.dirty:
+            state = sa_inspect(obj)
+            if state.attrs.is_deleted.history.has_changes() and obj.is_deleted:
+                dialog_on_message_changed(session, obj, *key, deleted=True)
+            elif state.attrs.content.history.has_changes() or state.attrs.message_type.history.has_changes():
+                dialog_on_message_changed(session, obj, *key, deleted=False)
+    
+    for obj in changed:
+        if isinstance(obj, DialogSummary):
+            if obj in session.dirty:
+                state = sa_inspect(obj)
+                changes = {field: getattr(obj, field) for field in DIALOG_SUMMARY_FIELDS if state.attrs[field].history.has_changes()}
+                if "unread_count" in changes:
+                    changes.update(unread_changes(obj.unread_count))
+                if changes:
+                    queue_dialog_update(session, obj.user_id, obj.chat_type, obj.chat_id, changes)
+            continue
+        if isinstance(obj, (Group, Channel)):
+            if obj in session.dirty:
+                queue_chat_dialog_update(session, obj)
+            continue
+        
+        chat = membership_chat(obj)
+        if chat is None or obj.user_id is None or chat[1] is None:
+            continue
+        if obj in session.deleted:
+            dialog_on_member_removed(session, obj.user_id, *chat)
+        elif obj in session.new:
+            if not obj.is_banned:
+                dialog_on_member_added(session, obj.user_id, *chat, obj.notification_settings)
+        elif sa_inspect(obj).attrs.is_banned.history.has_changes():
+            if obj.is_banned:
+                dialog_on_member_removed(session, obj.user_id, *chat)
+            else:
+                dialog_on_member_added(session, obj.user_id, *chat, obj.notification_settings)
+
+def mark_dialog_read(db: Session, user_id: int, message: "Message"):
+    """
+    Сдвиг отметки прочтения чата до сообщения: сообщения до него считаются прочитанными,
+    непрочитанные пересчитываются только после отметки.
+    """
+    key = message_chat_ref(message)
+    if key is None:
+        return
+    chat_type, chat_ref = key
+    chat_id = dialog_partner(chat_ref, user_id) if chat_type == "private" else chat_ref
+    
+    summary = db.query(DialogSummary).filter(
+        DialogSummary.user_id == user_id,
+        DialogSummary.chat_type == chat_type,
+        DialogSummary.chat_id == chat_id
+    ).first()
+    if summary is None or message.id <= (summary.last_read_message_id or 0):
+        return
+    
+    summary.last_read_message_id = message.id
+    if summary.last_message_id is None or message.id >= summary.last_message_id:
+        summary.unread_count = 0
+    else:
+        summary.unread_count = db.query(func.count(Message.id)).filter(
+            chat_message_filter(chat_type, chat_ref),
+            Message.id > message.id,
+            Message.is_deleted == False,
+            or_(Message.from_user_id.is_(None), Message.from_user_id != user_id)
+        ).scalar()
+    
+    # Отметка в самой записи участия - для совместимости со старыми клиентами
+    if chat_type == "group":
+        db.query(GroupMember).filter(
+            GroupMember.group_id == chat_id,
+            GroupMember.user_id == user_id,
+            or_(GroupMember.last_message_read_id.is_(None), GroupMember.last_message_read_id < message.id)
+        ).update({GroupMember.last_message_read_id: message.id}, synchronize_session=False)
+    elif chat_type == "channel":
+        db.query(ChannelSubscription).filter(
+            ChannelSubscription.channel_id == chat_id,
+            ChannelSubscription.user_id == user_id,
+            or_(ChannelSubscription.last_message_read_id.is_(None), ChannelSubscription.last_message_read_id < message.id)
+        ).update({ChannelSubscription.last_message_read_id: message.id}, synchronize_session=False)
+
+# Непрочитанные сообщения строки списка чатов: после отметки прочтения, не свои и не удаленные
+UNREAD_RECOUNT_SQL = {
+    "group": "messages.group_id = dialog_summaries.chat_id",
+    "channel": "messages.channel_id = dialog_summaries.chat_id",
+    "private": "messages.dialog_key = substr(dialog_summaries.chat_ref, 9)",
+}
+
+def reconcile_unread_counts(batch_size: int = UNREAD_RECONCILE_BATCH) -> int:
+    """
+    Сверка счетчиков непрочитанных с сообщениями после отметки прочтения.
+    Исправляет расхождения (ручные правки БД, гонки, сбои) и возвращает число исправленных строк.
+    """
+    with engine.connect() as conn:
+        high_id = conn.execute(text("SELECT MAX(id) FROM dialog_summaries")).scalar()
+    if not high_id:
+        return 0
+    
+    corrected = 0
+    for start in range(0, high_id, batch_size):
+        with engine.begin() as conn:
+            for chat_type, chat_match in UNREAD_RECOUNT_SQL.items():
+                recount = f"""
+                    (SELECT COUNT(*) FROM messages
+                     WHERE {chat_match}
+                       AND messages.id > dialog_summaries.last_read_message_id
+                       AND messages.is_deleted = :no
+                       AND (messages.from_user_id IS NULL OR messages.from_user_id != dialog_summaries.user_id))
+                """
+                result = conn.execute(text(f"""
+                    UPDATE dialog_summaries SET unread_count = {recount}
+                    WHERE id > :start AND id <= :end AND chat_type = :chat_type
+                      AND unread_count != {recount}
+                """), {"start": start, "end": start + batch_size, "chat_type": chat_type, "no": False})
+                corrected += result.rowcount or 0
+    return corrected
+
+def unread_badge(unread_count: int) -> Optional[str]:
+    """Счетчик для отображения: пусто, число или "99+" """
+    if not unread_count or unread_count <= 0:
+        return None
+    if unread_count > UNREAD_DISPLAY_CAP:
+        return f"{UNREAD_DISPLAY_CAP}+"
+    return str(unread_count)
+
+# Индексы, замененные более поздними версиями схемы
+OBSOLETE_INDEXES = ["ix_messages_private_timeline", "ix_messages_recipient_timeline"]
+
+# Колонки, появившиеся после создания таблиц (create_all их не трогает)
+ADDED_COLUMNS = [
+    ("messages", "dialog_key", "VARCHAR(41)"),
+    ("messages", "seq", "INTEGER"),
+]
+
+def migrate_schema(created_tables: Set[str]):
+    """Добавляет новые колонки и таблицы и заполняет их по старым строкам"""
+    for table, column, column_type in ADDED_COLUMNS:
+        if column in {c["name"] for c in sa_inspect(engine).get_columns(table)}:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+            logger.info(f"🛠️ Added {table}.{column}")
+        except Exception as e:
+            # Другой воркер мог добавить колонку одновременно с нами
+            if column not in {c["name"] for c in sa_inspect(engine).get_columns(table)}:
+                raise
+            logger.info(f"🛠️ {table}.{column} already added by another worker: {e}")
+    
+    with engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    
+    backfill_messages(
+        "dialog_key = CASE "
+        "WHEN from_user_id < to_user_id "
+        "THEN CAST(from_user_id AS VARCHAR(20)) || ':' || CAST(to_user_id AS VARCHAR(20)) "
+        "ELSE CAST(to_user_id AS VARCHAR(20)) || ':' || CAST(from_user_id AS VARCHAR(20)) END",
+        "dialog_key IS NULL AND from_user_id IS NOT NULL AND to_user_id IS NOT NULL "
+        "AND group_id IS NULL AND channel_id IS NULL",
+        "dialog_key"
+    )
+    # id растет монотонно, поэтому годится как стартовый номер изменения
+    backfill_messages("seq = id", "seq IS NULL", "seq")
+    
+    if "dialog_summaries" in created_tables:
+        backfill_dialog_summaries()
+    
+    create_search_index()
+
+def backfill_messages(assignment: str, condition: str, label: str, batch_size: int = 50000):
+    """Разовое заполнение новой колонки у старых сообщений, пачками по id"""
+    with engine.connect() as conn:
+        bounds = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM messages WHERE {condition}")).first()
+    if not bounds or bounds[0] is None:
+        return
+    
+    low_id, high_id = bounds
+    updated = 0
+    for start in range(low_id - 1, high_id, batch_size):
+        with engine.begin() as conn:
+            result = conn.execute(text(f"""
+                UPDATE messages SET {assignment}
+                WHERE id > :start AND id <= :end AND {condition}
+            """), {"start": start, "end": start + batch_size})
+            updated += result.rowcount or 0
+    logger.info(f"🛠️ Backfilled {label} for {updated} messages")
+
+def backfill_dialog_summaries(batch_size: int = 5000):
+    """
+    Разовое построение списка чатов по существующим сообщениям и участию.
+    Прочтение раньше не отслеживалось, поэтому старые чаты считаются прочитанными.
+    """
+    created = 0
+    
+    def flush(conn, rows):
+        nonlocal created
+        if rows:
+            conn.execute(DIALOG_READ_ROW_INSERT, rows)
+            created += len(rows)
+            rows.clear()
+    
+    with engine.begin() as conn:
+        rows = []
+        for chat_type, model, chat_column in (("group", GroupMember, GroupMember.group_id), ("channel", ChannelSubscription, ChannelSubscription.channel_id)):
+            last_by_chat = {}
+            memberships = conn.execute(
+                select(model.user_id, chat_column, model.notification_settings)
+                .where(or_(model.is_banned == False, model.is_banned.is_(None)), chat_column.isnot(None))
+                .order_by(chat_column)
+            )
+            for user_id, chat_id, notification_settings in memberships:
+                if chat_id not in last_by_chat:
+                    last_by_chat[chat_id] = (latest_chat_message(conn, chat_type, chat_id), max_chat_message_id(conn, chat_type, chat_id))
+                rows.append(dialog_read_row(user_id, chat_type, chat_id, chat_id, *last_by_chat[chat_id], notification_settings))
+                if len(rows) >= batch_size:
+                    flush(conn, rows)
+        
+        dialog_keys = conn.execute(
+            select(Message.dialog_key).where(Message.dialog_key.isnot(None), Message.is_deleted == False).distinct()
+        ).scalars().all()
+        for dialog_key in dialog_keys:
+            last = latest_chat_message(conn, "private", dialog_key)
+            last_read = max_chat_message_id(conn, "private", dialog_key)
+            low, high = (int(part) for part in dialog_key.split(":"))
+            rows.append(dialog_read_row(low, "private", high, dialog_key, last, last_read))
+            rows.append(dialog_read_row(high, "private", low, dialog_key, last, last_read))
+            if len(rows) >= batch_size:
+                flush(conn, rows)
+        flush(conn, rows)
+    logger.info(f"🛠️ Backfilled {created} dialog summaries")
+
+# ---------- Полнотекстовый поиск по сообщениям ----------
+# SQLite: FTS5 с внешним содержимым (messages) и триггерами; PostgreSQL: колонка tsvector, которую ведет триггер, с GIN-индексом.
+# Без них поиск остается подстрочным (ILIKE).
+
+MESSAGE_SEARCH_BACKEND: Optional[str] = None  # "fts5", "tsvector" или None
+
+# Маркеры найденных слов во фрагменте; заменяются на <mark> после экранирования HTML
+SNIPPET_OPEN, SNIPPET_CLOSE = "\ue000", "\ue001"
+
+def fts_chat_sql(row: str) -> str:
+    """Токен чата для колонки chat индекса FTS5: g<id>, c<id> или d<min>x<max>"""
+    return (
+        f"CASE WHEN {row}.group_id IS NOT NULL THEN 'g' || {row}.group_id "
+        f"WHEN {row}.channel_id IS NOT NULL THEN 'c' || {row}.channel_id "
+        f"ELSE 'd' || replace({row}.dialog_key, ':', 'x') END"
+    )
+
+def fts_indexed_sql(row: str) -> str:
+    """Сообщение попадает в индекс: не удалено, есть текст и чат"""
+    return f"{row}.is_deleted = 0 AND {row}.content IS NOT NULL AND ({fts_chat_sql(row)}) IS NOT NULL"
+
+def fts_chat_token(chat_type: str, chat_ref: Any) -> str:
+    if chat_type == "group":
+        return f"g{chat_ref}"
+    if chat_type == "channel":
+        return f"c{chat_ref}"
+    return "d" + str(chat_ref).replace(":", "x")
+
+def search_terms(query: str) -> List[str]:
+    """Слова поискового запроса (без синтаксиса FTS, его пользователь не передает)"""
+    return re.findall(r"\w+", query.lower())[:16]
+
+def create_search_index():
+    """Создает полнотекстовый индекс сообщений и заполняет его при первом создании"""
+    global MESSAGE_SEARCH_BACKEND
+    dialect = engine.dialect.name
+    try:
+        if dialect == "sqlite":
+            create_fts5_index()
+            MESSAGE_SEARCH_BACKEND = "fts5"
+        elif dialect == "postgresql":
+            create_tsvector_index()
+            MESSAGE_SEARCH_BACKEND = "tsvector"
+    except Exception as e:
+        MESSAGE_SEARCH_BACKEND = None
+        logger.warning(f"⚠️ Full-text search index unavailable, falling back to ILIKE: {e}")
+
+@contextmanager
+def sqlite_write_transaction():
+    """Транзакция SQLite, сразу берущая блокировку записи: воркеры gunicorn выполняют ее по очереди"""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def create_fts5_index(batch_size: int = 50000):
+    """
+    Индекс FTS5 и его заполнение по старым сообщениям.
+    Воркеры стартуют одновременно, поэтому создание идет под блокировкой записи, а граница и прогресс
+    заполнения хранятся в messages_fts_backfill: каждую пачку берет ровно один воркер, прерванное заполнение
+    продолжается при следующем запуске.
+    """
+    with sqlite_write_transaction() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")).first() is not None
+        # Внешнее содержимое - представление с токеном чата, чтобы поиск внутри чата шел по индексу
+        conn.execute(text(f"""
+            CREATE VIEW IF NOT EXISTS messages_search_source AS
+            SELECT id, content, {fts_chat_sql("messages")} AS chat FROM messages
+            WHERE {fts_indexed_sql("messages")}
+        """))
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, chat,
+                content = 'messages_search_source', content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """))
+        remove_old = (
+            f"INSERT INTO messages_fts (messages_fts, rowid, content, chat) "
+            f"SELECT 'delete', old.id, old.content, {fts_chat_sql('old')} WHERE {fts_indexed_sql('old')};"
+        )
+        add_new = (
+            f"INSERT INTO messages_fts (rowid, content, chat) "
+            f"SELECT new.id, new.content, {fts_chat_sql('new')} WHERE {fts_indexed_sql('new')};"
+        )
+        conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN {add_new} END"))
+        conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN {remove_old} END"))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS messages_fts_update "
+            f"AFTER UPDATE OF content, is_deleted, group_id, channel_id, dialog_key ON messages "
+            f"BEGIN {remove_old} {add_new} END"
+        ))
+        conn.execute(text("CREATE TABLE IF NOT EXISTS messages_fts_backfill (high_id INTEGER NOT NULL, done_id INTEGER NOT NULL)"))
+        if not exists:
+            # Более новые сообщения индексируют триггеры, созданные в этой же транзакции
+            conn.execute(text("INSERT INTO messages_fts_backfill (high_id, done_id) SELECT COALESCE(MAX(id), 0), 0 FROM messages"))
+    
+    # Заполняем пачками, а не через 'rebuild', чтобы не держать одну огромную транзакцию
+    indexed = 0
+    while True:
+        with sqlite_write_transaction() as conn:
+            progress = conn.execute(text("SELECT high_id, done_id FROM messages_fts_backfill")).first()
+            if progress is None or progress.done_id >= progress.high_id:
+                break
+            end = min(progress.done_id + batch_size, progress.high_id)
+            result = conn.execute(text(f"""
+                INSERT INTO messages_fts (rowid, content, chat)
+                SELECT messages.id, messages.content, {fts_chat_sql("messages")} FROM messages
+                WHERE messages.id > :start AND messages.id <= :end AND {fts_indexed_sql("messages")}
+            """), {"start": progress.done_id, "end": end})
+            conn.execute(text("UPDATE messages_fts_backfill SET done_id = :end"), {"end": end})
+            indexed += result.rowcount or 0
+    if indexed:
+        logger.info(f"🛠️ Indexed {indexed} messages for full-text search")
+
+def create_tsvector_index(index_engine=None, batch_size: int = 20000):
+    """
+    Колонка tsvector с GIN-индексом (index_engine - другая база PostgreSQL, для тестов).
+    Ни один шаг не переписывает messages под ACCESS EXCLUSIVE: колонка без значения по умолчанию
+    добавляется мгновенно, новые и измененные строки заполняет триггер, старые - пачки UPDATE,
+    а индекс строится CONCURRENTLY, не блокируя запись сообщений.
+    """
+    index_engine = index_engine or engine
+    vector = f"to_tsvector('{MESSAGE_SEARCH_LANGUAGE}'::regconfig, coalesce({{row}}content, ''))"
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    with index_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Воркеры стартуют одновременно: шаги выполняются по очереди
+        conn.execute(text("SELECT pg_advisory_lock(hashtext('messages_content_tsv'))"))
+        try:
+            generated = conn.execute(text("""
+                SELECT is_generated FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'messages' AND column_name = 'content_tsv'
+            """)).scalar()
+            if generated is None:
+                conn.execute(text("ALTER TABLE messages ADD COLUMN content_tsv tsvector"))
+                logger.info("🛠️ Added messages.content_tsv")
+            elif generated == "ALWAYS":
+                # Колонка прежней версии (GENERATED ... STORED): значения сохраняются, дальше ее ведет триггер
+                conn.execute(text("ALTER TABLE messages ALTER COLUMN content_tsv DROP EXPRESSION"))
+            
+            conn.execute(text(f"""
+                CREATE OR REPLACE FUNCTION messages_content_tsv_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.content_tsv := {vector.format(row="NEW.")};
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql
+            """))
+            conn.execute(text("DROP TRIGGER IF EXISTS messages_content_tsv ON messages"))
+            conn.execute(text("""
+                CREATE TRIGGER messages_content_tsv BEFORE INSERT OR UPDATE OF content ON messages
+                FOR EACH ROW EXECUTE FUNCTION messages_content_tsv_update()
+            """))
+            
+            # Старые строки - короткими транзакциями по диапазонам id, прерванное заполнение продолжится при следующем запуске
+            high_id = conn.execute(text("SELECT MAX(id) FROM messages WHERE content_tsv IS NULL")).scalar()
+            filled = 0
+            for start in range(0, high_id or 0, batch_size):
+                result = conn.execute(text(f"""
+                    UPDATE messages SET content_tsv = {vector.format(row="")}
+                    WHERE id > :start AND id <= :end AND content_tsv IS NULL
+                """), {"start": start, "end": start + batch_size})
+                filled += result.rowcount or 0
+            if filled:
+                logger.info(f"🛠️ Backfilled content_tsv for {filled} messages")
+            
+            # Прерванное построение оставляет невалидный индекс - удаляем его и строим заново
+            valid = conn.execute(text("""
+                SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = 'ix_messages_content_tsv' AND c.relnamespace = current_schema()::regnamespace
+            """)).scalar()
+            if valid is False:
+                conn.execute(text("DROP INDEX CONCURRENTLY ix_messages_content_tsv"))
+            if valid is not True:
+                conn.execute(text("CREATE INDEX CONCURRENTLY ix_messages_content_tsv ON messages USING GIN (content_tsv)"))
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(hashtext('messages_content_tsv'))"))
+
+def search_chat_messages(
+    db: Session,
+    chat_type: str,
+    chat_ref: Any,
+    query: str,
+    limit: int,
+    offset: int = 0,
+    before: Optional[datetime] = None,
+    after: Optional[datetime] = None
+) -> Optional[List[Tuple[int, float, str]]]:
+    """
+    Поиск по индексу внутри чата: (id, релевантность - больше лучше, фрагмент в HTML с <mark>).
+    Ранжируются только SEARCH_RANK_WINDOW последних совпадений, иначе частое слово
+    в большом чате заставит оценить каждое его сообщение.
+    None - индекса нет, нужен подстрочный поиск.
+    """
+    if MESSAGE_SEARCH_BACKEND is None:
+        return None
+    terms = search_terms(query)
+    if not terms:
+        return []
+    
+    params: Dict[str, Any] = {
+        "limit": limit, "offset": offset, "window": max(SEARCH_RANK_WINDOW, offset + limit),
+        "open": SNIPPET_OPEN, "close": SNIPPET_CLOSE
+    }
+    conditions = ["m.is_deleted = :no"]
+    params["no"] = False
+    if before:
+        conditions.append("m.created_at < :before")
+        params["before"] = before
+    if after:
+        conditions.append("m.created_at > :after")
+        params["after"] = after
+    column = {"group": "group_id", "channel": "channel_id"}.get(chat_type, "dialog_key")
+    chat_condition = f"m.{column} = :chat_ref"
+    params["chat_ref"] = chat_ref
+    
+    if MESSAGE_SEARCH_BACKEND == "fts5":
+        # Слова - фразы в кавычках, последнее - по префиксу (поиск по мере набора)
+        phrases = " ".join(f'"{term}"' for term in terms) + "*"
+        # Окно свежих совпадений находим по токену чата, идя по индексу от новых к старым.
+        # bm25() здесь не годится: он считает документы с каждой фразой по всему индексу,
+        # и частое слово стоит сотни миллисекунд - релевантность считаем по самому окну
+        params.update(match=f"chat : {fts_chat_token(chat_type, chat_ref)} AND content : ({phrases})", words=SEARCH_SNIPPET_WORDS)
+        window = db.execute(text(f"""
+            SELECT m.id, m.content, snippet(messages_fts, 0, :open, :close, '…', :words) AS snippet
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH :match AND {" AND ".join(conditions)}
+            ORDER BY messages_fts.rowid DESC
+            LIMIT :window
+        """), params).all()
+        scores = window_bm25_scores([content for _, content, _ in window], terms)
+        ranked = sorted(zip(window, scores), key=lambda item: (-item[1], -item[0][0]))
+        rows = [(message_id, score, snippet) for (message_id, _, snippet), score in ranked[offset:offset + limit]]
+    else:
+        params["config"] = MESSAGE_SEARCH_LANGUAGE
+        params["tsquery"] = " & ".join(terms) + ":*"
+        params["headline"] = f"StartSel={SNIPPET_OPEN}, StopSel={SNIPPET_CLOSE}, MaxWords={SEARCH_SNIPPET_WORDS * 2}, MinWords={SEARCH_SNIPPET_WORDS}"
+        # ts_headline дорогой, поэтому считается только для строк страницы
+        rows = db.execute(text(f"""
+            WITH q AS (
+                SELECT to_tsquery(CAST(:config AS regconfig), :tsquery) AS q
+            ), recent AS (
+                SELECT m.id, m.content, m.content_tsv FROM messages m, q
+                WHERE m.content_tsv @@ q.q AND {chat_condition} AND {" AND ".join(conditions)}
+                ORDER BY m.id DESC
+                LIMIT :window
+            ), page AS (
+                SELECT recent.id, recent.content, ts_rank(recent.content_tsv, q.q) AS score FROM recent, q
+                ORDER BY score DESC, recent.id DESC
+                LIMIT :limit OFFSET :offset
+            )
+            SELECT page.id, page.score, ts_headline(CAST(:config AS regconfig), page.content, q.q, :headline)
+            FROM page, q
+            ORDER BY page.score DESC, page.id DESC
+        """), params).all()
+    
+    return [(message_id, float(score), highlight_snippet(snippet)) for message_id, score, snippet in rows]
+
+def fold_search_text(value: str) -> str:
+    """Нижний регистр без диакритики - как токенизатор unicode61 remove_diacritics"""
+    return "".join(char for char in unicodedata.normalize("NFKD", value.lower()) if not unicodedata.combining(char))
+
+def window_bm25_scores(contents: List[Optional[str]], terms: List[str], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    """
+    BM25 по окну совпадений (статистика слов - по самому окну, а не по всему индексу).
+    Последнее слово запроса - префикс, как в запросе к FTS5.
+    """
+    terms = [fold_search_text(term) for term in terms]
+    documents = [re.findall(r"\w+", fold_search_text(content or "")) for content in contents]
+    if not documents:
+        return []
+    average_length = sum(len(tokens) for tokens in documents) / len(documents) or 1
+    
+    frequencies = []
+    for tokens in documents:
+        counts = [sum(1 for token in tokens if token == term) for term in terms[:-1]]
+        counts.append(sum(1 for token in tokens if token.startswith(terms[-1])))
+        frequencies.append(counts)
+    
+    total = len(documents)
+    idf = []
+    for index in range(len(terms)):
+        with_term = sum(1 for counts in frequencies if counts[index])
+        idf.append(math.log((total - with_term + 0.5) / (with_term + 0.5) + 1))
+    
+    scores = []
+    for tokens, counts in zip(documents, frequencies):
+        norm = k1 * (1 - b + b * len(tokens) / average_length)
+        scores.append(sum(weight * count * (k1 + 1) / (count + norm) for weight, count in zip(idf, counts) if count))
+    return scores
+
+def highlight_snippet(snippet: Optional[str]) -> str:
+    """Экранированный фрагмент сообщения с найденными словами в <mark>"""
+    return html.escape(snippet or "").replace(SNIPPET_OPEN, "<mark>").replace(SNIPPET_CLOSE, "</mark>")
+
+# Меняется вместе с миграциями, которых не видно в моделях: триггеры, поисковый индекс, заполнение колонок
+SCHEMA_REVISION = 2
+
+def schema_fingerprint() -> str:
+    """Отпечаток ожидаемой схемы: таблицы, колонки и индексы моделей, добавленные колонки и ревизия миграций"""
+    parts = [str(SCHEMA_REVISION), repr(ADDED_COLUMNS), repr(OBSOLETE_INDEXES)]
+    for table in sorted(Base.metadata.tables.values(), key=lambda table: table.name):
+        parts.append(table.name)
+        parts.extend(sorted(f"{column.name}:{column.type}" for column in table.columns))
+        parts.extend(sorted(str(index.name) for index in table.indexes))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+@contextmanager
+def schema_migration_lock():
+    """
+    Блокировка между воркерами на время проверки и обновления схемы.
+    Миграция идет многими транзакциями, поэтому для SQLite блокируется отдельный файл рядом с базой
+    (BEGIN EXCLUSIVE в самой базе остановил бы и эти транзакции), для PostgreSQL - сессионная advisory-блокировка.
+    """
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(hashtext('devnet_schema'))"))
+            # Блокировка сессионная: транзакцию закрываем, чтобы соединение не простаивало внутри нее
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext('devnet_schema'))"))
+                conn.commit()
+    elif dialect == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+        lock = sqlite3.connect(f"{engine.url.database}.schema-lock", timeout=SCHEMA_LOCK_TIMEOUT, isolation_level=None)
+        try:
+            lock.execute("BEGIN EXCLUSIVE")
+            yield
+        finally:
+            lock.close()
+    else:
+        yield
+
+def read_schema_state() -> Optional[Tuple[str, Optional[str]]]:
+    """Отпечаток схемы и поисковый индекс, записанные последней успешной миграцией"""
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_state (fingerprint VARCHAR(64) NOT NULL, search_backend VARCHAR(20))"))
+        row = conn.execute(text("SELECT fingerprint, search_backend FROM schema_state")).first()
+    return tuple(row) if row else None
+
+def write_schema_state(fingerprint: str, search_backend: Optional[str]):
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM schema_state"))
+        conn.execute(
+            text("INSERT INTO schema_state (fingerprint, search_backend) VALUES (:fingerprint, :backend)"),
+            {"fingerprint": fingerprint, "backend": search_backend}
+        )
+
 # Создаем таблицы
 def create_tables():
-    """Создает таблицы в базе данных"""
+    """
+    Создает таблицы и выполняет миграции.
+    Воркеры gunicorn импортируют main одновременно: схему обновляет первый, остальные ждут блокировку
+    и, увидев записанный отпечаток текущей схемы, не повторяют проверки, индексы и заполнение колонок.
+    """
+    global MESSAGE_SEARCH_BACKEND
     try:
-        Base.metadata.create_all(bind=engine)
+        fingerprint = schema_fingerprint()
+        with schema_migration_lock():
+            state = read_schema_state()
+            if state is not None and state[0] == fingerprint:
+                MESSAGE_SEARCH_BACKEND = state[1]
+                logger.info("✅ Database schema is up to date")
+                return
+            
+            existing_tables = set(sa_inspect(engine).get_table_names())
+            Base.metadata.create_all(bind=engine)
+            migrate_schema(set(Base.metadata.tables) - existing_tables)
+            # create_all не добавляет индексы в уже существующие таблицы
+            for table in Base.metadata.tables.values():
+                for index in table.indexes:
+                    index.create(bind=engine, checkfirst=True)
+            # Без поискового индекса (ошибка создания) миграция повторится при следующем запуске
+            if MESSAGE_SEARCH_BACKEND is not None or engine.dialect.name not in ("sqlite", "postgresql"):
+                write_schema_state(fingerprint, MESSAGE_SEARCH_BACKEND)
         logger.info("✅ Database tables created successfully")
     except Exception as e:
         logger.error(f"❌ Error creating database tables: {e}")
@@ -574,6 +1620,93 @@ def create_tables():
 
 create_tables()
 
+# ========== ПЛАНЫ ГОРЯЧИХ ЗАПРОСОВ ==========
+
+def hot_queries(db: Session) -> Dict[str, Any]:
+    """Горячие запросы с типовыми параметрами для проверки планов"""
+    anchor = datetime(2024, 1, 1)
+    return {
+        "group_timeline": db.query(Message).filter(
+            Message.is_deleted == False, Message.group_id == 1,
+            Message.created_at <= anchor, or_(Message.created_at < anchor, Message.id < 100)
+        ).order_by(desc(Message.created_at), desc(Message.id)).limit(51),
+        "channel_timeline": db.query(Message).filter(
+            Message.is_deleted == False, Message.channel_id == 1
+        ).order_by(desc(Message.created_at), desc(Message.id)).limit(51),
+        "private_timeline": db.query(Message).filter(
+            Message.is_deleted == False, Message.dialog_key == make_dialog_key(1, 2)
+        ).order_by(desc(Message.created_at), desc(Message.id)).limit(51),
+        "user_dialogs": db.query(Message.dialog_key).filter(
+            Message.from_user_id == 1, Message.dialog_key.isnot(None)
+        ).union(
+            db.query(Message.dialog_key).filter(Message.to_user_id == 1, Message.dialog_key.isnot(None))
+        ),
+        "dialog_sync": db.query(Message).filter(
+            Message.dialog_key == make_dialog_key(1, 2), Message.seq > 100
+        ).order_by(Message.seq).limit(201),
+        "user_dialog_list": db.query(DialogSummary).filter(
+            DialogSummary.user_id == 1
+        ).order_by(desc(DialogSummary.last_message_at), desc(DialogSummary.id)),
+        "group_last_message": db.query(Message).filter(
+            Message.group_id == 1, Message.is_deleted == False
+        ).order_by(desc(Message.created_at)).limit(1),
+        "user_groups": db.query(GroupMember.group_id).filter(
+            GroupMember.user_id == 1, GroupMember.is_banned == False
+        ),
+        "group_members": db.query(GroupMember.user_id).filter(
+            GroupMember.group_id == 1, GroupMember.is_banned == False
+        ),
+        "user_channels": db.query(ChannelSubscription.channel_id).filter(
+            ChannelSubscription.user_id == 1, ChannelSubscription.is_banned == False
+        ),
+        "contact_blocked": db.query(Contact).filter(
+            Contact.user_id == 1, Contact.contact_id == 2, Contact.is_blocked == True
+        ),
+        "unread_notifications": db.query(Notification).filter(
+            Notification.user_id == 1, Notification.is_read == False
+        ).order_by(desc(Notification.created_at)).limit(50),
+        "page_reactions": db.query(MessageReaction).filter(MessageReaction.message_id.in_([1, 2, 3])),
+    }
+
+def check_query_plans(plan_engine=None) -> Dict[str, Dict[str, Any]]:
+    """
+    EXPLAIN горячих запросов: full scan любой таблицы считается регрессией.
+    Проверяется тестом BackEnd/tests/test_query_plans.py (SQLite и, при наличии DSN, PostgreSQL).
+    """
+    results = {}
+    if plan_engine is None:
+        if engine.dialect.name == "sqlite":
+            # Пустая копия схемы в памяти: статистика живой базы (ANALYZE) не влияет на результат
+            plan_engine = create_engine("sqlite://")
+            Base.metadata.create_all(bind=plan_engine)
+        else:
+            plan_engine = engine
+    tables = set(Base.metadata.tables)
+    db = sessionmaker(bind=plan_engine)()
+    try:
+        dialect = plan_engine.dialect
+        for name, query in hot_queries(db).items():
+            sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+            
+            if dialect.name == "sqlite":
+                # SEARCH - поиск по ключу индекса, SCAN - обход всей таблицы или всего индекса
+                # (SCAN подзапроса вроде "SCAN anon_1" - обход уже отобранных строк)
+                plan = [row[-1] for row in db.execute(text("EXPLAIN QUERY PLAN " + sql))]
+                full_scan = any(line.split()[:1] == ["SCAN"] and line.split()[1] in tables for line in plan)
+            elif dialect.name == "postgresql":
+                # На маленьких таблицах seq scan дешевле, поэтому проверяем, есть ли вообще индексный путь
+                db.execute(text("SET LOCAL enable_seqscan = off"))
+                plan = [row[0] for row in db.execute(text("EXPLAIN " + sql))]
+                full_scan = any("Seq Scan on " in line for line in plan)
+            else:
+                continue
+            
+            results[name] = {"full_scan": full_scan, "plan": plan}
+        db.rollback()
+    finally:
+        db.close()
+    return results
+
 # ========== УТИЛИТЫ И ХЕЛПЕРЫ ==========
 
 class EncryptionHelper:
@@ -1155,6 +2288,7 @@ def create_initial_data():
             message = Message(
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
+                dialog_key=make_dialog_key(from_user_id, to_user_id),
                 content=content,
                 message_type="text",
                 created_at=datetime.utcnow() - timedelta(hours=random.randint(1, 48))
@@ -1225,366 +2359,2105 @@ try:
 except Exception as e:
     logger.error(f"Failed to create initial data: {e}")
 
-# ========== WEBSOCKET MANAGER ==========
+# ========== BACKPLANE МЕЖДУ ВОРКЕРАМИ ==========
 
-class ConnectionManager:
+class Backplane:
+    """Backplane одного процесса: события не покидают воркер"""
+    name = "local"
+    distributed = False
+    
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
-        self.user_connections: Dict[int, List[WebSocket]] = {}
-        self.user_devices: Dict[int, Dict[str, Any]] = {}
-        self.typing_indicators: Dict[Tuple[str, int], Dict[int, datetime]] = {}
-        self.call_rooms: Dict[str, Dict[str, Any]] = {}
-        self.lock = asyncio.Lock()  # Используем asyncio.Lock вместо threading.Lock
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.on_event = None
+        self.counters: Dict[str, int] = {"published": 0, "received": 0, "errors": 0}
     
-    async def connect(self, websocket: WebSocket, user_id: int, device_id: Optional[str] = None):
-        """Подключение пользователя к WebSocket"""
-        await websocket.accept()
-        
-        async with self.lock:
-            if user_id not in self.user_connections:
-                self.user_connections[user_id] = []
-            
-            self.user_connections[user_id].append(websocket)
-            self.active_connections[id(websocket)] = user_id
-            
-            if device_id:
-                if user_id not in self.user_devices:
-                    self.user_devices[user_id] = {}
-                self.user_devices[user_id][device_id] = {
-                    "connected_at": datetime.utcnow(),
-                    "last_activity": datetime.utcnow()
-                }
+    async def start(self, on_event):
+        """Запуск приема событий; on_event вызывается для событий других воркеров"""
+        self.on_event = on_event
+    
+    def publish(self, event: Dict[str, Any]):
+        """Публикация события для остальных воркеров (без ожидания, порядок сохраняется)"""
+        pass
+    
+    async def stop(self):
+        """Остановка backplane"""
+        pass
+    
+    def _encode(self, event: Dict[str, Any]) -> bytes:
+        event["origin"] = self.worker_id
+        return json.dumps(event, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+    
+    def _dispatch(self, payload: bytes):
+        """Разбор и передача события менеджеру соединений"""
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            self.counters["errors"] += 1
+            return
         
-        logger.info(f"✅ User {user_id} connected to WebSocket (device: {device_id})")
+        # Redis возвращает подписчику и собственные публикации
+        if event.get("origin") == self.worker_id or self.on_event is None:
+            return
         
-        # Обновляем статус пользователя в БД
-        db = SessionLocal()
+        self.counters["received"] += 1
         try:
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                user.is_online = True
-                user.last_seen = datetime.utcnow()
-                db.commit()
-                
-                # Уведомляем других пользователей
-                await self.broadcast_user_status(user_id, True)
+            self.on_event(event)
         except Exception as e:
-            logger.error(f"⚠️ Error updating user status: {e}")
-        finally:
-            db.close()
+            self.counters["errors"] += 1
+            logger.error(f"❌ Error handling backplane event {event.get('kind')}: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика backplane"""
+        return {"type": self.name, "worker_id": self.worker_id, **self.counters}
+
+class UnixSocketBackplane(Backplane):
+    """Backplane на Unix datagram сокетах: каждый воркер слушает свой сокет в общей директории"""
+    name = "unix"
+    distributed = True
+    
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, f"worker-{os.getpid()}.sock")
+        self.sock: Optional[socket.socket] = None
+        self.peers: List[str] = []
+        self.peers_refreshed_at = 0.0
+        self.buffer = bytearray(BACKPLANE_MAX_EVENT_BYTES)
+        self.counters.update({"dropped": 0, "oversized": 0})
+    
+    async def start(self, on_event):
+        await super().start(on_event)
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, BACKPLANE_MAX_EVENT_BYTES * 8)
+            except OSError:
+                pass
+        sock.bind(self.path)
+        sock.setblocking(False)
+        self.sock = sock
         
-        # Отправляем информацию о текущем состоянии
-        await self.send_user_state(user_id, websocket)
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+        logger.info(f"🔌 Unix backplane listening on {self.path}")
     
-    async def disconnect(self, websocket: WebSocket):
-        """Отключение пользователя от WebSocket"""
-        connection_id = id(websocket)
-        
-        if connection_id in self.active_connections:
-            user_id = self.active_connections[connection_id]
-            
-            async with self.lock:
-                # Удаляем соединение
-                if user_id in self.user_connections:
-                    if websocket in self.user_connections[user_id]:
-                        self.user_connections[user_id].remove(websocket)
-                    
-                    if not self.user_connections[user_id]:
-                        del self.user_connections[user_id]
-                        del self.active_connections[connection_id]
-                        
-                        # Обновляем статус пользователя в БД
-                        asyncio.create_task(self.update_user_offline_status(user_id))
-                else:
-                    del self.active_connections[connection_id]
-            
-            logger.info(f"📴 User {user_id} disconnected from WebSocket")
+    def _on_readable(self):
+        """Чтение всех накопившихся датаграмм"""
+        while self.sock is not None:
+            try:
+                size = self.sock.recv_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.counters["errors"] += 1
+                logger.warning(f"⚠️ Unix backplane receive error: {e}")
+                return
+            self._dispatch(bytes(self.buffer[:size]))
     
-    async def update_user_offline_status(self, user_id: int):
-        """Обновление статуса пользователя при отключении"""
-        await asyncio.sleep(5)  # Ждем 5 секунд перед установкой офлайн статуса
-        
-        async with self.lock:
-            if user_id in self.user_connections and self.user_connections[user_id]:
-                return  # Пользователь снова подключился
+    def _refresh_peers(self):
+        """Список сокетов других воркеров (перечитывается не чаще раза в секунду)"""
+        now = time.monotonic()
+        if now - self.peers_refreshed_at < 1.0:
+            return
         
-        db = SessionLocal()
+        self.peers_refreshed_at = now
         try:
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                user.is_online = False
-                user.last_seen = datetime.utcnow()
-                db.commit()
-                
-                # Уведомляем других пользователей
-                await self.broadcast_user_status(user_id, False)
-        except Exception as e:
-            logger.error(f"⚠️ Error updating user status on disconnect: {e}")
-        finally:
-            db.close()
-    
-    async def send_to_user(self, user_id: int, message: Dict[str, Any]):
-        """Отправка сообщения конкретному пользователю"""
-        if user_id in self.user_connections:
-            disconnected = []
-            
-            for websocket in self.user_connections[user_id]:
-                try:
-                    await websocket.send_json(message)
-                    
-                    # Обновляем активность устройства
-                    async with self.lock:
-                        if user_id in self.user_devices:
-                            for device_id, device_info in self.user_devices[user_id].items():
-                                device_info["last_activity"] = datetime.utcnow()
-                except Exception as e:
-                    logger.error(f"❌ Error sending to user {user_id}: {e}")
-                    disconnected.append(websocket)
-            
-            # Удаляем отключенные соединения
-            for websocket in disconnected:
-                await self.disconnect(websocket)
+            self.peers = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".sock") and os.path.join(self.directory, name) != self.path
+            ]
+        except OSError as e:
+            logger.warning(f"⚠️ Unix backplane directory error: {e}")
+            self.peers = []
     
-    async def broadcast(self, message: Dict[str, Any], exclude_user_id: Optional[int] = None):
-        """Широковещательная рассылка всем пользователям"""
-        disconnected = []
+    def publish(self, event: Dict[str, Any]):
+        if self.sock is None:
+            return
         
-        async with self.lock:
-            connections_to_send = []
-            
-            for user_id, websockets in self.user_connections.items():
-                if user_id == exclude_user_id:
-                    continue
-                
-                for websocket in websockets:
-                    connections_to_send.append((user_id, websocket))
+        data = self._encode(event)
+        if len(data) > BACKPLANE_MAX_EVENT_BYTES:
+            self.counters["oversized"] += 1
+            logger.warning(f"⚠️ Backplane event {event.get('kind')} is too large ({len(data)} bytes), dropped")
+            return
         
-        for user_id, websocket in connections_to_send:
+        self._refresh_peers()
+        for peer in list(self.peers):
+            try:
+                self.sock.sendto(data, peer)
+            except BlockingIOError:
+                # Очередь воркера-получателя переполнена
+                self.counters["dropped"] += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Сокет остался от завершившегося воркера
+                self.peers.remove(peer)
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+            except OSError as e:
+                self.counters["errors"] += 1
+                logger.warning(f"⚠️ Unix backplane send error to {peer}: {e}")
+        
+        self.counters["published"] += 1
+    
+    async def stop(self):
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+def _resp_command(*parts: bytes) -> bytes:
+    """Кодирование команды в протокол RESP"""
+    chunks = [b"*%d\r\n" % len(parts)]
+    for part in parts:
+        chunks.append(b"$%d\r\n%s\r\n" % (len(part), part))
+    return b"".join(chunks)
+
+async def _read_resp(reader: asyncio.StreamReader):
+    """Чтение одного ответа в протоколе RESP"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by server")
+    
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest
+    if prefix == b"-":
+        raise ConnectionError(rest.decode("utf-8", "replace"))
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if prefix == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await _read_resp(reader) for _ in range(length)]
+    
+    raise ConnectionError(f"Unexpected RESP reply: {line[:32]!r}")
+
+class RedisBackplane(Backplane):
+    """Backplane через Redis PUBLISH/SUBSCRIBE (минимальный клиент протокола RESP)"""
+    name = "redis"
+    distributed = True
+    
+    def __init__(self, url: str, channel: str = BACKPLANE_CHANNEL):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.channel = channel.encode("utf-8")
+        self.outbox: "deque[bytes]" = deque()
+        self.outbox_ready = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+        self.counters["dropped"] = 0
+    
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_resp_command(b"AUTH", self.password.encode("utf-8")))
+            await writer.drain()
+            await _read_resp(reader)
+        return reader, writer
+    
+    async def start(self, on_event):
+        await super().start(on_event)
+        self.tasks = [
+            asyncio.create_task(self._subscribe_loop()),
+            asyncio.create_task(self._publish_loop())
+        ]
+        logger.info(f"🔌 Redis backplane on {self.host}:{self.port}, channel {self.channel.decode()}")
+    
+    async def _subscribe_loop(self):
+        """Подписка на канал с переподключением"""
+        delay = 1
+        while True:
+            writer = None
             try:
-                await websocket.send_json(message)
+                reader, writer = await self._open()
+                writer.write(_resp_command(b"SUBSCRIBE", self.channel))
+                await writer.drain()
+                delay = 1
                 
-                # Обновляем активность
-                async with self.lock:
-                    if user_id in self.user_devices:
-                        for device_info in self.user_devices[user_id].values():
-                            device_info["last_activity"] = datetime.utcnow()
+                while True:
+                    reply = await _read_resp(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._dispatch(reply[2])
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"❌ Error broadcasting to user {user_id}: {e}")
-                disconnected.append(websocket)
+                self.counters["errors"] += 1
+                logger.warning(f"⚠️ Redis backplane subscriber error: {e}, retrying in {delay}s")
+            finally:
+                if writer is not None:
+                    writer.close()
+            
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    
+    def publish(self, event: Dict[str, Any]):
+        if len(self.outbox) >= BACKPLANE_OUTBOX_SIZE:
+            self.counters["dropped"] += 1
+            return
         
-        # Удаляем отключенные соединения
-        for websocket in disconnected:
-            await self.disconnect(websocket)
+        self.outbox.append(_resp_command(b"PUBLISH", self.channel, self._encode(event)))
+        self.outbox_ready.set()
     
-    async def broadcast_to_chat(self, chat_type: str, chat_id: int, message: Dict[str, Any], exclude_user_id: Optional[int] = None):
-        """Отправка сообщения всем участникам чата"""
+    async def _publish_loop(self):
+        """Отправка накопленных PUBLISH одной пачкой с переподключением"""
+        delay = 1
+        while True:
+            writer = None
+            reply_task = None
+            try:
+                reader, writer = await self._open()
+                reply_task = asyncio.create_task(self._drain_replies(reader))
+                delay = 1
+                
+                while True:
+                    if not self.outbox:
+                        self.outbox_ready.clear()
+                        await self.outbox_ready.wait()
+                        continue
+                    if reply_task.done():
+                        raise ConnectionError("Publisher connection lost")
+                    
+                    batch = list(self.outbox)
+                    self.outbox.clear()
+                    writer.write(b"".join(batch))
+                    await writer.drain()
+                    self.counters["published"] += len(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.counters["errors"] += 1
+                logger.warning(f"⚠️ Redis backplane publisher error: {e}, retrying in {delay}s")
+            finally:
+                if reply_task is not None:
+                    reply_task.cancel()
+                if writer is not None:
+                    writer.close()
+            
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    
+    async def _drain_replies(self, reader: asyncio.StreamReader):
+        """Чтение ответов на PUBLISH, чтобы не ждать их при публикации"""
+        while True:
+            await _read_resp(reader)
+    
+    async def stop(self):
+        # Даем отправиться последним событиям (например, "bye")
+        for _ in range(10):
+            if not self.outbox:
+                break
+            await asyncio.sleep(0.05)
+        for task in self.tasks:
+            task.cancel()
+
+def create_backplane(url: str) -> Backplane:
+    """Создание backplane по BACKPLANE_URL"""
+    if not url:
+        return Backplane()
+    if url.startswith("unix://"):
+        return UnixSocketBackplane(url[len("unix://"):])
+    if url.startswith("redis://"):
+        return RedisBackplane(url)
+    
+    logger.warning(f"⚠️ Unknown BACKPLANE_URL scheme: {url}, falling back to single-process mode")
+    return Backplane()
+
+# ========== WEBSOCKET MANAGER ==========
+
+class ChatMembershipIndex:
+    """LRU-индекс участников чатов: (chat_type, chat_id) -> set(user_id)"""
+    
+    def __init__(self, max_chats: int = MEMBERSHIP_CACHE_SIZE):
+        self.max_chats = max_chats
+        self.members: "OrderedDict[Tuple[str, int], Set[int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Чаты, загружаемые в пуле потоков: обработчики, ждущие участников, и изменения за время загрузки
+        self.loading: Dict[Tuple[str, int], Dict[str, List[Any]]] = {}
+        # Вызывается при локальных изменениях, чтобы разослать их другим воркерам
+        self.on_change = None
+    
+    def _notify(self, op: str, chat_type: str, chat_id: int, user_id: Optional[int] = None):
+        if self.on_change is not None:
+            self.on_change(op, chat_type, chat_id, user_id)
+    
+    def _load(self, chat_type: str, chat_id: int) -> Set[int]:
+        """Загрузка участников чата из БД (только user_id, выполняется в пуле потоков)"""
         db = SessionLocal()
         try:
-            user_ids = set()
-            
-            if chat_type == "private":
-                user_ids.add(chat_id)
-            elif chat_type == "group":
-                members = db.query(GroupMember).filter(
+            if chat_type == "group":
+                rows = db.query(GroupMember.user_id).filter(
                     GroupMember.group_id == chat_id,
                     GroupMember.is_banned == False
                 ).all()
-                user_ids.update(member.user_id for member in members)
             elif chat_type == "channel":
-                subscribers = db.query(ChannelSubscription).filter(
+                rows = db.query(ChannelSubscription.user_id).filter(
                     ChannelSubscription.channel_id == chat_id,
                     ChannelSubscription.is_banned == False
                 ).all()
-                user_ids.update(subscriber.user_id for subscriber in subscribers)
-            
-            if exclude_user_id and exclude_user_id in user_ids:
-                user_ids.remove(exclude_user_id)
+            else:
+                return set()
             
-            # Отправляем каждому пользователю
-            for user_id in user_ids:
-                if user_id in self.user_connections:
-                    await self.send_to_user(user_id, message)
-                    
-        except Exception as e:
-            logger.error(f"❌ Error broadcasting to chat: {e}")
+            return {row[0] for row in rows if row[0] is not None}
         finally:
             db.close()
     
-    async def broadcast_user_status(self, user_id: int, is_online: bool):
-        """Уведомление о изменении статуса пользователя"""
-        message = {
-            "type": "user_status",
-            "user_id": user_id,
-            "is_online": is_online,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+    def with_members(self, chat_type: str, chat_id: int, callback: Callable[[Set[int]], None]):
+        """
+        Вызов callback(участники) сразу из индекса или после загрузки чата в пуле потоков.
+        Обработчики одного чата выполняются в порядке поступления, загрузка одна на чат.
+        """
+        key = (chat_type, chat_id)
+        loading = self.loading.get(key)
+        if loading is not None:
+            loading["callbacks"].append(callback)
+            return
+        
+        members = self.peek(chat_type, chat_id)
+        if members is not None:
+            callback(members)
+            return
         
-        await self.broadcast(message, exclude_user_id=user_id)
+        self.misses += 1
+        self.loading[key] = {"callbacks": [callback], "changes": []}
+        asyncio.create_task(self._load_in_thread(key))
     
-    async def send_user_state(self, user_id: int, websocket: WebSocket):
-        """Отправка текущего состояния пользователю"""
-        db = SessionLocal()
+    async def get_members(self, chat_type: str, chat_id: int) -> Set[int]:
+        """Получение участников чата (лениво загружается при первом обращении)"""
+        future = asyncio.get_running_loop().create_future()
+        
+        def resolve(members: Set[int]):
+            if not future.done():
+                future.set_result(members)
+        
+        self.with_members(chat_type, chat_id, resolve)
+        return await future
+    
+    async def _load_in_thread(self, key: Tuple[str, int]):
+        cacheable = True
         try:
-            # Получаем непрочитанные уведомления
-            notifications = db.query(Notification).filter(
-                Notification.user_id == user_id,
-                Notification.is_read == False
-            ).order_by(desc(Notification.created_at)).limit(50).all()
-            
-            # Получаем активные чаты
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                # Отправляем информацию о пользователе
-                await websocket.send_json({
-                    "type": "user_state",
-                    "user": {
-                        "id": user.id,
-                        "username": user.username,
-                        "display_name": user.display_name,
-                        "avatar_url": user.avatar_url,
-                        "status": user.status,
-                        "status_message": user.status_message,
-                        "is_online": user.is_online,
-                        "settings": user.settings
-                    },
-                    "notifications": [
-                        {
-                            "id": n.id,
-                            "type": n.type,
-                            "title": n.title,
-                            "message": n.message,
-                            "data": n.data,
-                            "is_read": n.is_read,
-                            "created_at": n.created_at.isoformat() if n.created_at else None
-                        }
-                        for n in notifications
-                    ],
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-                
+            members = await asyncio.to_thread(self._load, *key)
         except Exception as e:
-            logger.error(f"❌ Error sending user state: {e}")
+            logger.error(f"❌ Ошибка загрузки участников {key[0]} {key[1]}: {e}")
+            members, cacheable = set(), False
+        
+        loading = self.loading.pop(key)
+        # Изменения во время загрузки применяем поверх прочитанного списка по порядку
+        for op, user_id in loading["changes"]:
+            if op == "add":
+                members.add(user_id)
+            elif op == "remove":
+                members.discard(user_id)
+            else:
+                cacheable = False
+        
+        if cacheable:
+            self.members[key] = members
+            # Вытесняем самые старые чаты при переполнении
+            while len(self.members) > self.max_chats:
+                self.members.popitem(last=False)
+                self.evictions += 1
+        
+        for callback in loading["callbacks"]:
+            try:
+                callback(members)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки участников {key[0]} {key[1]}: {e}")
+    
+    def peek(self, chat_type: str, chat_id: int) -> Optional[Set[int]]:
+        """Участники чата, если он уже в индексе (без обращения к БД)"""
+        members = self.members.get((chat_type, chat_id))
+        if members is not None:
+            self.hits += 1
+            self.members.move_to_end((chat_type, chat_id))
+        return members
+    
+    def add_member(self, chat_type: str, chat_id: int, user_id: int, propagate: bool = True):
+        """Добавление участника (только если чат уже в индексе или загружается)"""
+        members = self.members.get((chat_type, chat_id))
+        if members is not None:
+            members.add(user_id)
+        elif (chat_type, chat_id) in self.loading:
+            self.loading[(chat_type, chat_id)]["changes"].append(("add", user_id))
+        if propagate:
+            self._notify("add", chat_type, chat_id, user_id)
+    
+    def remove_member(self, chat_type: str, chat_id: int, user_id: int, propagate: bool = True):
+        """Удаление участника (только если чат уже в индексе или загружается)"""
+        members = self.members.get((chat_type, chat_id))
+        if members is not None:
+            members.discard(user_id)
+        elif (chat_type, chat_id) in self.loading:
+            self.loading[(chat_type, chat_id)]["changes"].append(("remove", user_id))
+        if propagate:
+            self._notify("remove", chat_type, chat_id, user_id)
+    
+    def invalidate(self, chat_type: str, chat_id: int, propagate: bool = True):
+        """Удаление чата из индекса"""
+        self.members.pop((chat_type, chat_id), None)
+        if (chat_type, chat_id) in self.loading:
+            self.loading[(chat_type, chat_id)]["changes"].append(("invalidate", None))
+        if propagate:
+            self._notify("invalidate", chat_type, chat_id)
+    
+    def apply(self, op: str, chat_type: str, chat_id: int, user_id: Optional[int] = None):
+        """Применение изменения, пришедшего от другого воркера"""
+        if op == "add" and user_id is not None:
+            self.add_member(chat_type, chat_id, user_id, propagate=False)
+        elif op == "remove" and user_id is not None:
+            self.remove_member(chat_type, chat_id, user_id, propagate=False)
+        else:
+            self.invalidate(chat_type, chat_id, propagate=False)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика индекса"""
+        total = self.hits + self.misses
+        return {
+            "chats": len(self.members),
+            "max_chats": self.max_chats,
+            "members": sum(len(members) for members in self.members.values()),
+            "loading": len(self.loading),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+class MessageTailCache:
+    """LRU-кэш последних сериализованных сообщений чатов: (chat_type, chat_key) -> хвост по возрастанию времени"""
+    
+    def __init__(self, size: int = MESSAGE_TAIL_SIZE, max_bytes: int = MESSAGE_TAIL_MAX_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.chats: "OrderedDict[Tuple[str, Any], Dict[str, Any]]" = OrderedDict()
+        self.bytes = 0
+        # Меняется при каждом коммите сообщений: заполнение по устаревшему чтению отбрасывается
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = {"hits": 0, "misses": 0, "fills": 0, "updates": 0, "evictions": 0, "invalidations": 0}
+        # Вызывается при локальных изменениях, чтобы другие воркеры сбросили свои копии
+        self.on_change = None
+    
+    @staticmethod
+    def key_for(message: "Message") -> Optional[Tuple[str, Any]]:
+        """Ключ чата сообщения"""
+        return message_chat_ref(message)
+    
+    @staticmethod
+    def _size(payload: Dict[str, Any]) -> int:
+        return len(json.dumps(payload, ensure_ascii=False, default=str))
+    
+    @staticmethod
+    def _position(payload: Dict[str, Any]) -> Tuple[str, int]:
+        return (payload.get("created_at") or "", payload["id"])
+    
+    def get(self, key: Tuple[str, Any], limit: int, viewer_id: int) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """Последние limit сообщений и признак более старых, None если хвоста не хватает"""
+        with self.lock:
+            entry = self.chats.get(key)
+            if entry is None or (len(entry["messages"]) < limit and not entry["complete"]):
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            self.chats.move_to_end(key)
+            tail = entry["messages"][-limit:]
+            has_older = len(entry["messages"]) > limit or not entry["complete"]
+        
+        # Поля, зависящие от зрителя, подставляются на копиях
+        return [{**payload, "is_my_message": payload["from_user_id"] == viewer_id} for payload in tail], has_older
+    
+    def fill(self, key: Tuple[str, Any], messages: List[Dict[str, Any]], complete: bool, generation: int):
+        """Сохранение первой страницы, прочитанной из БД"""
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.chats.pop(key, None)
+            if old:
+                self.bytes -= old["bytes"]
+            messages = list(messages[-self.size:])
+            entry = {
+                "messages": messages,
+                "sizes": {payload["id"]: self._size(payload) for payload in messages},
+                "complete": complete and len(messages) < self.size
+            }
+            entry["bytes"] = sum(entry["sizes"].values())
+            self.chats[key] = entry
+            self.bytes += entry["bytes"]
+            self.counters["fills"] += 1
+            self._evict()
+    
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.chats:
+            _, entry = self.chats.popitem(last=False)
+            self.bytes -= entry["bytes"]
+            self.counters["evictions"] += 1
+    
+    def _remove(self, entry: Dict[str, Any], index: int):
+        payload = entry["messages"].pop(index)
+        size = entry["sizes"].pop(payload["id"], 0)
+        entry["bytes"] -= size
+        self.bytes -= size
+    
+    def _store(self, entry: Dict[str, Any], index: int, payload: Dict[str, Any]):
+        size = self._size(payload)
+        entry["messages"].insert(index, payload)
+        entry["sizes"][payload["id"]] = size
+        entry["bytes"] += size
+        self.bytes += size
+    
+    def apply(self, key: Tuple[str, Any], message_id: int, payload: Optional[Dict[str, Any]]):
+        """Обновление хвоста на месте: payload=None означает удаление сообщения"""
+        with self.lock:
+            entry = self.chats.get(key)
+            if entry is None:
+                return
+            messages = entry["messages"]
+            self.counters["updates"] += 1
+            
+            for index, cached in enumerate(messages):
+                if cached["id"] == message_id:
+                    self._remove(entry, index)
+                    if payload is not None:
+                        self._store(entry, index, payload)
+                    break
+            else:
+                if payload is not None:
+                    position = self._position(payload)
+                    index = len(messages)
+                    while index > 0 and self._position(messages[index - 1]) > position:
+                        index -= 1
+                    # Сообщение старше хвоста неполного чата в кэш не попадает
+                    if index > 0 or entry["complete"]:
+                        self._store(entry, index, payload)
+                        while len(messages) > self.size:
+                            self._remove(entry, 0)
+                            entry["complete"] = False
+            
+            # Цитаты этого сообщения в ответах
+            for cached in messages:
+                reply = cached.get("reply_to")
+                if reply and reply["message_id"] == message_id and payload is not None:
+                    content = payload["content"]
+                    reply["content"] = content[:100] + "..." if len(content or "") > 100 else content
+            self._evict()
+    
+    def invalidate_sender(self, user_id: int):
+        """Сброс хвостов, где есть сообщения пользователя (сменились имя или аватар)"""
+        with self.lock:
+            keys = [
+                key for key, entry in self.chats.items()
+                if any(payload["from_user_id"] == user_id for payload in entry["messages"])
+            ]
+        for key in keys:
+            self.invalidate(key)
+    
+    def invalidate(self, key: Tuple[str, Any], propagate: bool = True):
+        """Удаление хвоста чата"""
+        with self.lock:
+            entry = self.chats.pop(key, None)
+            if entry:
+                self.bytes -= entry["bytes"]
+                self.counters["invalidations"] += 1
+        if propagate and self.on_change is not None:
+            self.on_change(key)
+    
+    def refresh(self, changed: Dict[int, Optional[Tuple[str, Any]]]):
+        """Пересериализация закоммиченных сообщений для кэшированных чатов"""
+        changed = {message_id: key for message_id, key in changed.items() if key in self.chats}
+        if not changed:
+            return
+        db = SessionLocal()
+        try:
+            rows = db.query(Message).filter(Message.id.in_(list(changed)), Message.is_deleted == False).all()
+            payloads = {payload["id"]: payload for payload in serialize_messages(db, rows)}
         finally:
             db.close()
+        
+        # Удаленные (или стертые из БД) сообщения просто убираются из хвоста
+        for message_id, key in changed.items():
+            self.apply(key, message_id, payloads.get(message_id))
+        for key in set(changed.values()):
+            if self.on_change is not None:
+                self.on_change(key)
     
-    async def update_typing_indicator(self, user_id: int, chat_type: str, chat_id: int, is_typing: bool):
-        """Обновление индикатора набора текста"""
-        key = (chat_type, chat_id)
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика кэша хвостов"""
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "chats": len(self.chats),
+            "messages": sum(len(entry["messages"]) for entry in self.chats.values()),
+            "tail_size": self.size,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(self.counters["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+class ReplayLog:
+    """
+    Журнал недавних WebSocket событий для повтора после переподключения.
+    Потоки - пользователь (личные события) и группа/канал.
+    Номера событий общие для всех воркеров: воркер-источник назначает номер до публикации в backplane,
+    остальные записывают событие с тем же номером, поэтому клиент может переподключиться к любому воркеру.
+    """
+    
+    def __init__(self, size: int = WS_REPLAY_SIZE, ttl: float = WS_REPLAY_TTL, max_streams: int = WS_REPLAY_STREAMS):
+        self.size = size
+        self.ttl = ttl
+        self.max_streams = max_streams
+        # Гибридные часы: миллисекунды * 1000 + счетчик; чужие номера сдвигают часы вперед
+        self.last_id = self._clock()
+        # Поток: {"events": deque[(id, tick, message, exclude_user_id)], "trimmed": последний выброшенный id}
+        self.streams: "OrderedDict[Tuple[str, Any], Dict[str, Any]]" = OrderedDict()
+        # До этого номера журнал неполон: событий до запуска воркера и из потоков, выброшенных целиком
+        self.evicted_id = self.last_id
+        self.counters = {"recorded": 0, "replays": 0, "replayed": 0, "resyncs": 0}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+    
+    @staticmethod
+    def _clock() -> int:
+        return int(time.time() * 1000) * 1000
+    
+    def _trim(self, stream: Dict[str, Any], now: float):
+        events = stream["events"]
+        while events and (len(events) > self.size or now - events[0][1] > self.ttl):
+            stream["trimmed"] = max(stream["trimmed"], events.popleft()[0])
+    
+    def stamp(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Копия кадра данных с новым event_id (вызывается воркером-источником до публикации)"""
+        if not self.enabled or message.get("type") not in REPLAY_FRAME_TYPES or "event_id" in message:
+            return message
+        self.last_id = max(self.last_id + 1, self._clock())
+        return {**message, "event_id": str(self.last_id)}
+    
+    def record(self, key: Tuple[str, Any], message: Dict[str, Any], exclude_user_id: Optional[int] = None) -> Dict[str, Any]:
+        """Запись кадра данных в поток; возвращает кадр с event_id (pong, звонки и typing не пишутся)"""
+        message = self.stamp(message)
+        number = self.parse(message.get("event_id") or "")
+        if number is None or message.get("type") not in REPLAY_FRAME_TYPES:
+            return message
+        
+        self.last_id = max(self.last_id, number)
+        now = time.monotonic()
+        
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = {"events": deque(), "trimmed": 0}
+        else:
+            self.streams.move_to_end(key)
+        stream["events"].append((number, now, message, exclude_user_id))
+        self._trim(stream, now)
+        self.counters["recorded"] += 1
         
-        async with self.lock:
-            if is_typing:
-                if key not in self.typing_indicators:
-                    self.typing_indicators[key] = {}
-                self.typing_indicators[key][user_id] = datetime.utcnow()
-            else:
-                if key in self.typing_indicators and user_id in self.typing_indicators[key]:
-                    del self.typing_indicators[key][user_id]
-                    if not self.typing_indicators[key]:
-                        del self.typing_indicators[key]
+        while len(self.streams) > self.max_streams:
+            _, evicted = self.streams.popitem(last=False)
+            if evicted["events"]:
+                self.evicted_id = max(self.evicted_id, max(event[0] for event in evicted["events"]))
         
-        # Отправляем уведомление другим участникам
-        typing_message = {
-            "type": "typing",
-            "chat_type": chat_type,
-            "chat_id": chat_id,
-            "user_id": user_id,
-            "is_typing": is_typing,
-            "timestamp": datetime.utcnow().isoformat()
+        return message
+    
+    @staticmethod
+    def parse(event_id: str) -> Optional[int]:
+        """Номер события или None для чужого формата"""
+        if not event_id.isdigit():
+            return None
+        return int(event_id)
+    
+    def since(self, event_id: str, user_id: int, keys: List[Tuple[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        """
+        События потоков keys после event_id в порядке номеров.
+        None - часть пропуска уже не хранится и клиенту нужна полная ресинхронизация.
+        """
+        last_id = self.parse(event_id)
+        if last_id is None or last_id > self.last_id or self.evicted_id > last_id:
+            self.counters["resyncs"] += 1
+            return None
+        
+        now = time.monotonic()
+        missed = []
+        for key in keys:
+            stream = self.streams.get(key)
+            if stream is None:
+                continue
+            self._trim(stream, now)
+            if stream["trimmed"] > last_id:
+                self.counters["resyncs"] += 1
+                return None
+            missed.extend(
+                (number, message) for number, _, message, exclude_user_id in stream["events"]
+                if number > last_id and exclude_user_id != user_id
+            )
+        
+        missed.sort(key=lambda item: item[0])
+        self.counters["replays"] += 1
+        self.counters["replayed"] += len(missed)
+        return [message for _, message in missed]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "streams": len(self.streams),
+            "events": sum(len(stream["events"]) for stream in self.streams.values()),
+            "last_event_id": str(self.last_id)
+        }
+
+# Кадры, которые можно выбросить, если клиент не успевает (typing, presence)
+DROPPABLE_FRAME_TYPES = {"typing", "presence_batch"}
+
+# Кадры данных чатов и пользователя - только они попадают в журнал повтора (pong, звонки и typing - нет)
+REPLAY_FRAME_TYPES = {
+    "message", "message_sent", "message_updated", "message_deleted", "message_read",
+    "message_pinned", "message_unpinned", "reaction_update", "poll_updated", "poll_closed",
+    "dialog_updated", "profile_updated", "added_to_contacts",
+    "group_updated", "group_deleted", "group_joined", "group_member_joined", "group_member_left",
+    "group_member_banned", "group_member_unbanned", "group_member_role_updated", "group_ownership_transferred",
+    "channel_updated", "channel_deleted", "channel_subscribed", "channel_new_subscriber", "channel_subscriber_left",
+    "channel_subscriber_banned", "channel_subscriber_unbanned", "channel_subscriber_role_updated",
+    "channel_ownership_transferred",
+    "you_were_banned", "you_were_unbanned", "you_were_banned_from_channel", "you_were_unbanned_from_channel"
+}
+
+# Кадры-снимки состояния: в очереди достаточно последнего кадра для ключа
+COALESCED_FRAME_KEYS = {
+    "reaction_update": "message_id",
+    "message_updated": "message_id",
+    "poll_updated": "poll_id",
+    "profile_updated": "user_id"
+}
+
+# Короткие ключи протокола devnet.msgpack.v1 (клиент разворачивает их по той же таблице)
+WS_SHORT_KEYS = {
+    "type": "t",
+    "timestamp": "ts",
+    "user_id": "u",
+    "users": "us",
+    "chat_type": "ct",
+    "chat_id": "c",
+    "is_typing": "ty",
+    "is_online": "on",
+    "last_seen": "ls",
+    "message": "m",
+    "message_id": "mi",
+    "content": "co",
+    "from_user_id": "f",
+    "to_user_id": "to",
+    "group_id": "g",
+    "channel_id": "ch",
+    "reply_to_id": "rt",
+    "created_at": "ca",
+    "updated_at": "ua",
+    "sender": "sn",
+    "username": "un",
+    "display_name": "dn",
+    "avatar_url": "av",
+    "reactions": "r",
+    "read_by": "rb",
+    "media_url": "mu",
+    "is_edited": "ed",
+    "is_encrypted": "en",
+    "call_id": "cid"
+}
+WS_LONG_KEYS = {short: key for key, short in WS_SHORT_KEYS.items()}
+
+# Поля со временем: в бинарном протоколе передаются как миллисекунды с эпохи (UTC)
+WS_TIMESTAMP_KEYS = {"timestamp", "created_at", "updated_at", "last_seen", "edited_at", "joined_at", "start_time", "end_time"}
+
+def _to_epoch_ms(value: Any) -> Any:
+    """ISO-строка или datetime -> миллисекунды с эпохи; остальное без изменений"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1000)
+    return value
+
+def compact_ws_payload(value: Any) -> Any:
+    """Сжатие кадра для devnet.msgpack.v1: короткие ключи и epoch-время"""
+    if isinstance(value, dict):
+        return {
+            WS_SHORT_KEYS.get(key, key): compact_ws_payload(_to_epoch_ms(item) if key in WS_TIMESTAMP_KEYS else item)
+            for key, item in value.items()
         }
+    if isinstance(value, (list, tuple)):
+        return [compact_ws_payload(item) for item in value]
+    if isinstance(value, datetime):
+        return _to_epoch_ms(value)
+    return value
+
+def expand_ws_payload(value: Any) -> Any:
+    """Разворачивание коротких ключей во входящем кадре devnet.msgpack.v1"""
+    if isinstance(value, dict):
+        return {WS_LONG_KEYS.get(key, key): expand_ws_payload(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [expand_ws_payload(item) for item in value]
+    return value
+
+class OutboundFrame:
+    """Сериализованный WebSocket кадр, общий для всех получателей"""
+    __slots__ = ("text", "size", "droppable", "coalesce_key", "message", "_packed")
+    
+    def __init__(
+        self,
+        text: str,
+        frame_type: Optional[str] = None,
+        coalesce_key: Optional[Tuple[str, Any]] = None,
+        message: Optional[Dict[str, Any]] = None
+    ):
+        self.text = text
+        self.size = len(text)
+        self.droppable = frame_type in DROPPABLE_FRAME_TYPES
+        self.coalesce_key = coalesce_key
+        self.message = message
+        self._packed: Optional[bytes] = None
+    
+    def packed(self) -> bytes:
+        """Бинарное представление (кодируется при первом обращении, общее для всех msgpack клиентов)"""
+        if self._packed is None:
+            self._packed = msgpack.packb(compact_ws_payload(self.message), use_bin_type=True, default=str)
+        return self._packed
+
+def encode_frame(message: Dict[str, Any]) -> OutboundFrame:
+    """Сериализация WebSocket кадра (один раз на рассылку)"""
+    frame_type = message.get("type")
+    coalesce_key = None
+    
+    key_field = COALESCED_FRAME_KEYS.get(frame_type)
+    if key_field and message.get(key_field) is not None:
+        coalesce_key = (frame_type, message[key_field])
+    
+    text = json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+    return OutboundFrame(text, frame_type, coalesce_key, message)
+
+class ClientConnection:
+    """WebSocket соединение с собственной очередью отправки и задачей-писателем"""
+    
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        counters: Optional[Dict[str, int]] = None,
+        max_queue: int = WS_SEND_QUEUE_SIZE,
+        max_bytes: int = WS_SEND_QUEUE_BYTES,
+        binary: bool = False
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.binary = binary
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self.queue: "deque[OutboundFrame]" = deque()
+        self.queued_bytes = 0
+        self.ready = asyncio.Event()
+        self.counters = counters if counters is not None else {}
+        self.writer_task: Optional[asyncio.Task] = None
+        self.closed = False
+        # Пользователи, чей статус клиент показывает на экране
+        self.presence_subscriptions: Set[int] = set()
+        # Активность отслеживаем монотонными тиками без блокировок
+        self.connected_tick = time.monotonic()
+        self.last_activity_tick = self.connected_tick
+    
+    def touch(self):
+        """Отметка активности соединения"""
+        self.last_activity_tick = time.monotonic()
+    
+    def start(self, on_error):
+        """Запуск задачи-писателя"""
+        self.writer_task = asyncio.create_task(self._writer(on_error))
+    
+    def _count(self, name: str):
+        self.counters[name] = self.counters.get(name, 0) + 1
+    
+    def _is_full(self, extra_bytes: int) -> bool:
+        return len(self.queue) >= self.max_queue or self.queued_bytes + extra_bytes > self.max_bytes
+    
+    def _coalesce(self, frame: OutboundFrame) -> bool:
+        """Замена устаревшего кадра с тем же ключом на новый"""
+        for index, queued in enumerate(self.queue):
+            if queued.coalesce_key == frame.coalesce_key:
+                self.queue[index] = frame
+                self.queued_bytes += frame.size - queued.size
+                return True
+        return False
+    
+    def _evict_droppable(self, needed_bytes: int) -> bool:
+        """Выбрасывание droppable кадров из очереди, пока новый кадр не поместится"""
+        kept = deque()
+        queue_len = len(self.queue)
+        
+        for queued in self.queue:
+            over_limit = queue_len >= self.max_queue or self.queued_bytes + needed_bytes > self.max_bytes
+            if queued.droppable and over_limit:
+                queue_len -= 1
+                self.queued_bytes -= queued.size
+                self._count("dropped")
+                continue
+            kept.append(queued)
+        
+        self.queue = kept
+        return not self._is_full(needed_bytes)
+    
+    def clear(self):
+        """Удаление всех еще не отправленных кадров"""
+        self.queue.clear()
+        self.queued_bytes = 0
+    
+    def enqueue(self, frame: OutboundFrame) -> bool:
+        """
+        Постановка готового кадра в очередь без ожидания.
+        Возвращает False, если клиент безнадежно отстал и должен быть отключен.
+        """
+        if self.closed:
+            return True
+        
+        if self._is_full(frame.size):
+            # 1. Typing и presence просто выбрасываем
+            if frame.droppable:
+                self._count("dropped")
+                return True
+            
+            # 2. Снимки состояния схлопываем с уже стоящими в очереди
+            if frame.coalesce_key and self._coalesce(frame):
+                self._count("coalesced")
+                return True
+            
+            # 3. Освобождаем место за счет droppable кадров, иначе - ресинхронизация
+            if not self._evict_droppable(frame.size):
+                self._count("resync_disconnects")
+                return False
+        
+        self.queue.append(frame)
+        self.queued_bytes += frame.size
+        self.ready.set()
+        return True
+    
+    async def _writer(self, on_error):
+        """Последовательная отправка кадров из очереди в сокет"""
+        try:
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                
+                frame = self.queue.popleft()
+                self.queued_bytes -= frame.size
+                if self.binary:
+                    await self.websocket.send_bytes(frame.packed())
+                else:
+                    await self.websocket.send_text(frame.text)
+                self.last_activity_tick = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error sending to user {self.user_id}: {e}")
+            self.closed = True
+            await on_error(self.websocket)
+    
+    async def close(self, code: Optional[int] = None, reason: Optional[str] = None):
+        """Остановка писателя и (опционально) закрытие сокета"""
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        if self.writer_task and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+        if code is not None:
+            try:
+                await self.websocket.close(code=code, reason=reason)
+            except Exception:
+                pass
+
+class TimerWheel:
+    """Хешированное колесо таймеров: установка и отмена за O(1), срабатывание с точностью до тика"""
+    
+    def __init__(self, tick: float, slots: int, on_expire):
+        self.tick = tick
+        self.slots: List[Dict[Any, int]] = [{} for _ in range(slots)]
+        self.position = 0
+        self.timers: Dict[Any, int] = {}  # ключ -> номер слота
+        self.on_expire = on_expire
+        self.task: Optional[asyncio.Task] = None
+    
+    def __len__(self) -> int:
+        return len(self.timers)
+    
+    def schedule(self, key: Any, delay: float):
+        """Установка (или перенос) таймера для ключа"""
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.position + ticks) % len(self.slots)
+        # Число полных оборотов колеса, которые таймер должен пропустить
+        self.slots[slot][key] = (ticks - 1) // len(self.slots)
+        self.timers[key] = slot
+        
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+    
+    def cancel(self, key: Any):
+        """Отмена таймера"""
+        slot = self.timers.pop(key, None)
+        if slot is not None:
+            self.slots[slot].pop(key, None)
+    
+    def advance(self):
+        """Поворот колеса на один тик"""
+        self.position = (self.position + 1) % len(self.slots)
+        bucket = self.slots[self.position]
+        expired = []
+        
+        for key, rounds in list(bucket.items()):
+            if rounds > 0:
+                bucket[key] = rounds - 1
+            else:
+                del bucket[key]
+                del self.timers[key]
+                expired.append(key)
         
-        await self.broadcast_to_chat(chat_type, chat_id, typing_message, exclude_user_id=user_id)
+        for key in expired:
+            try:
+                self.on_expire(key)
+            except Exception as e:
+                logger.error(f"❌ Timer callback error: {e}")
     
-    def get_typing_users(self, chat_type: str, chat_id: int) -> List[int]:
-        """Получение пользователей, которые печатают в чате"""
-        key = (chat_type, chat_id)
+    async def _run(self):
+        while self.timers:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+class ConnectionManager:
+    def __init__(self):
+        self.active_connections: Dict[int, WebSocket] = {}
+        self.user_connections: Dict[int, List[WebSocket]] = {}
+        self.clients: Dict[int, ClientConnection] = {}
+        self.backpressure_counters: Dict[str, int] = {"dropped": 0, "coalesced": 0, "resync_disconnects": 0}
+        self.user_devices: Dict[int, Dict[str, Any]] = {}
+        self.typing_indicators: Dict[Tuple[str, int], Dict[int, datetime]] = {}
+        # Время последней рассылки "печатает" по (user_id, chat_type, chat_id) и таймеры окончания набора
+        self.typing_fanouts: Dict[Tuple[int, str, int], float] = {}
+        self.typing_wheel = TimerWheel(TYPING_WHEEL_TICK, 64, self._on_typing_expired)
+        self.typing_counters: Dict[str, int] = {"events": 0, "fanouts": 0, "throttled": 0, "expired": 0}
+        self.call_rooms: Dict[str, Dict[str, Any]] = {}
+        self.chat_members = ChatMembershipIndex()
+        self.chat_members.on_change = self._on_membership_change
+        self.message_tail = MessageTailCache()
+        self.message_tail.on_change = self._on_tail_change
+        self.replay_log = ReplayLog()
+        # События для сокетов других воркеров идут через backplane
+        self.backplane = create_backplane(BACKPLANE_URL)
+        self.remote_workers: Dict[str, Dict[str, Any]] = {}
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        # Presence: изменения копятся и рассылаются пачками только заинтересованным
+        self.pending_presence: Dict[int, Dict[str, Any]] = {}
+        self.presence_audience: "OrderedDict[int, Tuple[float, Set[int]]]" = OrderedDict()
+        self.presence_watchers: Dict[int, Set[int]] = {}
+        self.presence_task: Optional[asyncio.Task] = None
+        self.presence_counters: Dict[str, int] = {"changes": 0, "batches": 0, "frames": 0}
+        # Изменения списка чатов приходят из хуков коммита, в том числе из потоков пула
+        self.dialog_counters: Dict[str, int] = {"user_frames": 0, "chat_frames": 0}
+        # Пачки изменений списка чатов рассылаются одной задачей по порядку коммитов
+        self.dialog_queue: "deque[Tuple[Dict[Tuple[int, str, int], Dict[str, Any]], Dict[Tuple[str, int], Dict[str, Any]]]]" = deque()
+        self.dialog_task: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Отдельные блокировки для независимых структур; отправка кадров блокировок не берет
+        self.connections_lock = asyncio.Lock()
+        self.calls_lock = asyncio.Lock()
+    
+    async def connect(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        device_id: Optional[str] = None,
+        subprotocol: Optional[str] = None,
+        last_event_id: Optional[str] = None
+    ):
+        """Подключение пользователя к WebSocket"""
+        await websocket.accept(subprotocol=subprotocol)
+        
+        replay_keys = None
+        if last_event_id and self.replay_log.enabled:
+            replay_keys = await asyncio.to_thread(self._replay_keys, user_id)
         
-        # Используем обычный with для доступа к словарю
-        if key in self.typing_indicators:
-            # Удаляем старые записи (старше 10 секунд)
-            current_time = datetime.utcnow()
-            typing_users = []
+        async with self.connections_lock:
+            first_connection = user_id not in self.user_connections
+            if first_connection:
+                self.user_connections[user_id] = []
             
-            for user_id, typing_time in list(self.typing_indicators[key].items()):
-                if (current_time - typing_time).total_seconds() > 10:
-                    del self.typing_indicators[key][user_id]
-                else:
-                    typing_users.append(user_id)
+            self.user_connections[user_id].append(websocket)
+            self.active_connections[id(websocket)] = user_id
             
-            if not self.typing_indicators[key]:
-                del self.typing_indicators[key]
+            client = ClientConnection(
+                websocket,
+                user_id,
+                self.backpressure_counters,
+                binary=subprotocol == WS_MSGPACK_PROTOCOL
+            )
+            self.clients[id(websocket)] = client
+            # Пропущенные события ставим в очередь до любых новых - без await между регистрацией и повтором
+            if replay_keys is not None:
+                self._replay(client, last_event_id, replay_keys)
+            replay_position = str(self.replay_log.last_id)
+            client.start(self.disconnect)
             
-            return typing_users
+            if device_id:
+                if user_id not in self.user_devices:
+                    self.user_devices[user_id] = {}
+                self.user_devices[user_id][device_id] = {
+                    "connected_at": datetime.utcnow(),
+                    "client": client
+                }
         
-        return []
-    
-    async def create_call_room(self, call_id: str, initiator_id: int, chat_type: str, chat_id: int, call_type: str = "audio"):
-        """Создание комнаты для звонка"""
-        async with self.lock:
-            self.call_rooms[call_id] = {
-                "id": call_id,
-                "initiator_id": initiator_id,
-                "chat_type": chat_type,
-                "chat_id": chat_id,
-                "call_type": call_type,
-                "participants": [initiator_id],
-                "start_time": datetime.utcnow(),
-                "status": "waiting",
-                "sdp_offers": {},
-                "ice_candidates": {}
-            }
+        logger.info(f"✅ User {user_id} connected to WebSocket (device: {device_id})")
         
-        logger.info(f"📞 Call room created: {call_id}")
-        return self.call_rooms[call_id]
-    
-    async def join_call_room(self, call_id: str, user_id: int):
-        """Присоединение к комнате звонка"""
-        async with self.lock:
-            if call_id in self.call_rooms:
-                if user_id not in self.call_rooms[call_id]["participants"]:
-                    self.call_rooms[call_id]["participants"].append(user_id)
+        if first_connection:
+            self._publish({"kind": "presence", "user_id": user_id, "online": True})
+        
+        # Обновляем статус пользователя в БД
+        db = SessionLocal()
+        try:
+            user = db.query(User).filter(User.id == user_id).first()
+            if user:
+                user.is_online = True
+                user.last_seen = datetime.utcnow()
+                db.commit()
                 
-                return self.call_rooms[call_id]
+                # Уведомляем других пользователей
+                await self.broadcast_user_status(user_id, True)
+        except Exception as e:
+            logger.error(f"⚠️ Error updating user status: {e}")
+        finally:
+            db.close()
         
-        return None
+        # Отправляем информацию о текущем состоянии
+        await self.send_user_state(user_id, websocket, replay_position if self.replay_log.enabled else None)
     
-    async def leave_call_room(self, call_id: str, user_id: int):
-        """Выход из комнаты звонка"""
-        async with self.lock:
-            if call_id in self.call_rooms:
-                if user_id in self.call_rooms[call_id]["participants"]:
-                    self.call_rooms[call_id]["participants"].remove(user_id)
-                
-                # Удаляем комнату если пустая
-                if not self.call_rooms[call_id]["participants"]:
-                    del self.call_rooms[call_id]
-                    logger.info(f"📞 Call room deleted: {call_id}")
+    def _replay_keys(self, user_id: int) -> List[Tuple[str, Any]]:
+        """Потоки журнала повтора, события которых адресованы пользователю"""
+        db = SessionLocal()
+        try:
+            group_ids = db.query(GroupMember.group_id).filter(
+                GroupMember.user_id == user_id,
+                GroupMember.is_banned == False
+            ).all()
+            channel_ids = db.query(ChannelSubscription.channel_id).filter(
+                ChannelSubscription.user_id == user_id,
+                ChannelSubscription.is_banned == False
+            ).all()
+        finally:
+            db.close()
+        
+        return (
+            [("user", user_id), ("broadcast", None)]
+            + [("group", group_id) for group_id, in group_ids]
+            + [("channel", channel_id) for channel_id, in channel_ids]
+        )
     
-    def get_call_room(self, call_id: str) -> Optional[Dict[str, Any]]:
-        """Получение информации о комнате звонка"""
-        return self.call_rooms.get(call_id)
+    def _replay(self, client: ClientConnection, last_event_id: str, keys: List[Tuple[str, Any]]):
+        """Повтор событий после last_event_id или сигнал полной ресинхронизации"""
+        missed = self.replay_log.since(last_event_id, client.user_id, keys)
+        timestamp = datetime.utcnow().isoformat()
+        resync = encode_frame({"type": "resync_required", "last_event_id": last_event_id, "timestamp": timestamp})
+        
+        if missed is None:
+            client.enqueue(resync)
+            return
+        
+        frames = [encode_frame(message) for message in missed]
+        frames.append(encode_frame({"type": "replay_complete", "count": len(missed), "timestamp": timestamp}))
+        # Пропуск больше очереди соединения: очередь отказала бы части кадров, и клиент
+        # получил бы дыру в истории без replay_complete - вместо этого полная ресинхронизация
+        if len(frames) > client.max_queue or sum(frame.size for frame in frames) > client.max_bytes:
+            self.replay_log.counters["resyncs"] += 1
+            client.enqueue(resync)
+            return
+        
+        for frame in frames:
+            if not client.enqueue(frame):
+                self.replay_log.counters["resyncs"] += 1
+                client.clear()
+                client.enqueue(resync)
+                return
     
-    def get_user_devices(self, user_id: int) -> List[Dict[str, Any]]:
-        """Получение информации об устройствах пользователя"""
-        if user_id in self.user_devices:
-            devices = []
-            for device_id, device_info in self.user_devices[user_id].items():
-                devices.append({
-                    "device_id": device_id,
-                    "connected_at": device_info["connected_at"].isoformat() if isinstance(device_info["connected_at"], datetime) else device_info["connected_at"],
-                    "last_activity": device_info["last_activity"].isoformat() if isinstance(device_info["last_activity"], datetime) else device_info["last_activity"]
-                })
-            return devices
-        return []
+    async def disconnect(self, websocket: WebSocket):
+        """Отключение пользователя от WebSocket"""
+        connection_id = id(websocket)
+        
+        if connection_id in self.active_connections:
+            user_id = self.active_connections[connection_id]
+            last_connection = False
+            
+            async with self.connections_lock:
+                self.active_connections.pop(connection_id, None)
+                client = self.clients.pop(connection_id, None)
+                if client:
+                    self._unwatch_presence(connection_id, client.presence_subscriptions)
+                
+                # Удаляем соединение
+                if user_id in self.user_connections:
+                    if websocket in self.user_connections[user_id]:
+                        self.user_connections[user_id].remove(websocket)
+                    
+                    if not self.user_connections[user_id]:
+                        del self.user_connections[user_id]
+                        last_connection = True
+                        
+                        # Обновляем статус пользователя в БД
+                        asyncio.create_task(self.update_user_offline_status(user_id))
+            
+            if client:
+                await client.close()
+            
+            if last_connection:
+                self._publish({"kind": "presence", "user_id": user_id, "online": False})
+            
+            logger.info(f"📴 User {user_id} disconnected from WebSocket")
     
-    def get_online_users(self) -> List[int]:
-        """Получение списка онлайн пользователей"""
-        return list(self.user_connections.keys())
-
-manager = ConnectionManager()
+    async def update_user_offline_status(self, user_id: int):
+        """Обновление статуса пользователя при отключении"""
+        await asyncio.sleep(5)  # Ждем 5 секунд перед установкой офлайн статуса
         
-# ========== СОЗДАНИЕ FASTAPI ПРИЛОЖЕНИЯ ==========
-
-app = FastAPI(
+        if self.is_user_online(user_id):
+            return  # Пользователь снова подключился (возможно, к другому воркеру)
+        
+        db = SessionLocal()
+        try:
+            user = db.query(User).filter(User.id == user_id).first()
+            if user:
+                user.is_online = False
+                user.last_seen = datetime.utcnow()
+                db.commit()
+                
+                # Уведомляем других пользователей
+                await self.broadcast_user_status(user_id, False)
+        except Exception as e:
+            logger.error(f"⚠️ Error updating user status on disconnect: {e}")
+        finally:
+            db.close()
+    
+    def _enqueue(self, websocket: WebSocket, frame: OutboundFrame) -> bool:
+        """Постановка кадра в очередь соединения"""
+        client = self.clients.get(id(websocket))
+        if not client:
+            return False
+        
+        if not client.enqueue(frame):
+            # Клиент безнадежно отстал - отключаем, он пересинхронизируется при переподключении
+            logger.warning(
+                f"⚠️ Send queue overflow for user {client.user_id} "
+                f"({len(client.queue)} frames, {client.queued_bytes} bytes), closing for resync"
+            )
+            client.closed = True
+            asyncio.create_task(self._drop_client(websocket, client))
+            return False
+        
+        return True
+    
+    async def _drop_client(self, websocket: WebSocket, client: ClientConnection):
+        """Принудительное отключение медленного клиента с кодом ресинхронизации"""
+        await self.disconnect(websocket)
+        await client.close(code=WS_CLOSE_RESYNC, reason="resync")
+    
+    def _fan_out(self, user_ids, frame: OutboundFrame, exclude_connection: Optional[WebSocket] = None):
+        """Раздача готового кадра всем соединениям указанных пользователей"""
+        for user_id in user_ids:
+            for websocket in list(self.user_connections.get(user_id, ())):
+                if websocket is not exclude_connection:
+                    self._enqueue(websocket, frame)
+    
+    def touch(self, websocket: WebSocket):
+        """Отметка входящей активности соединения"""
+        client = self.clients.get(id(websocket))
+        if client:
+            client.touch()
+    
+    def _deliver_to_user(self, user_id: int, message: Dict[str, Any], exclude_connection: Optional[WebSocket] = None):
+        """Доставка пользователю в сокеты этого воркера"""
+        message = self.replay_log.record(("user", user_id), message)
+        if user_id in self.user_connections:
+            self._fan_out((user_id,), encode_frame(message), exclude_connection)
+    
+    def _deliver_broadcast(self, message: Dict[str, Any], exclude_user_id: Optional[int] = None):
+        """Доставка всем пользователям этого воркера"""
+        message = self.replay_log.record(("broadcast", None), message, exclude_user_id)
+        user_ids = [user_id for user_id in list(self.user_connections) if user_id != exclude_user_id]
+        if user_ids:
+            self._fan_out(user_ids, encode_frame(message))
+    
+    def _deliver_to_chat(self, chat_type: str, chat_id: int, message: Dict[str, Any], exclude_user_id: Optional[int] = None):
+        """Доставка участникам чата, подключенным к этому воркеру"""
+        # Журнал повтора пишем и для отключенных участников
+        if chat_type == "private":
+            message = self.replay_log.record(("user", chat_id), message)
+        else:
+            message = self.replay_log.record((chat_type, chat_id), message, exclude_user_id)
+        
+        if not self.user_connections:
+            return
+        
+        def fan_out(user_ids: Set[int]):
+            # Отправляем только подключенным участникам, кадр кодируем один раз
+            recipients = [
+                user_id for user_id in user_ids
+                if user_id != exclude_user_id and user_id in self.user_connections
+            ]
+            if recipients:
+                self._fan_out(recipients, encode_frame(message))
+        
+        if chat_type == "private":
+            fan_out({chat_id})
+        else:
+            # При промахе индекса кадр ждет загрузки участников в пуле потоков, не останавливая цикл событий
+            self.chat_members.with_members(chat_type, chat_id, fan_out)
+    
+    async def send_to_user(self, user_id: int, message: Dict[str, Any], exclude_connection: Optional[WebSocket] = None):
+        """Отправка сообщения конкретному пользователю (кроме exclude_connection этого воркера)"""
+        message = self.replay_log.stamp(message)
+        self._deliver_to_user(user_id, message, exclude_connection)
+        if self._should_publish_to_user(user_id, message):
+            self._publish({"kind": "user", "user_id": user_id, "message": message})
+    
+    async def send_to_connection(self, websocket: WebSocket, message: Dict[str, Any]):
+        """Отправка сообщения в конкретное соединение"""
+        self._enqueue(websocket, encode_frame(message))
+    
+    async def broadcast(self, message: Dict[str, Any], exclude_user_id: Optional[int] = None):
+        """Широковещательная рассылка всем пользователям"""
+        message = self.replay_log.stamp(message)
+        self._deliver_broadcast(message, exclude_user_id)
+        if self.remote_workers:
+            self._publish({"kind": "broadcast", "message": message, "exclude_user_id": exclude_user_id})
+    
+    async def broadcast_to_chat(self, chat_type: str, chat_id: int, message: Dict[str, Any], exclude_user_id: Optional[int] = None):
+        """Отправка сообщения всем участникам чата"""
+        message = self.replay_log.stamp(message)
+        try:
+            self._deliver_to_chat(chat_type, chat_id, message, exclude_user_id)
+        except Exception as e:
+            logger.error(f"❌ Error broadcasting to chat: {e}")
+        
+        if chat_type == "private":
+            if self._should_publish_to_user(chat_id, message):
+                self._publish({"kind": "user", "user_id": chat_id, "message": message})
+        elif self.remote_workers:
+            self._publish({
+                "kind": "chat",
+                "chat_type": chat_type,
+                "chat_id": chat_id,
+                "message": message,
+                "exclude_user_id": exclude_user_id
+            })
+    
+    async def broadcast_user_status(self, user_id: int, is_online: bool):
+        """Уведомление о изменении статуса пользователя (уходит в ближайший presence_batch)"""
+        self._queue_presence(user_id, is_online, datetime.utcnow().isoformat())
+        if self.remote_workers:
+            self._publish({"kind": "user_status", "user_id": user_id, "is_online": is_online})
+    
+    # ---------- Список чатов ----------
+    
+    def queue_dialog_updates(self, updates: Dict[Tuple[int, str, int], Dict[str, Any]], chat_updates: Dict[Tuple[str, int], Dict[str, Any]]):
+        """Изменения списка чатов после коммита; из потока пула передаются в цикл событий воркера"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self._enqueue_dialog_updates, updates, chat_updates)
+            return
+        self._enqueue_dialog_updates(updates, chat_updates)
+    
+    def _enqueue_dialog_updates(self, updates: Dict[Tuple[int, str, int], Dict[str, Any]], chat_updates: Dict[Tuple[str, int], Dict[str, Any]]):
+        self.dialog_queue.append((updates, chat_updates))
+        task = self.dialog_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self.dialog_task = asyncio.create_task(self._drain_dialog_updates())
+    
+    async def _drain_dialog_updates(self):
+        while self.dialog_queue:
+            await self.send_dialog_updates(*self.dialog_queue.popleft())
+    
+    async def send_dialog_updates(self, updates: Dict[Tuple[int, str, int], Dict[str, Any]], chat_updates: Dict[Tuple[str, int], Dict[str, Any]]):
+        """Кадры dialog_updated: только измененные поля элемента списка, новый элемент - целиком"""
+        try:
+            timestamp = datetime.utcnow().isoformat()
+            added = [key for key, changes in updates.items() if changes.get("added")]
+            # Новые элементы читаются из БД в пуле потоков
+            entries = await asyncio.to_thread(load_dialog_entries, added) if added else {}
+            
+            for key, changes in updates.items():
+                user_id, chat_type, chat_id = key
+                frame = {"type": "dialog_updated", "chat_type": chat_type, "chat_id": chat_id, "timestamp": timestamp}
+                if changes.get("removed"):
+                    frame["removed"] = True
+                elif changes.get("added"):
+                    if key not in entries:
+                        continue
+                    frame["added"] = True
+                    frame["changes"] = entries[key]
+                else:
+                    frame["changes"] = changes
+                
+                frame = self.replay_log.stamp(frame)
+                self._deliver_to_user(user_id, frame)
+                if self._should_publish_to_user(user_id, frame):
+                    self._publish({"kind": "user", "user_id": user_id, "message": frame})
+                self.dialog_counters["user_frames"] += 1
+            
+            for (chat_type, chat_id), changes in chat_updates.items():
+                frame = {"type": "dialog_updated", "chat_type": chat_type, "chat_id": chat_id, "timestamp": timestamp}
+                if changes.get("removed"):
+                    frame["removed"] = True
+                else:
+                    frame["changes"] = changes
+                
+                frame = self.replay_log.stamp(frame)
+                self._deliver_to_chat(chat_type, chat_id, frame)
+                if self.remote_workers:
+                    self._publish({"kind": "chat", "chat_type": chat_type, "chat_id": chat_id, "message": frame})
+                self.dialog_counters["chat_frames"] += 1
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки изменений списка чатов: {e}")
+    
+    # ---------- Presence ----------
+    
+    def _queue_presence(self, user_id: int, is_online: bool, last_seen: Optional[str]):
+        """Постановка изменения статуса в очередь; повторные изменения схлопываются"""
+        self.pending_presence[user_id] = {"user_id": user_id, "is_online": is_online, "last_seen": last_seen}
+        self.presence_counters["changes"] += 1
+        
+        if self.presence_task is None or self.presence_task.done():
+            self.presence_task = asyncio.create_task(self._presence_loop())
+    
+    async def _presence_loop(self):
+        while True:
+            await asyncio.sleep(PRESENCE_BATCH_INTERVAL)
+            try:
+                await self.flush_presence()
+            except Exception as e:
+                logger.error(f"❌ Presence batch error: {e}")
+    
+    async def flush_presence(self):
+        """Рассылка накопленных изменений статуса кадрами presence_batch"""
+        updates = self.pending_presence
+        if not updates:
+            return
+        self.pending_presence = {}
+        
+        audiences = await self._get_presence_audiences(list(updates)) if self.user_connections else {}
+        
+        # Собираем изменения для каждого соединения: собеседники + явные подписчики из той же аудитории
+        per_connection: Dict[int, List[Dict[str, Any]]] = {}
+        for subject_id, update in updates.items():
+            audience = audiences.get(subject_id, ())
+            targets = {
+                connection_id for connection_id in self.presence_watchers.get(subject_id, ())
+                if connection_id in self.clients and self.clients[connection_id].user_id in audience
+            }
+            for user_id in audience:
+                for websocket in self.user_connections.get(user_id, ()):
+                    targets.add(id(websocket))
+            
+            for connection_id in targets:
+                per_connection.setdefault(connection_id, []).append(update)
+        
+        # Одинаковые наборы изменений кодируем один раз
+        frames: Dict[Tuple[int, ...], OutboundFrame] = {}
+        timestamp = datetime.utcnow().isoformat()
+        for connection_id, batch in per_connection.items():
+            client = self.clients.get(connection_id)
+            if not client:
+                continue
+            
+            key = tuple(update["user_id"] for update in batch)
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = encode_frame({"type": "presence_batch", "users": batch, "timestamp": timestamp})
+            
+            self._enqueue(client.websocket, frame)
+            self.presence_counters["frames"] += 1
+        
+        self.presence_counters["batches"] += 1
+    
+    async def _get_presence_audiences(self, subject_ids: List[int]) -> Dict[int, Set[int]]:
+        """Кому интересен статус пользователей (с кэшем на PRESENCE_AUDIENCE_TTL)"""
+        now = time.monotonic()
+        audiences: Dict[int, Set[int]] = {}
+        missing = []
+        
+        for subject_id in subject_ids:
+            cached = self.presence_audience.get(subject_id)
+            if cached and now - cached[0] < PRESENCE_AUDIENCE_TTL:
+                self.presence_audience.move_to_end(subject_id)
+                audiences[subject_id] = cached[1]
+            else:
+                missing.append(subject_id)
+        
+        if missing:
+            # Запросы к БД - в пуле потоков, чтобы волна переподключений не останавливала цикл событий
+            relations = await asyncio.to_thread(self._load_presence_relations, missing)
+            
+            # Участники групп - из индекса, незагруженные группы одним запросом в пуле потоков
+            group_ids = set().union(*(relation["groups"] for relation in relations.values()))
+            group_members = {group_id: self.chat_members.peek("group", group_id) for group_id in group_ids}
+            unknown = [group_id for group_id, members in group_members.items() if members is None]
+            if unknown:
+                group_members.update(await asyncio.to_thread(self._load_group_members, unknown))
+            
+            now = time.monotonic()
+            for subject_id, relation in relations.items():
+                audience = set(relation["users"])
+                for group_id in relation["groups"]:
+                    audience.update(group_members.get(group_id) or ())
+                audience.discard(subject_id)
+                audience.difference_update(relation["blocked"])
+                # privacy.online_status == "contacts": статус видят только контакты пользователя
+                if relation["contacts_only"]:
+                    audience.intersection_update(relation["contacts"])
+                
+                audiences[subject_id] = audience
+                self.presence_audience[subject_id] = (now, audience)
+                self.presence_audience.move_to_end(subject_id)
+            
+            while len(self.presence_audience) > PRESENCE_AUDIENCE_CACHE_SIZE:
+                self.presence_audience.popitem(last=False)
+        
+        return audiences
+    
+    @staticmethod
+    def _load_presence_relations(subject_ids: List[int]) -> Dict[int, Dict[str, Set[int]]]:
+        """
+        Контакты, собеседники по личным чатам, заблокированные, группы и настройка приватности статуса
+        пользователей (выполняется в пуле потоков)
+        """
+        subjects = set(subject_ids)
+        relations = {
+            subject_id: {"users": set(), "blocked": set(), "groups": set(), "contacts": set(), "contacts_only": False}
+            for subject_id in subject_ids
+        }
+        
+        db = SessionLocal()
+        try:
+            for start in range(0, len(subject_ids), 500):
+                chunk = subject_ids[start:start + 500]
+                
+                contacts = db.query(Contact.user_id, Contact.contact_id, Contact.is_blocked).filter(
+                    or_(Contact.user_id.in_(chunk), Contact.contact_id.in_(chunk))
+                ).all()
+                for owner_id, contact_id, is_blocked in contacts:
+                    if owner_id in subjects:
+                        relations[owner_id]["blocked" if is_blocked else "users"].add(contact_id)
+                        if not is_blocked:
+                            relations[owner_id]["contacts"].add(contact_id)
+                    if contact_id in subjects and not is_blocked:
+                        relations[contact_id]["users"].add(owner_id)
+                
+                # Собеседники - строки списка чатов пользователя (индекс по user_id), а не поиск по messages
+                partners = db.query(DialogSummary.user_id, DialogSummary.chat_id).filter(
+                    DialogSummary.user_id.in_(chunk),
+                    DialogSummary.chat_type == "private"
+                ).all()
+                for user_id, partner_id in partners:
+                    relations[user_id]["users"].add(partner_id)
+                
+                memberships = db.query(GroupMember.user_id, GroupMember.group_id).filter(
+                    GroupMember.user_id.in_(chunk),
+                    GroupMember.is_banned == False
+                ).all()
+                for user_id, group_id in memberships:
+                    relations[user_id]["groups"].add(group_id)
+                
+                for user_id, settings in db.query(User.id, User.settings).filter(User.id.in_(chunk)).all():
+                    privacy = (settings or {}).get("privacy") if isinstance(settings, dict) else None
+                    if isinstance(privacy, dict) and privacy.get("online_status") == "contacts":
+                        relations[user_id]["contacts_only"] = True
+        finally:
+            db.close()
+        
+        return relations
+    
+    @staticmethod
+    def _load_group_members(group_ids: List[int]) -> Dict[int, Set[int]]:
+        """Участники групп, которых нет в индексе (выполняется в пуле потоков)"""
+        members: Dict[int, Set[int]] = {group_id: set() for group_id in group_ids}
+        db = SessionLocal()
+        try:
+            rows = _query_in_chunks(
+                db.query(GroupMember.group_id, GroupMember.user_id).filter(GroupMember.is_banned == False),
+                GroupMember.group_id,
+                group_ids
+            )
+            for group_id, user_id in rows:
+                if user_id is not None:
+                    members[group_id].add(user_id)
+        finally:
+            db.close()
+        return members
+    
+    def _unwatch_presence(self, connection_id: int, user_ids):
+        for user_id in user_ids:
+            watchers = self.presence_watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(connection_id)
+                if not watchers:
+                    del self.presence_watchers[user_id]
+    
+    @staticmethod
+    def _load_last_seen(user_ids: List[int]) -> List[Tuple[int, Optional[datetime]]]:
+        """Время последнего визита пользователей (выполняется в пуле потоков)"""
+        db = SessionLocal()
+        try:
+            return [tuple(row) for row in _query_in_chunks(db.query(User.id, User.last_seen), User.id, user_ids)]
+        finally:
+            db.close()
+    
+    async def subscribe_presence(self, websocket: WebSocket, user_ids: List[Any]):
+        """
+        Подписка соединения на статусы пользователей, видимых на экране (заменяет прежнюю).
+        Подписаться можно только на тех, чей статус пользователь и так получает: контакты,
+        собеседники и участники общих групп с учетом блокировок и приватности статуса.
+        """
+        client = self.clients.get(id(websocket))
+        if not client:
+            return
+        
+        connection_id = id(websocket)
+        requested = {user_id for user_id in user_ids if isinstance(user_id, int) and user_id != client.user_id}
+        if len(requested) > PRESENCE_SUBSCRIPTION_LIMIT:
+            requested = set(sorted(requested)[:PRESENCE_SUBSCRIPTION_LIMIT])
+        if requested:
+            audiences = await self._get_presence_audiences(list(requested))
+            requested = {user_id for user_id in requested if client.user_id in audiences.get(user_id, ())}
+            # Соединение могло закрыться, пока загружалась аудитория
+            if self.clients.get(connection_id) is not client:
+                return
+        
+        added = requested - client.presence_subscriptions
+        self._unwatch_presence(connection_id, client.presence_subscriptions - requested)
+        for user_id in added:
+            self.presence_watchers.setdefault(user_id, set()).add(connection_id)
+        client.presence_subscriptions = requested
+        
+        if not added:
+            return
+        
+        # Сразу отправляем текущее состояние новых подписок
+        rows = await asyncio.to_thread(self._load_last_seen, list(added))
+        
+        await self.send_to_connection(websocket, {
+            "type": "presence_batch",
+            "users": [
+                {
+                    "user_id": user_id,
+                    "is_online": self.is_user_online(user_id),
+                    "last_seen": last_seen.isoformat() if last_seen else None
+                }
+                for user_id, last_seen in rows
+            ],
+            "timestamp": datetime.utcnow().isoformat()
+        })
+    
+    async def send_user_state(self, user_id: int, websocket: WebSocket, last_event_id: Optional[str] = None):
+        """Отправка текущего состояния пользователю (last_event_id - позиция журнала повтора на момент подключения)"""
+        db = SessionLocal()
+        try:
+            # Получаем непрочитанные уведомления
+            notifications = db.query(Notification).filter(
+                Notification.user_id == user_id,
+                Notification.is_read == False
+            ).order_by(desc(Notification.created_at)).limit(50).all()
+            
+            # Получаем активные чаты
+            user = db.query(User).filter(User.id == user_id).first()
+            if user:
+                # Отправляем информацию о пользователе
+                await self.send_to_connection(websocket, {
+                    "type": "user_state",
+                    "user": {
+                        "id": user.id,
+                        "username": user.username,
+                        "display_name": user.display_name,
+                        "avatar_url": user.avatar_url,
+                        "status": user.status,
+                        "status_message": user.status_message,
+                        "is_online": user.is_online,
+                        "settings": user.settings
+                    },
+                    "notifications": [
+                        {
+                            "id": n.id,
+                            "type": n.type,
+                            "title": n.title,
+                            "message": n.message,
+                            "data": n.data,
+                            "is_read": n.is_read,
+                            "created_at": n.created_at.isoformat() if n.created_at else None
+                        }
+                        for n in notifications
+                    ],
+                    "last_event_id": last_event_id,
+                    "timestamp": datetime.utcnow().isoformat()
+                })
+                
+        except Exception as e:
+            logger.error(f"❌ Error sending user state: {e}")
+        finally:
+            db.close()
+    
+    def refresh_typing(self, user_id: int, chat_type: str, chat_id: int) -> bool:
+        """
+        Продление набора текста без рассылки.
+        Возвращает True, если пользователь уже печатает и рассылка была недавно.
+        """
+        timer_key = (user_id, chat_type, chat_id)
+        self.typing_counters["events"] += 1
+        
+        last_fanout = self.typing_fanouts.get(timer_key)
+        if last_fanout is None or time.monotonic() - last_fanout >= TYPING_THROTTLE_SECONDS:
+            return False
+        
+        self.typing_indicators[(chat_type, chat_id)][user_id] = datetime.utcnow()
+        self.typing_wheel.schedule(timer_key, TYPING_TIMEOUT_SECONDS)
+        self.typing_counters["throttled"] += 1
+        return True
+    
+    def _clear_typing(self, user_id: int, chat_type: str, chat_id: int) -> bool:
+        """Сброс состояния набора; True, если пользователь печатал"""
+        key = (chat_type, chat_id)
+        self.typing_fanouts.pop((user_id, chat_type, chat_id), None)
+        
+        typists = self.typing_indicators.get(key)
+        if not typists or user_id not in typists:
+            return False
+        
+        del typists[user_id]
+        if not typists:
+            del self.typing_indicators[key]
+        return True
+    
+    def _on_typing_expired(self, timer_key: Tuple[int, str, int]):
+        """Клиент перестал присылать события набора - сами сообщаем, что он больше не печатает"""
+        user_id, chat_type, chat_id = timer_key
+        if self._clear_typing(user_id, chat_type, chat_id):
+            self.typing_counters["expired"] += 1
+            asyncio.create_task(self._broadcast_typing(user_id, chat_type, chat_id, False))
+    
+    async def _broadcast_typing(self, user_id: int, chat_type: str, chat_id: int, is_typing: bool):
+        typing_message = {
+            "type": "typing",
+            "chat_type": chat_type,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "is_typing": is_typing,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        
+        self.typing_counters["fanouts"] += 1
+        await self.broadcast_to_chat(chat_type, chat_id, typing_message, exclude_user_id=user_id)
+    
+    async def update_typing_indicator(self, user_id: int, chat_type: str, chat_id: int, is_typing: bool):
+        """Обновление индикатора набора текста"""
+        key = (chat_type, chat_id)
+        timer_key = (user_id, chat_type, chat_id)
+        
+        if is_typing:
+            if key not in self.typing_indicators:
+                self.typing_indicators[key] = {}
+            self.typing_indicators[key][user_id] = datetime.utcnow()
+            self.typing_fanouts[timer_key] = time.monotonic()
+            self.typing_wheel.schedule(timer_key, TYPING_TIMEOUT_SECONDS)
+        else:
+            self.typing_wheel.cancel(timer_key)
+            if not self._clear_typing(user_id, chat_type, chat_id):
+                return  # Пользователь и не печатал - рассылать нечего
+        
+        # Отправляем уведомление другим участникам
+        await self._broadcast_typing(user_id, chat_type, chat_id, is_typing)
+    
+    def get_typing_users(self, chat_type: str, chat_id: int) -> List[int]:
+        """Получение пользователей, которые печатают в чате (устаревшие записи снимает колесо таймеров)"""
+        return list(self.typing_indicators.get((chat_type, chat_id), ()))
+    
+    async def create_call_room(self, call_id: str, initiator_id: int, chat_type: str, chat_id: int, call_type: str = "audio"):
+        """Создание комнаты для звонка"""
+        async with self.calls_lock:
+            self.call_rooms[call_id] = {
+                "id": call_id,
+                "initiator_id": initiator_id,
+                "chat_type": chat_type,
+                "chat_id": chat_id,
+                "call_type": call_type,
+                "participants": [initiator_id],
+                "start_time": datetime.utcnow(),
+                "status": "waiting",
+                "sdp_offers": {},
+                "ice_candidates": {}
+            }
+        
+        logger.info(f"📞 Call room created: {call_id}")
+        return self.call_rooms[call_id]
+    
+    async def join_call_room(self, call_id: str, user_id: int):
+        """Присоединение к комнате звонка"""
+        async with self.calls_lock:
+            if call_id in self.call_rooms:
+                if user_id not in self.call_rooms[call_id]["participants"]:
+                    self.call_rooms[call_id]["participants"].append(user_id)
+                
+                return self.call_rooms[call_id]
+        
+        return None
+    
+    async def leave_call_room(self, call_id: str, user_id: int):
+        """Выход из комнаты звонка"""
+        async with self.calls_lock:
+            if call_id in self.call_rooms:
+                if user_id in self.call_rooms[call_id]["participants"]:
+                    self.call_rooms[call_id]["participants"].remove(user_id)
+                
+                # Удаляем комнату если пустая
+                if not self.call_rooms[call_id]["participants"]:
+                    del self.call_rooms[call_id]
+                    logger.info(f"📞 Call room deleted: {call_id}")
+    
+    def get_call_room(self, call_id: str) -> Optional[Dict[str, Any]]:
+        """Получение информации о комнате звонка"""
+        return self.call_rooms.get(call_id)
+    
+    def get_user_devices(self, user_id: int) -> List[Dict[str, Any]]:
+        """Получение информации об устройствах пользователя"""
+        if user_id in self.user_devices:
+            devices = []
+            for device_id, device_info in self.user_devices[user_id].items():
+                connected_at = device_info["connected_at"]
+                client = device_info.get("client")
+                
+                # Переводим монотонный тик активности в календарное время только при чтении
+                last_activity = connected_at
+                if client:
+                    last_activity = connected_at + timedelta(seconds=client.last_activity_tick - client.connected_tick)
+                
+                devices.append({
+                    "device_id": device_id,
+                    "connected_at": connected_at.isoformat(),
+                    "last_activity": last_activity.isoformat()
+                })
+            return devices
+        return []
+    
+    def get_online_users(self) -> List[int]:
+        """Получение списка онлайн пользователей (со всех воркеров)"""
+        online = set(self.user_connections)
+        for worker in self.remote_workers.values():
+            online.update(worker["users"])
+        return list(online)
+    
+    def is_user_online(self, user_id: int) -> bool:
+        """Подключен ли пользователь к этому или другому воркеру"""
+        return user_id in self.user_connections or self._is_remote_online(user_id)
+    
+    def _is_remote_online(self, user_id: int) -> bool:
+        return any(user_id in worker["users"] for worker in self.remote_workers.values())
+    
+    def _should_publish_to_user(self, user_id: int, message: Dict[str, Any]) -> bool:
+        """С журналом повтора кадры данных нужны и воркеру, к которому пользователь переподключится"""
+        if self._is_remote_online(user_id):
+            return True
+        return "event_id" in message and bool(self.remote_workers)
+    
+    # ---------- Backplane ----------
+    
+    def _publish(self, event: Dict[str, Any]):
+        """Публикация события для других воркеров"""
+        if self.backplane.distributed:
+            self.backplane.publish(event)
+    
+    def _on_tail_change(self, key: Tuple[str, Any]):
+        """Другие воркеры сбрасывают свою копию хвоста измененного чата"""
+        if self.backplane.distributed:
+            self._publish({"kind": "tail", "chat_type": key[0], "chat_id": key[1]})
+    
+    def _on_membership_change(self, op: str, chat_type: str, chat_id: int, user_id: Optional[int]):
+        """Рассылка изменений индекса участников другим воркерам"""
+        if self.backplane.distributed:
+            self._publish({
+                "kind": "membership",
+                "op": op,
+                "chat_type": chat_type,
+                "chat_id": chat_id,
+                "user_id": user_id
+            })
+    
+    def _remote_worker(self, worker_id: str) -> Dict[str, Any]:
+        worker = self.remote_workers.get(worker_id)
+        if worker is None:
+            worker = self.remote_workers[worker_id] = {"users": {}, "seen": time.monotonic()}
+        return worker
+    
+    def handle_backplane_event(self, event: Dict[str, Any]):
+        """Обработка события, опубликованного другим воркером"""
+        kind = event.get("kind")
+        origin = event.get("origin")
+        now = time.monotonic()
+        
+        if kind == "user":
+            self._deliver_to_user(event["user_id"], event["message"])
+        elif kind == "chat":
+            self._deliver_to_chat(event["chat_type"], event["chat_id"], event["message"], event.get("exclude_user_id"))
+        elif kind == "broadcast":
+            self._deliver_broadcast(event["message"], event.get("exclude_user_id"))
+        elif kind == "user_status":
+            self._queue_presence(event["user_id"], event["is_online"], datetime.utcnow().isoformat())
+        elif kind == "membership":
+            self.chat_members.apply(event["op"], event["chat_type"], event["chat_id"], event.get("user_id"))
+        elif kind == "tail":
+            self.message_tail.invalidate((event["chat_type"], event["chat_id"]), propagate=False)
+        elif kind == "presence":
+            worker = self._remote_worker(origin)
+            worker["seen"] = now
+            if event.get("online"):
+                worker["users"][event["user_id"]] = now
+            else:
+                worker["users"].pop(event["user_id"], None)
+        elif kind == "heartbeat":
+            worker = self._remote_worker(origin)
+            worker["seen"] = now
+            for user_id in event.get("users", ()):
+                worker["users"][user_id] = now
+        elif kind == "hello":
+            # Новый воркер: сразу сообщаем ему своих пользователей
+            self._remote_worker(origin)
+            self._publish_heartbeat()
+        elif kind == "bye":
+            self.remote_workers.pop(origin, None)
+    
+    def _publish_heartbeat(self):
+        """Публикация списка локальных пользователей (частями, чтобы уложиться в размер события)"""
+        user_ids = list(self.user_connections)
+        for start in range(0, len(user_ids), 5000):
+            self._publish({"kind": "heartbeat", "users": user_ids[start:start + 5000]})
+        if not user_ids:
+            self._publish({"kind": "heartbeat", "users": []})
+    
+    def _expire_remote_users(self):
+        """Удаление воркеров и пользователей, о которых давно не было вестей"""
+        deadline = time.monotonic() - BACKPLANE_HEARTBEAT_SECONDS * 3
+        for worker_id, worker in list(self.remote_workers.items()):
+            if worker["seen"] < deadline:
+                del self.remote_workers[worker_id]
+                continue
+            for user_id, seen in list(worker["users"].items()):
+                if seen < deadline:
+                    del worker["users"][user_id]
+    
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(BACKPLANE_HEARTBEAT_SECONDS)
+            try:
+                self._publish_heartbeat()
+                self._expire_remote_users()
+            except Exception as e:
+                logger.error(f"❌ Backplane heartbeat error: {e}")
+    
+    async def start_backplane(self):
+        """Запуск backplane при старте воркера"""
+        self.loop = asyncio.get_running_loop()
+        await self.backplane.start(self.handle_backplane_event)
+        if self.backplane.distributed:
+            self._publish({"kind": "hello"})
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+    
+    async def stop_backplane(self):
+        """Остановка backplane при завершении воркера"""
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        self._publish({"kind": "bye"})
+        await self.backplane.stop()
+        # После остановки цикла событий коммиты из потоков больше не передают в него изменения
+        self.loop = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика менеджера соединений"""
+        return {
+            "online_users": len(self.user_connections),
+            "connections": sum(len(websockets) for websockets in self.user_connections.values()),
+            "msgpack_connections": sum(1 for client in self.clients.values() if client.binary),
+            "membership_index": self.chat_members.get_stats(),
+            "message_tail": self.message_tail.get_stats(),
+            "replay_log": self.replay_log.get_stats(),
+            "typing": {
+                **self.typing_counters,
+                "active": len(self.typing_wheel)
+            },
+            "dialog_updates": self.dialog_counters,
+            "presence": {
+                **self.presence_counters,
+                "pending": len(self.pending_presence),
+                "watched_users": len(self.presence_watchers),
+                "audience_cache": len(self.presence_audience)
+            },
+            "backplane": {
+                **self.backplane.get_stats(),
+                "remote_workers": len(self.remote_workers),
+                "remote_online_users": sum(len(worker["users"]) for worker in self.remote_workers.values())
+            },
+            "backpressure": {
+                **self.backpressure_counters,
+                "queue_limit": WS_SEND_QUEUE_SIZE,
+                "queue_bytes_limit": WS_SEND_QUEUE_BYTES,
+                "queued_frames": sum(len(client.queue) for client in self.clients.values()),
+                "queued_bytes": sum(client.queued_bytes for client in self.clients.values())
+            }
+        }
+
+manager = ConnectionManager()
+        
+# ========== СОЗДАНИЕ FASTAPI ПРИЛОЖЕНИЯ ==========
+
+def _json_default(value: Any) -> Any:
+    """Типы, которые JSON-кодировщик не знает сам"""
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, (datetime, date)):
+        # Как orjson: ISO 8601 с "T", а не str() с пробелом
+        return value.isoformat()
+    return str(value)
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON-ответ через orjson (datetime, UUID и ключи-числа кодируются нативно).
+    Горячие эндпоинты возвращают его напрямую, минуя jsonable_encoder.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(
+    default_response_class=FastJSONResponse,
     title="DevNet Messenger API",
     description="Full-featured messenger for developers with real-time communication, file sharing, and more",
     version="3.0.0",
@@ -1612,6 +4485,40 @@ app.add_middleware(
     max_age=600
 )
 
+@app.on_event("startup")
+async def startup_backplane():
+    """Подключение воркера к backplane"""
+    await manager.start_backplane()
+
+async def unread_reconcile_loop():
+    """Периодическая сверка счетчиков непрочитанных (в отдельном потоке, чтобы не держать цикл событий)"""
+    while True:
+        await asyncio.sleep(UNREAD_RECONCILE_INTERVAL)
+        try:
+            started = time.perf_counter()
+            corrected = await asyncio.to_thread(reconcile_unread_counts)
+            if corrected:
+                logger.warning(f"🧮 Reconciled {corrected} unread counters in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"❌ Unread reconcile error: {e}")
+
+@app.on_event("startup")
+async def startup_unread_reconcile():
+    """Запуск сверки счетчиков непрочитанных"""
+    if UNREAD_RECONCILE_INTERVAL > 0:
+        app.state.unread_reconcile_task = asyncio.create_task(unread_reconcile_loop())
+
+@app.on_event("shutdown")
+async def shutdown_unread_reconcile():
+    task = getattr(app.state, "unread_reconcile_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("shutdown")
+async def shutdown_backplane():
+    """Отключение воркера от backplane"""
+    await manager.stop_backplane()
+
 # Создаем директории для загрузок
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
@@ -1767,7 +4674,8 @@ async def api_health_check(db: Session = Depends(get_db)):
                 "messages": messages_count,
                 "groups": groups_count,
                 "channels": channels_count,
-                "online_users": len(manager.get_online_users())
+                "online_users": len(manager.get_online_users()),
+                "realtime": manager.get_stats()
             },
             "system": system_info
         }
@@ -2505,18 +5413,16 @@ async def get_users(
                 "created_at": user_item.created_at.isoformat() if user_item.created_at else None
             })
         
-         return {
-        "success": True,
-        "private_chats": private_chats,  # Изменено с "chats" на "private_chats"
-        "group_chats": group_chats,      # Добавлено
-        "channel_chats": channel_chats,  # Добавлено
-        "count": len(all_chats),
-        "stats": {
-            "private": len(private_chats),
-            "groups": len(group_chats),
-            "channels": len(channel_chats)
+        return {
+            "success": True,
+            "users": users_data,
+            "pagination": {
+                "page": page,
+                "limit": limit,
+                "total": total,
+                "pages": (total + limit - 1) // limit
+            }
         }
-    }
         
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки пользователей: {str(e)}")
@@ -2579,11 +5485,8 @@ async def get_user_by_id(
         
         # Проверяем, есть ли общие чаты
         common_chats = False
-        common_messages = db.query(Message).filter(
-            or_(
-                and_(Message.from_user_id == user.id, Message.to_user_id == user_id),
-                and_(Message.from_user_id == user_id, Message.to_user_id == user.id)
-            )
+        common_messages = db.query(Message.id).filter(
+            Message.dialog_key == make_dialog_key(user.id, user_id)
         ).first()
         
         if common_messages:
@@ -2836,526 +5739,1399 @@ async def block_user(
             contact.is_blocked = True
             contact.updated_at = datetime.utcnow()
         else:
-            contact = Contact(
-                user_id=user.id,
-                contact_id=user_id,
-                name=target_user.display_name or target_user.username,
-                is_blocked=True
-            )
-            db.add(contact)
+            contact = Contact(
+                user_id=user.id,
+                contact_id=user_id,
+                name=target_user.display_name or target_user.username,
+                is_blocked=True
+            )
+            db.add(contact)
+        
+        db.commit()
+        
+        return {
+            "success": True,
+            "message": f"Пользователь {target_user.username} заблокирован"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Ошибка блокировки пользователя: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка блокировки пользователя: {str(e)}"
+        )
+
+@app.post("/api/users/{user_id}/unblock")
+async def unblock_user(
+    user_id: int,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Разблокировка пользователя"""
+    try:
+        contact = db.query(Contact).filter(
+            Contact.user_id == user.id,
+            Contact.contact_id == user_id,
+            Contact.is_blocked == True
+        ).first()
+        
+        if not contact:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Пользователь не найден в заблокированных"
+            )
+        
+        contact.is_blocked = False
+        contact.updated_at = datetime.utcnow()
+        db.commit()
+        
+        target_user = db.query(User).filter(User.id == user_id).first()
+        
+        return {
+            "success": True,
+            "message": f"Пользователь {target_user.username if target_user else 'unknown'} разблокирован"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Ошибка разблокировки пользователя: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка разблокировки пользователя: {str(e)}"
+        )
+
+# ========== СООБЩЕНИЯ ==========
+
+def _query_in_chunks(query, column, ids) -> List[Any]:
+    """Выборка по IN (...) кусками, чтобы не упереться в лимит параметров"""
+    ids = list(ids)
+    rows = []
+    for start in range(0, len(ids), 500):
+        rows.extend(query.filter(column.in_(ids[start:start + 500])).all())
+    return rows
+
+def serialize_sender(sender: Optional[User]) -> Optional[Dict[str, Any]]:
+    """Краткие данные отправителя для payload сообщения"""
+    if not sender:
+        return None
+    return {
+        "id": sender.id,
+        "username": sender.username,
+        "display_name": sender.display_name,
+        "avatar_url": sender.avatar_url,
+        "is_online": sender.is_online,
+        "is_verified": sender.is_verified
+    }
+
+def with_sender_presence(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Копия payload со статусом отправителя на момент ответа (в кэше хвоста он устаревает)"""
+    sender = payload.get("sender")
+    if not sender:
+        return payload
+    return {**payload, "sender": {**sender, "is_online": manager.is_user_online(sender["id"])}}
+
+def serialize_messages(
+    db: Session,
+    messages: List[Message],
+    current_user_id: Optional[int] = None,
+    include_chat: bool = False,
+    users: Optional[Dict[int, User]] = None,
+    load_reactions: bool = True
+) -> List[Dict[str, Any]]:
+    """Сериализация страницы сообщений фиксированным числом IN-запросов"""
+    if not messages:
+        return []
+    
+    users = dict(users or {})
+    
+    # Сообщения, на которые ответили (один запрос на страницу)
+    reply_ids = {m.reply_to_id for m in messages if m.reply_to_id}
+    replies = {r.id: r for r in _query_in_chunks(db.query(Message), Message.id, reply_ids)} if reply_ids else {}
+    
+    # Все упомянутые пользователи: отправители, пересланные, авторы ответов
+    user_ids = {m.from_user_id for m in messages if m.from_user_id}
+    user_ids.update(m.forwarded_from for m in messages if m.forwarded_message_id and m.forwarded_from)
+    user_ids.update(r.from_user_id for r in replies.values() if r.from_user_id)
+    missing = user_ids - users.keys()
+    if missing:
+        users.update((u.id, u) for u in _query_in_chunks(db.query(User), User.id, missing))
+    
+    # Реакции всей страницы
+    reactions: Dict[int, Dict[str, Dict[str, Any]]] = {}
+    if load_reactions:
+        rows = _query_in_chunks(
+            db.query(MessageReaction.message_id, MessageReaction.user_id, MessageReaction.reaction),
+            MessageReaction.message_id,
+            [m.id for m in messages]
+        )
+        for message_id, reaction_user_id, reaction in rows:
+            summary = reactions.setdefault(message_id, {}).setdefault(reaction, {"count": 0, "users": []})
+            summary["count"] += 1
+            summary["users"].append(reaction_user_id)
+    
+    result = []
+    for msg in messages:
+        forwarded_message_info = None
+        if msg.forwarded_message_id and msg.forwarded_from:
+            forwarded_user = users.get(msg.forwarded_from)
+            if forwarded_user:
+                forwarded_message_info = {
+                    "from_user_id": msg.forwarded_from,
+                    "from_username": forwarded_user.username,
+                    "from_display_name": forwarded_user.display_name,
+                    "message_id": msg.forwarded_message_id
+                }
+        
+        reply_to_info = None
+        replied_msg = replies.get(msg.reply_to_id) if msg.reply_to_id else None
+        if replied_msg:
+            replied_sender = users.get(replied_msg.from_user_id)
+            reply_to_info = {
+                "message_id": replied_msg.id,
+                "content": replied_msg.content[:100] + "..." if len(replied_msg.content or "") > 100 else replied_msg.content,
+                "sender_id": replied_sender.id if replied_sender else None,
+                "sender_username": replied_sender.username if replied_sender else None,
+                "sender_display_name": replied_sender.display_name if replied_sender else None
+            }
+        
+        data = {
+            "id": msg.id,
+            "content": msg.content,
+            "type": msg.message_type,
+            "media_url": msg.media_url,
+            "thumbnail_url": msg.thumbnail_url,
+            "media_size": msg.media_size,
+            "media_width": msg.media_width,
+            "media_height": msg.media_height,
+            "media_duration": msg.media_duration,
+            "filename": msg.filename,
+            "file_size": msg.file_size,
+            "file_type": msg.file_type,
+            "is_my_message": current_user_id is not None and msg.from_user_id == current_user_id,
+            "is_edited": msg.is_edited,
+            "is_pinned": msg.is_pinned,
+            "is_encrypted": msg.is_encrypted,
+            "from_user_id": msg.from_user_id,
+            "to_user_id": msg.to_user_id,
+            "group_id": msg.group_id,
+            "channel_id": msg.channel_id,
+            "reply_to_id": msg.reply_to_id,
+            "reply_to": reply_to_info,
+            "forwarded_message_id": msg.forwarded_message_id,
+            "forwarded_from": forwarded_message_info,
+            "reactions": reactions.get(msg.id, {}) if load_reactions else (msg.reactions_summary or {}),
+            "read_by": msg.read_by or [],
+            "sender": serialize_sender(users.get(msg.from_user_id)),
+            "created_at": msg.created_at.isoformat() if msg.created_at else None,
+            "updated_at": msg.updated_at.isoformat() if msg.updated_at else None,
+            "seq": msg.seq
+        }
+        
+        if include_chat:
+            # Определяем тип чата
+            if msg.group_id:
+                data["chat_type"], data["chat_id"] = "group", msg.group_id
+            elif msg.channel_id:
+                data["chat_type"], data["chat_id"] = "channel", msg.channel_id
+            else:
+                data["chat_type"] = "private"
+                data["chat_id"] = msg.to_user_id if msg.from_user_id == current_user_id else msg.from_user_id
+        
+        result.append(data)
+    
+    return result
+
+# Поля payload сообщения, которые можно запросить через fields=
+MESSAGE_PAYLOAD_FIELDS = {
+    "id", "content", "type", "media_url", "thumbnail_url", "media_size", "media_width", "media_height",
+    "media_duration", "filename", "file_size", "file_type", "is_my_message", "is_edited", "is_pinned",
+    "is_encrypted", "from_user_id", "to_user_id", "group_id", "channel_id", "reply_to_id", "reply_to",
+    "forwarded_message_id", "forwarded_from", "reactions", "read_by", "sender", "created_at", "updated_at",
+    "seq", "chat_type", "chat_id"
+}
+
+# В компактном виде: отправитель уходит в общий словарь users, id дублируются во вложенных объектах
+COMPACT_SKIPPED_FIELDS = {"sender", "read_by", "reply_to_id", "forwarded_message_id"}
+
+def parse_message_fields(fields: Optional[str], view: str) -> Optional[Set[str]]:
+    """Проверка fields= и view=; None - все поля"""
+    if view not in ("full", "compact"):
+        raise HTTPException(status_code=400, detail="view должен быть full или compact")
+    if not fields:
+        return None
+    
+    selected = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = selected - MESSAGE_PAYLOAD_FIELDS
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(sorted(unknown))}")
+    selected.add("id")
+    return selected
+
+def shape_message_payloads(
+    messages: List[Dict[str, Any]],
+    selected: Optional[Set[str]],
+    view: str
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Dict[str, Any]]]]:
+    """
+    Sparse fieldsets и компактный вид поверх готовых payload (исходные словари не меняются).
+    В компактном виде пустые и ложные значения опускаются, а отправители
+    возвращаются один раз в словаре users по id.
+    """
+    if view == "full":
+        if selected is None:
+            return messages, None
+        return [{key: value for key, value in message.items() if key in selected} for message in messages], None
+    
+    with_users = selected is None or "sender" in selected
+    users: Dict[str, Dict[str, Any]] = {}
+    shaped = []
+    for message in messages:
+        sender = message.get("sender")
+        if with_users and sender and sender.get("id") is not None:
+            users.setdefault(str(sender["id"]), sender)
+        
+        compact = {}
+        for key, value in message.items():
+            if key in COMPACT_SKIPPED_FIELDS or (selected is not None and key not in selected):
+                continue
+            if key == "reply_to" and value:
+                value = {"message_id": value["message_id"], "content": value["content"], "sender_id": value["sender_id"]}
+                if with_users and value["sender_id"] is not None:
+                    users.setdefault(str(value["sender_id"]), {
+                        "id": value["sender_id"],
+                        "username": message["reply_to"]["sender_username"],
+                        "display_name": message["reply_to"]["sender_display_name"]
+                    })
+            elif key == "forwarded_from" and value:
+                value = {"from_user_id": value["from_user_id"], "message_id": value["message_id"]}
+            elif key == "reactions" and value:
+                value = {emoji: info["count"] for emoji, info in value.items()}
+            
+            if value is None or value is False or value in ("", [], {}):
+                continue
+            compact[key] = value
+        shaped.append(compact)
+    
+    return shaped, users if with_users else None
+
+# Поля пользователя, которые попадают в payload сообщений
+SENDER_PAYLOAD_FIELDS = ("username", "display_name", "avatar_url", "is_verified")
+
+@event.listens_for(SessionLocal, "after_flush")
+def collect_message_changes(session, flush_context):
+    """Запоминаем измененные сообщения до коммита транзакции"""
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Message):
+            session.info.setdefault("changed_messages", {})[obj.id] = MessageTailCache.key_for(obj)
+        elif isinstance(obj, User) and obj in session.dirty:
+            state = sa_inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in SENDER_PAYLOAD_FIELDS):
+                session.info.setdefault("changed_senders", set()).add(obj.id)
+
+@event.listens_for(SessionLocal, "after_commit")
+def apply_message_changes(session):
+    """После коммита обновляем хвосты кэшированных чатов на месте"""
+    tail = manager.message_tail
+    for user_id in session.info.pop("changed_senders", ()):
+        tail.invalidate_sender(user_id)
+    
+    changed = session.info.pop("changed_messages", None)
+    if not changed:
+        return
+    with tail.lock:
+        tail.generation += 1
+    if not any(key in tail.chats for key in changed.values()):
+        return
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # Коммит из потока пула - пересериализуем здесь же
+        refresh_message_tail(changed)
+        return
+    # Коммит в цикле событий: запросы пересериализации уходят в поток
+    asyncio.create_task(asyncio.to_thread(refresh_message_tail, changed))
+
+def refresh_message_tail(changed: Dict[int, Optional[Tuple[str, Any]]]):
+    """Обновление хвостов после коммита; при ошибке затронутые хвосты сбрасываются"""
+    tail = manager.message_tail
+    try:
+        tail.refresh(changed)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления кэша сообщений: {e}")
+        for key in set(changed.values()):
+            if key is not None:
+                tail.invalidate(key)
+
+@event.listens_for(SessionLocal, "after_commit")
+def publish_dialog_changes(session):
+    """После коммита рассылаем изменения списка чатов кадрами dialog_updated"""
+    updates = session.info.pop("dialog_updates", None)
+    chat_updates = session.info.pop("dialog_chat_updates", None)
+    if updates or chat_updates:
+        manager.queue_dialog_updates(updates or {}, chat_updates or {})
+
+@event.listens_for(SessionLocal, "after_rollback")
+def discard_message_changes(session):
+    session.info.pop("changed_messages", None)
+    session.info.pop("changed_senders", None)
+    session.info.pop("dialog_updates", None)
+    session.info.pop("dialog_chat_updates", None)
+
+def encode_message_cursor(message: Dict[str, Any], direction: str) -> str:
+    """Непрозрачный курсор на позицию (created_at, id) сериализованного сообщения"""
+    raw = json.dumps({"t": message["created_at"], "i": message["id"], "d": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_message_cursor(cursor: str) -> Tuple[datetime, int, str]:
+    """Разбор курсора истории, 400 при любой ошибке"""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        direction = raw["d"]
+        if direction not in ("older", "newer"):
+            raise ValueError(direction)
+        return datetime.fromisoformat(raw["t"]), int(raw["i"]), direction
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+def keyset_slice(
+    query,
+    created_at: Optional[datetime],
+    message_id: Optional[int],
+    direction: str,
+    limit: int,
+    inclusive: bool = False
+) -> Tuple[List[Message], bool]:
+    """Срез истории до/после позиции (created_at, id) в хронологическом порядке"""
+    if direction == "older":
+        if created_at is not None:
+            id_filter = Message.id <= message_id if inclusive else Message.id < message_id
+            # created_at <= t задает диапазон по индексу, OR уточняет равные метки
+            query = query.filter(Message.created_at <= created_at, or_(Message.created_at < created_at, id_filter))
+        query = query.order_by(desc(Message.created_at), desc(Message.id))
+    else:
+        if created_at is not None:
+            id_filter = Message.id >= message_id if inclusive else Message.id > message_id
+            query = query.filter(Message.created_at >= created_at, or_(Message.created_at > created_at, id_filter))
+        query = query.order_by(Message.created_at, Message.id)
+    
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "older":
+        rows.reverse()
+    return rows, has_more
+
+@app.get("/api/messages")
+async def get_messages(
+    page: int = Query(1, ge=1),
+    limit: int = Query(50, ge=1, le=200),
+    chat_type: Optional[str] = Query(None),
+    chat_id: Optional[int] = Query(None),
+    fields: Optional[str] = Query(None, description="Поля сообщений через запятую"),
+    view: str = Query("full", description="full или compact"),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Получение последних сообщений пользователя"""
+    try:
+        selected_fields = parse_message_fields(fields, view)
+        query = db.query(Message).filter(Message.is_deleted == False)
+        
+        # Фильтрация по типу чата
+        if chat_type and chat_id:
+            if chat_type == "private":
+                query = query.filter(Message.dialog_key == make_dialog_key(user.id, chat_id))
+            elif chat_type == "group":
+                query = query.filter(Message.group_id == chat_id)
+            elif chat_type == "channel":
+                query = query.filter(Message.channel_id == chat_id)
+        
+        # Если не указан чат, получаем все сообщения пользователя
+        if not chat_type or not chat_id:
+            query = query.filter(
+                or_(
+                    Message.from_user_id == user.id,
+                    Message.to_user_id == user.id,
+                    Message.group_id.in_(
+                        db.query(GroupMember.group_id).filter(
+                            GroupMember.user_id == user.id,
+                            GroupMember.is_banned == False
+                        )
+                    ),
+                    Message.channel_id.in_(
+                        db.query(ChannelSubscription.channel_id).filter(
+                            ChannelSubscription.user_id == user.id,
+                            ChannelSubscription.is_banned == False
+                        )
+                    )
+                )
+            )
+        
+        total = query.count()
+        messages = query.order_by(desc(Message.created_at)) \
+                       .offset((page - 1) * limit) \
+                       .limit(limit) \
+                       .all()
+        
+        messages_data = serialize_messages(db, messages, user.id, include_chat=True)
+        for data in messages_data:
+            if data["sender"] is None:
+                data["sender"] = {"username": "System"}
+        
+        messages_data, users = shape_message_payloads(messages_data, selected_fields, view)
+        response = {
+            "success": True,
+            "messages": messages_data,
+            "pagination": {
+                "page": page,
+                "limit": limit,
+                "total": total,
+                "pages": (total + limit - 1) // limit
+            }
+        }
+        if users is not None:
+            response["users"] = users
+        return FastJSONResponse(response)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки сообщений: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка загрузки сообщений: {str(e)}"
+        )
+
+@app.get("/api/messages/chat/{chat_type}/{chat_id}")
+async def get_chat_messages(
+    chat_type: str,
+    chat_id: int,
+    page: int = Query(1, ge=1),
+    limit: int = Query(100, ge=1, le=500),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    search: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    around: Optional[int] = Query(None),
+    with_total: bool = Query(False),
+    fields: Optional[str] = Query(None, description="Поля сообщений через запятую"),
+    view: str = Query("full", description="full или compact"),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Получение сообщений для чата с курсорной пагинацией и поиском"""
+    try:
+        selected_fields = parse_message_fields(fields, view)
+        query = db.query(Message).filter(Message.is_deleted == False)
+        
+        if chat_type == "private":
+            # Личные сообщения с пользователем
+            other_user = db.query(User).filter(
+                User.id == chat_id,
+                User.is_active == True
+            ).first()
+            
+            if not other_user:
+                raise HTTPException(status_code=404, detail="Пользователь не найден")
+            
+            # Проверяем, не заблокирован ли пользователь
+            is_blocked = db.query(Contact).filter(
+                Contact.user_id == user.id,
+                Contact.contact_id == chat_id,
+                Contact.is_blocked == True
+            ).first() is not None
+            
+            if is_blocked:
+                raise HTTPException(status_code=403, detail="Пользователь заблокирован")
+            
+            query = query.filter(Message.dialog_key == make_dialog_key(user.id, chat_id))
+            
+        elif chat_type == "group":
+            # Сообщения группы
+            group = db.query(Group).filter(
+                Group.id == chat_id,
+                Group.is_active == True
+            ).first()
+            
+            if not group:
+                raise HTTPException(status_code=404, detail="Группа не найдена")
+            
+            # Проверяем доступ
+            if not group.is_public:
+                membership = db.query(GroupMember).filter(
+                    GroupMember.group_id == chat_id,
+                    GroupMember.user_id == user.id,
+                    GroupMember.is_banned == False
+                ).first()
+                
+                if not membership:
+                    raise HTTPException(status_code=403, detail="Вы не состоите в этой группе")
+            
+            query = query.filter(Message.group_id == chat_id)
+            
+        elif chat_type == "channel":
+            # Сообщения канала
+            channel = db.query(Channel).filter(
+                Channel.id == chat_id,
+                Channel.is_active == True
+            ).first()
+            
+            if not channel:
+                raise HTTPException(status_code=404, detail="Канал не найден")
+            
+            # Проверяем доступ
+            if not channel.is_public:
+                subscription = db.query(ChannelSubscription).filter(
+                    ChannelSubscription.channel_id == chat_id,
+                    ChannelSubscription.user_id == user.id,
+                    ChannelSubscription.is_banned == False
+                ).first()
+                
+                if not subscription:
+                    raise HTTPException(status_code=403, detail="Вы не подписаны на этот канал")
+            
+            query = query.filter(Message.channel_id == chat_id)
+            
+        else:
+            raise HTTPException(status_code=400, detail="Неверный тип чата")
         
-        db.commit()
+        # Фильтрация по времени
+        before_time = after_time = None
+        if before:
+            try:
+                before_time = datetime.fromisoformat(before.replace('Z', '+00:00'))
+                query = query.filter(Message.created_at < before_time)
+            except:
+                pass
         
-        return {
-            "success": True,
-            "message": f"Пользователь {target_user.username} заблокирован"
-        }
+        if after:
+            try:
+                after_time = datetime.fromisoformat(after.replace('Z', '+00:00'))
+                query = query.filter(Message.created_at > after_time)
+            except:
+                pass
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        db.rollback()
-        logger.error(f"❌ Ошибка блокировки пользователя: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка блокировки пользователя: {str(e)}"
+        # Поиск по содержимому: по полнотекстовому индексу с релевантностью, без него - подстрокой
+        search_hits = None
+        if search and search.strip():
+            chat_ref = make_dialog_key(user.id, chat_id) if chat_type == "private" else chat_id
+            search_hits = search_chat_messages(
+                db, chat_type, chat_ref, search.strip(), limit + 1, (page - 1) * limit, before_time, after_time
+            )
+            if search_hits is None:
+                search_filter = f"%{search.strip()}%"
+                query = query.filter(Message.content.ilike(search_filter))
+        
+        # Точный COUNT пересканирует весь чат, поэтому только по запросу
+        total = query.count() if with_total and search_hits is None else None
+        
+        # Ключевая пагинация по (created_at, id): next_cursor ведет к более старым, prev_cursor к более новым
+        has_older = has_newer = False
+        
+        # Первая страница без фильтров отдается из кэша хвоста чата
+        tail = manager.message_tail
+        tail_key = ("private", make_dialog_key(user.id, chat_id)) if chat_type == "private" else (chat_type, chat_id)
+        use_tail = (
+            page == 1 and not cursor and around is None and not before and not after
+            and not (search and search.strip()) and limit <= tail.size
         )
-
-@app.post("/api/users/{user_id}/unblock")
-async def unblock_user(
-    user_id: int,
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Разблокировка пользователя"""
-    try:
-        contact = db.query(Contact).filter(
-            Contact.user_id == user.id,
-            Contact.contact_id == user_id,
-            Contact.is_blocked == True
-        ).first()
+        cached = tail.get(tail_key, limit, user.id) if use_tail else None
+        
+        if cached is not None:
+            messages_data, has_older = cached
+        elif search_hits is not None:
+            # Результаты поиска - по убыванию релевантности, страницы по номеру
+            has_older = len(search_hits) > limit
+            search_hits = search_hits[:limit]
+            messages = []
+            if search_hits:
+                # Чат, время и удаление уже отфильтрованы индексом; по query SQLite пошел бы по индексу чата
+                by_id = {message.id: message for message in db.query(Message).filter(Message.id.in_([hit[0] for hit in search_hits])).all()}
+                messages = [by_id[hit[0]] for hit in search_hits if hit[0] in by_id]
+        elif cursor:
+            cursor_time, cursor_id, direction = decode_message_cursor(cursor)
+            messages, has_more = keyset_slice(query, cursor_time, cursor_id, direction, limit)
+            has_older, has_newer = (has_more, True) if direction == "older" else (True, has_more)
+        elif around is not None:
+            # Переход к сообщению: якорь и половина страницы по обе стороны
+            anchor = query.filter(Message.id == around).first()
+            if not anchor:
+                raise HTTPException(status_code=404, detail="Сообщение не найдено")
+            older, has_older = keyset_slice(query, anchor.created_at, anchor.id, "older", limit - limit // 2, inclusive=True)
+            newer, has_newer = keyset_slice(query, anchor.created_at, anchor.id, "newer", limit // 2)
+            messages = older + newer
+        elif page > 1:
+            # Старые клиенты с номером страницы
+            messages = query.order_by(desc(Message.created_at), desc(Message.id)) \
+                            .offset((page - 1) * limit) \
+                            .limit(limit + 1) \
+                            .all()
+            has_older, has_newer = len(messages) > limit, True
+            messages = messages[:limit]
+            messages.reverse()
+        else:
+            generation = tail.generation
+            messages, has_older = keyset_slice(query, None, None, "older", limit)
         
-        if not contact:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Пользователь не найден в заблокированных"
-            )
+        if cached is None:
+            # Старые сообщения в начале
+            messages_data = serialize_messages(db, messages, user.id)
+            if use_tail:
+                tail.fill(tail_key, messages_data, not has_older, generation)
+        # Статус отправителей в сети - по подключениям, одинаково для кэша и БД
+        messages_data = [with_sender_presence(payload) for payload in messages_data]
         
-        contact.is_blocked = False
-        contact.updated_at = datetime.utcnow()
-        db.commit()
+        # Получаем информацию о чате
+        chat_info = None
+        if chat_type == "private" and other_user:
+            # Проверяем настройки приватности
+            can_see_online = True
+            can_see_last_seen = True
+            
+            if other_user.settings and "privacy" in other_user.settings:
+                privacy = other_user.settings["privacy"]
+                
+                if privacy.get("online_status") == "contacts":
+                    # Проверяем, есть ли в контактах
+                    is_contact = db.query(Contact).filter(
+                        Contact.user_id == other_user.id,
+                        Contact.contact_id == user.id,
+                        Contact.is_blocked == False
+                    ).first() is not None
+                    can_see_online = is_contact
+                
+                if privacy.get("last_seen") == "contacts":
+                    is_contact = db.query(Contact).filter(
+                        Contact.user_id == other_user.id,
+                        Contact.contact_id == user.id,
+                        Contact.is_blocked == False
+                    ).first() is not None
+                    can_see_last_seen = is_contact
+            
+            chat_info = {
+                "type": "private",
+                "id": other_user.id,
+                "name": other_user.display_name or other_user.username,
+                "avatar_url": other_user.avatar_url,
+                "is_online": other_user.is_online if can_see_online else None,
+                "is_verified": other_user.is_verified,
+                "status": other_user.status,
+                "status_message": other_user.status_message,
+                "last_seen": other_user.last_seen.isoformat() if other_user.last_seen and can_see_last_seen else None,
+                "bio": other_user.bio
+            }
+        elif chat_type == "group" and group:
+            chat_info = {
+                "type": "group",
+                "id": group.id,
+                "name": group.name,
+                "avatar_url": group.avatar_url,
+                "banner_url": group.banner_url,
+                "description": group.description,
+                "is_public": group.is_public,
+                "is_encrypted": group.is_encrypted,
+                "owner_id": group.owner_id,
+                "members_count": group.members_count,
+                "online_count": group.online_count,
+                "settings": group.settings,
+                "pinned_message_id": group.pinned_message_id
+            }
+        elif chat_type == "channel" and channel:
+            chat_info = {
+                "type": "channel",
+                "id": channel.id,
+                "name": channel.name,
+                "avatar_url": channel.avatar_url,
+                "banner_url": channel.banner_url,
+                "description": channel.description,
+                "is_public": channel.is_public,
+                "is_verified": channel.is_verified,
+                "is_encrypted": channel.is_encrypted,
+                "owner_id": channel.owner_id,
+                "subscribers_count": channel.subscribers_count,
+                "online_count": channel.online_count,
+                "settings": channel.settings,
+                "pinned_message_id": channel.pinned_message_id
+            }
         
-        target_user = db.query(User).filter(User.id == user_id).first()
+        shaped_messages, users = shape_message_payloads(messages_data, selected_fields, view)
+        if search_hits is not None:
+            hits = {message_id: {"rank": rank, "snippet": snippet} for message_id, rank, snippet in search_hits}
+            for shaped, message in zip(shaped_messages, messages_data):
+                shaped["search"] = hits.get(message["id"])
         
-        return {
+        response = {
             "success": True,
-            "message": f"Пользователь {target_user.username if target_user else 'unknown'} разблокирован"
+            "chat_info": chat_info,
+            "messages": shaped_messages,
+            "pagination": {
+                "page": page,
+                "limit": limit,
+                "total": total,
+                "pages": (total + limit - 1) // limit if total is not None else None,
+                "has_more": has_older,
+                "has_newer": has_newer,
+                "next_cursor": encode_message_cursor(messages_data[0], "older") if messages_data and has_older and search_hits is None else None,
+                "prev_cursor": encode_message_cursor(messages_data[-1], "newer") if messages_data and has_newer and search_hits is None else None,
+                "anchor_id": around
+            }
         }
+        if users is not None:
+            response["users"] = users
+        if search_hits is not None:
+            response["search"] = {"backend": MESSAGE_SEARCH_BACKEND, "query": search.strip()}
+        return FastJSONResponse(response)
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
-        logger.error(f"❌ Ошибка разблокировки пользователя: {str(e)}")
+        logger.error(f"❌ Ошибка загрузки сообщений: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка разблокировки пользователя: {str(e)}"
+            detail=f"Ошибка загрузки сообщений: {str(e)}"
         )
 
-# ========== СООБЩЕНИЯ ==========
+def chat_access_filter(db: Session, user: User, chat_type: str, chat_id: int):
+    """Условие на сообщения чата, если пользователь может его читать, иначе None"""
+    if chat_type == "private":
+        other_user = db.query(User.id).filter(User.id == chat_id, User.is_active == True).first()
+        if not other_user:
+            return None
+        is_blocked = db.query(Contact.id).filter(
+            Contact.user_id == user.id,
+            Contact.contact_id == chat_id,
+            Contact.is_blocked == True
+        ).first() is not None
+        return None if is_blocked else chat_message_filter("private", make_dialog_key(user.id, chat_id))
+    
+    if chat_type == "group":
+        group = db.query(Group).filter(Group.id == chat_id, Group.is_active == True).first()
+        if not group:
+            return None
+        if not group.is_public and not db.query(GroupMember.id).filter(
+            GroupMember.group_id == chat_id,
+            GroupMember.user_id == user.id,
+            GroupMember.is_banned == False
+        ).first():
+            return None
+        return chat_message_filter("group", chat_id)
+    
+    if chat_type == "channel":
+        channel = db.query(Channel).filter(Channel.id == chat_id, Channel.is_active == True).first()
+        if not channel:
+            return None
+        if not channel.is_public and not db.query(ChannelSubscription.id).filter(
+            ChannelSubscription.channel_id == chat_id,
+            ChannelSubscription.user_id == user.id,
+            ChannelSubscription.is_banned == False
+        ).first():
+            return None
+        return chat_message_filter("channel", chat_id)
+    
+    return None
 
-@app.get("/api/messages")
-async def get_messages(
-    page: int = Query(1, ge=1),
-    limit: int = Query(50, ge=1, le=200),
-    chat_type: Optional[str] = Query(None),
-    chat_id: Optional[int] = Query(None),
+def parse_sync_positions(since: str) -> List[Tuple[str, int, int]]:
+    """Разбор since вида "group:1:120,private:7:45" в (chat_type, chat_id, seq)"""
+    positions = []
+    for item in since.split(","):
+        parts = item.strip().split(":")
+        if len(parts) != 3 or parts[0] not in ("private", "group", "channel"):
+            raise HTTPException(status_code=400, detail=f"Некорректная позиция синхронизации: {item}")
+        try:
+            positions.append((parts[0], int(parts[1]), int(parts[2])))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Некорректная позиция синхронизации: {item}")
+    
+    if len(positions) > SYNC_MAX_CHATS:
+        raise HTTPException(status_code=400, detail=f"Не более {SYNC_MAX_CHATS} чатов за один запрос")
+    return positions
+
+@app.get("/api/sync")
+async def sync_chats(
+    since: str = Query(..., description="Позиции клиента: chat_type:chat_id:seq через запятую"),
+    limit: int = Query(200, ge=1, le=1000),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Получение последних сообщений пользователя"""
+    """Дельта-синхронизация: изменения и удаления сообщений после известных клиенту номеров"""
     try:
-        query = db.query(Message).filter(Message.is_deleted == False)
-        
-        # Фильтрация по типу чата
-        if chat_type and chat_id:
-            if chat_type == "private":
-                query = query.filter(
-                    or_(
-                        and_(Message.from_user_id == user.id, Message.to_user_id == chat_id),
-                        and_(Message.from_user_id == chat_id, Message.to_user_id == user.id)
-                    )
-                )
-            elif chat_type == "group":
-                query = query.filter(Message.group_id == chat_id)
-            elif chat_type == "channel":
-                query = query.filter(Message.channel_id == chat_id)
-        
-        # Если не указан чат, получаем все сообщения пользователя
-        if not chat_type or not chat_id:
-            query = query.filter(
-                or_(
-                    Message.from_user_id == user.id,
-                    Message.to_user_id == user.id,
-                    Message.group_id.in_(
-                        db.query(GroupMember.group_id).filter(
-                            GroupMember.user_id == user.id,
-                            GroupMember.is_banned == False
-                        )
-                    ),
-                    Message.channel_id.in_(
-                        db.query(ChannelSubscription.channel_id).filter(
-                            ChannelSubscription.user_id == user.id,
-                            ChannelSubscription.is_banned == False
-                        )
-                    )
-                )
-            )
-        
-        total = query.count()
-        messages = query.order_by(desc(Message.created_at)) \
-                       .offset((page - 1) * limit) \
-                       .limit(limit) \
-                       .all()
-        
-        messages_data = []
-        for msg in messages:
-            sender = None
-            if msg.from_user_id:
-                sender = db.query(User).filter(User.id == msg.from_user_id).first()
+        chats = []
+        for chat_type, chat_id, since_seq in parse_sync_positions(since):
+            chat_filter = chat_access_filter(db, user, chat_type, chat_id)
+            if chat_filter is None:
+                chats.append({"chat_type": chat_type, "chat_id": chat_id, "error": "Нет доступа к чату"})
+                continue
             
-            # Определяем тип чата
-            msg_chat_type = "private"
-            msg_chat_id = msg.to_user_id if msg.from_user_id == user.id else msg.from_user_id
+            rows = db.query(Message).filter(chat_filter, Message.seq > since_seq).order_by(
+                Message.seq
+            ).limit(limit + 1).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
             
-            if msg.group_id:
-                msg_chat_type = "group"
-                msg_chat_id = msg.group_id
-            elif msg.channel_id:
-                msg_chat_type = "channel"
-                msg_chat_id = msg.channel_id
-            
-            # Получаем информацию о пересланном сообщении
-            forwarded_message_info = None
-            if msg.forwarded_message_id and msg.forwarded_from:
-                forwarded_user = db.query(User).filter(User.id == msg.forwarded_from).first()
-                if forwarded_user:
-                    forwarded_message_info = {
-                        "from_user_id": msg.forwarded_from,
-                        "from_username": forwarded_user.username,
-                        "from_display_name": forwarded_user.display_name,
-                        "message_id": msg.forwarded_message_id
-                    }
-            
-            # Получаем информацию о сообщении, на которое ответили
-            reply_to_info = None
-            if msg.reply_to_id:
-                replied_msg = db.query(Message).filter(Message.id == msg.reply_to_id).first()
-                if replied_msg:
-                    replied_sender = db.query(User).filter(User.id == replied_msg.from_user_id).first()
-                    reply_to_info = {
-                        "message_id": replied_msg.id,
-                        "content": replied_msg.content[:100] + "..." if len(replied_msg.content or "") > 100 else replied_msg.content,
-                        "sender_id": replied_sender.id if replied_sender else None,
-                        "sender_username": replied_sender.username if replied_sender else None,
-                        "sender_display_name": replied_sender.display_name if replied_sender else None
-                    }
-            
-            messages_data.append({
-                "id": msg.id,
-                "content": msg.content,
-                "type": msg.message_type,
-                "media_url": msg.media_url,
-                "thumbnail_url": msg.thumbnail_url,
-                "media_size": msg.media_size,
-                "media_width": msg.media_width,
-                "media_height": msg.media_height,
-                "media_duration": msg.media_duration,
-                "filename": msg.filename,
-                "file_size": msg.file_size,
-                "file_type": msg.file_type,
-                "is_my_message": msg.from_user_id == user.id,
-                "is_edited": msg.is_edited,
-                "is_pinned": msg.is_pinned,
-                "is_encrypted": msg.is_encrypted,
-                "chat_type": msg_chat_type,
-                "chat_id": msg_chat_id,
-                "from_user_id": msg.from_user_id,
-                "to_user_id": msg.to_user_id,
-                "group_id": msg.group_id,
-                "channel_id": msg.channel_id,
-                "reply_to": reply_to_info,
-                "forwarded_from": forwarded_message_info,
-                "reactions": msg.reactions_summary or {},
-                "read_by": msg.read_by or [],
-                "sender": {
-                    "id": sender.id if sender else None,
-                    "username": sender.username if sender else "System",
-                    "display_name": sender.display_name if sender else None,
-                    "avatar_url": sender.avatar_url if sender else None,
-                    "is_online": sender.is_online if sender else False,
-                    "is_verified": sender.is_verified if sender else False
-                } if sender else {"username": "System"},
-                "created_at": msg.created_at.isoformat() if msg.created_at else None,
-                "updated_at": msg.updated_at.isoformat() if msg.updated_at else None
+            chats.append({
+                "chat_type": chat_type,
+                "chat_id": chat_id,
+                # Позиция, с которой продолжать: номер последнего отданного изменения
+                "seq": rows[-1].seq if rows else since_seq,
+                "messages": serialize_messages(db, [row for row in rows if not row.is_deleted], user.id),
+                "deleted": [
+                    {"id": row.id, "seq": row.seq, "deleted_at": row.deleted_at.isoformat() if row.deleted_at else None}
+                    for row in rows if row.is_deleted
+                ],
+                "has_more": has_more
             })
         
-        return {
-            "success": True,
-            "messages": messages_data,
-            "pagination": {
-                "page": page,
-                "limit": limit,
-                "total": total,
-                "pages": (total + limit - 1) // limit
-            }
-        }
+        return FastJSONResponse({"success": True, "chats": chats})
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"❌ Ошибка загрузки сообщений: {str(e)}")
+        logger.error(f"❌ Ошибка синхронизации чатов: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка загрузки сообщений: {str(e)}"
+            detail="Ошибка синхронизации чатов"
         )
 
-@app.get("/api/messages/chat/{chat_type}/{chat_id}")
-async def get_chat_messages(
+# Колонки экспорта чата (порядок столбцов CSV)
+EXPORT_COLUMNS = [
+    "id", "created_at", "from_user_id", "sender_username", "sender_display_name", "type", "content",
+    "media_url", "filename", "reply_to_id", "forwarded_message_id", "is_edited", "is_encrypted", "updated_at", "seq"
+]
+
+def parse_export_time(value: Optional[str], name: str) -> Optional[datetime]:
+    """ISO-время параметра экспорта в наивное UTC, 400 при ошибке"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Некорректное время в параметре {name}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def iter_chat_export(chat_filter, since: Optional[datetime], until: Optional[datetime], export_format: str):
+    """
+    Потоковая выгрузка истории чата пачками по EXPORT_BATCH_SIZE строк.
+    Читает серверным курсором (yield_per) в собственной сессии; в памяти только текущая пачка и кэш отправителей.
+    """
+    db = SessionLocal()
+    try:
+        statement = select(
+            Message.id, Message.created_at, Message.from_user_id, Message.message_type, Message.content,
+            Message.media_url, Message.filename, Message.reply_to_id, Message.forwarded_message_id,
+            Message.is_edited, Message.is_encrypted, Message.updated_at, Message.seq
+        ).where(chat_filter, Message.is_deleted == False)
+        if since:
+            statement = statement.where(Message.created_at >= since)
+        if until:
+            statement = statement.where(Message.created_at < until)
+        statement = statement.order_by(Message.created_at, Message.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        
+        if export_format == "csv":
+            # BOM, чтобы Excel открыл UTF-8 без вопросов
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+            yield "\ufeff" + buffer.getvalue()
+        
+        senders: Dict[int, Tuple[str, Optional[str]]] = {}
+        for rows in db.execute(statement).partitions():
+            # Отправителей пачки догружаем одним IN-запросом
+            missing = {row[2] for row in rows if row[2] is not None and row[2] not in senders}
+            if missing:
+                for sender_id, username, display_name in db.query(User.id, User.username, User.display_name).filter(User.id.in_(missing)):
+                    senders[sender_id] = (username, display_name)
+            
+            records = []
+            for (message_id, created_at, from_user_id, message_type, content, media_url, filename,
+                 reply_to_id, forwarded_message_id, is_edited, is_encrypted, updated_at, seq) in rows:
+                username, display_name = senders.get(from_user_id, (None, None))
+                records.append([
+                    message_id,
+                    created_at.isoformat() if created_at else None,
+                    from_user_id,
+                    username,
+                    display_name,
+                    message_type,
+                    content,
+                    media_url,
+                    filename,
+                    reply_to_id,
+                    forwarded_message_id,
+                    bool(is_edited),
+                    bool(is_encrypted),
+                    updated_at.isoformat() if updated_at else None,
+                    seq
+                ])
+            
+            if export_format == "csv":
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(records)
+                yield buffer.getvalue()
+            else:
+                yield "".join(
+                    json.dumps(dict(zip(EXPORT_COLUMNS, record)), ensure_ascii=False, separators=(",", ":")) + "\n"
+                    for record in records
+                )
+    except Exception as e:
+        # Заголовки уже отправлены - остается оборвать поток и записать ошибку
+        logger.error(f"❌ Ошибка экспорта чата: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+def authorize_chat_export(request: Request, chat_type: str, chat_id: int):
+    """Авторизация и условие доступа к чату в короткой сессии (не держит соединение пула на время потока)"""
+    db = SessionLocal()
+    try:
+        user = get_current_user(request, db)
+        return chat_access_filter(db, user, chat_type, chat_id)
+    finally:
+        db.close()
+
+@app.get("/api/messages/chat/{chat_type}/{chat_id}/export")
+async def export_chat_messages(
+    request: Request,
     chat_type: str,
     chat_id: int,
-    page: int = Query(1, ge=1),
-    limit: int = Query(100, ge=1, le=500),
-    before: Optional[str] = Query(None),
-    after: Optional[str] = Query(None),
-    search: Optional[str] = Query(None),
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    export_format: str = Query("ndjson", alias="format", description="ndjson или csv"),
+    since: Optional[str] = Query(None, description="ISO-время, включительно"),
+    until: Optional[str] = Query(None, description="ISO-время, не включительно")
 ):
-    """Получение сообщений для чата с пагинацией и поиском"""
-    try:
-        query = db.query(Message).filter(Message.is_deleted == False)
+    """Потоковый экспорт истории чата в NDJSON или CSV (без сессии запроса: она жила бы до конца потока)"""
+    if export_format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format должен быть ndjson или csv")
+    since_time = parse_export_time(since, "since")
+    until_time = parse_export_time(until, "until")
+    
+    chat_filter = await asyncio.to_thread(authorize_chat_export, request, chat_type, chat_id)
+    if chat_filter is None:
+        raise HTTPException(status_code=403, detail="Нет доступа к чату")
+    
+    filename = f"chat_{chat_type}_{chat_id}.{'csv' if export_format == 'csv' else 'ndjson'}"
+    return StreamingResponse(
+        iter_chat_export(chat_filter, since_time, until_time, export_format),
+        media_type="text/csv" if export_format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def serialize_sent_message(message: Message, chat_type: str, client_id: Optional[str] = None, duplicate: bool = False) -> Dict[str, Any]:
+    """Краткие данные отправленного сообщения для ответа и message_ack"""
+    return {
+        "id": message.id,
+        "content": message.content,
+        "type": message.message_type,
+        "media_url": message.media_url,
+        "thumbnail_url": message.thumbnail_url,
+        "filename": message.filename,
+        "is_encrypted": message.is_encrypted,
+        "chat_type": chat_type,
+        "chat_id": message.to_user_id or message.group_id or message.channel_id,
+        "reply_to_id": message.reply_to_id,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+        "seq": message.seq,
+        "client_id": client_id,
+        "duplicate": duplicate
+    }
+
+def find_client_message(db: Session, user_id: int, client_id: str) -> Optional[Dict[str, Any]]:
+    """Поиск сообщения, уже созданного с этим client_id"""
+    row = db.query(Message).join(MessageClientId, MessageClientId.message_id == Message.id).filter(
+        MessageClientId.user_id == user_id,
+        MessageClientId.client_id == client_id
+    ).first()
+    
+    if not row:
+        return None
+    
+    chat_type = "private" if row.to_user_id else "group" if row.group_id else "channel"
+    return serialize_sent_message(row, chat_type, client_id, duplicate=True)
+
+async def send_chat_message(
+    db: Session,
+    user: User,
+    content: Optional[str] = None,
+    message_type: str = "text",
+    to_user_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    channel_id: Optional[int] = None,
+    reply_to_id: Optional[int] = None,
+    forwarded_from: Optional[int] = None,
+    forwarded_message_id: Optional[int] = None,
+    is_encrypted: bool = False,
+    media: Optional[UploadFile] = None,
+    client_id: Optional[str] = None,
+    origin: Optional[WebSocket] = None
+) -> Dict[str, Any]:
+    """Проверка, сохранение и рассылка нового сообщения (общая для HTTP и WebSocket; origin - соединение-отправитель)"""
+    content = content.strip() if content else ""
+    
+    # Повторная отправка с тем же client_id возвращает уже созданное сообщение
+    if client_id:
+        if len(client_id) > 64:
+            raise HTTPException(status_code=400, detail="Слишком длинный client_id")
+        
+        existing = find_client_message(db, user.id, client_id)
+        if existing:
+            return existing
+    
+    media_url = None
+    media_size = None
+    media_width = None
+    media_height = None
+    media_duration = None
+    thumbnail_url = None
+    filename = None
+    file_size = None
+    file_type = None
+    
+    if not content and not media:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Сообщение не может быть пустым"
+        )
+    
+    # Проверяем получателя
+    chat_type = None
+    if to_user_id:
+        chat_type = "private"
+        recipient = db.query(User).filter(
+            User.id == to_user_id,
+            User.is_active == True
+        ).first()
         
-        if chat_type == "private":
-            # Личные сообщения с пользователем
-            other_user = db.query(User).filter(
-                User.id == chat_id,
-                User.is_active == True
-            ).first()
-            
-            if not other_user:
-                raise HTTPException(status_code=404, detail="Пользователь не найден")
-            
-            # Проверяем, не заблокирован ли пользователь
-            is_blocked = db.query(Contact).filter(
-                Contact.user_id == user.id,
-                Contact.contact_id == chat_id,
-                Contact.is_blocked == True
-            ).first() is not None
-            
-            if is_blocked:
-                raise HTTPException(status_code=403, detail="Пользователь заблокирован")
-            
-            query = query.filter(
-                or_(
-                    and_(Message.from_user_id == user.id, Message.to_user_id == chat_id),
-                    and_(Message.from_user_id == chat_id, Message.to_user_id == user.id)
-                )
+        if not recipient:
+            raise HTTPException(status_code=404, detail="Получатель не найден")
+        
+        if to_user_id == user.id:
+            raise HTTPException(status_code=400, detail="Нельзя отправлять сообщения самому себе")
+        
+        # Проверяем, не заблокирован ли пользователь
+        is_blocked = db.query(Contact).filter(
+            or_(
+                and_(Contact.user_id == user.id, Contact.contact_id == to_user_id, Contact.is_blocked == True),
+                and_(Contact.user_id == to_user_id, Contact.contact_id == user.id, Contact.is_blocked == True)
             )
+        ).first() is not None
+        
+        if is_blocked:
+            raise HTTPException(status_code=403, detail="Нельзя отправлять сообщения заблокированному пользователю")
             
-        elif chat_type == "group":
-            # Сообщения группы
-            group = db.query(Group).filter(
-                Group.id == chat_id,
-                Group.is_active == True
-            ).first()
-            
-            if not group:
-                raise HTTPException(status_code=404, detail="Группа не найдена")
+    elif group_id:
+        chat_type = "group"
+        group = db.query(Group).filter(
+            Group.id == group_id,
+            Group.is_active == True
+        ).first()
+        
+        if not group:
+            raise HTTPException(status_code=404, detail="Группа не найдена")
+        
+        # Проверяем доступ
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == user.id,
+            GroupMember.is_banned == False
+        ).first()
+        
+        if not membership and not group.is_public:
+            raise HTTPException(status_code=403, detail="Вы не состоите в этой группе")
+        
+        # Проверяем права на отправку сообщений
+        if membership and not membership.permissions.get("send_messages", True):
+            raise HTTPException(status_code=403, detail="У вас нет прав на отправку сообщений в этой группе")
+        
+        # Проверяем slow mode
+        if group.settings and group.settings.get("slow_mode", 0) > 0:
+            # Проверяем время последнего сообщения
+            last_message = db.query(Message).filter(
+                Message.group_id == group_id,
+                Message.from_user_id == user.id
+            ).order_by(desc(Message.created_at)).first()
             
-            # Проверяем доступ
-            if not group.is_public:
-                membership = db.query(GroupMember).filter(
-                    GroupMember.group_id == chat_id,
-                    GroupMember.user_id == user.id,
-                    GroupMember.is_banned == False
-                ).first()
+            if last_message:
+                time_diff = (datetime.utcnow() - last_message.created_at).total_seconds()
+                slow_mode_seconds = group.settings.get("slow_mode", 0)
                 
-                if not membership:
-                    raise HTTPException(status_code=403, detail="Вы не состоите в этой группе")
-            
-            query = query.filter(Message.group_id == chat_id)
+                if time_diff < slow_mode_seconds:
+                    wait_time = slow_mode_seconds - int(time_diff)
+                    raise HTTPException(
+                        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        detail=f"Slow mode активен. Подождите {wait_time} секунд"
+                    )
+        
+        # Проверяем, разрешено ли отправлять медиа
+        if media and group.settings:
+            media_type = media.content_type or ""
             
-        elif chat_type == "channel":
-            # Сообщения канала
-            channel = db.query(Channel).filter(
-                Channel.id == chat_id,
-                Channel.is_active == True
-            ).first()
+            if media_type.startswith('image/') and not group.settings.get("allow_photos", True):
+                raise HTTPException(status_code=403, detail="Отправка фото запрещена в этой группе")
             
-            if not channel:
-                raise HTTPException(status_code=404, detail="Канал не найден")
+            if media_type.startswith('video/') and not group.settings.get("allow_videos", True):
+                raise HTTPException(status_code=403, detail="Отправка видео запрещена в этой группе")
             
-            # Проверяем доступ
-            if not channel.is_public:
-                subscription = db.query(ChannelSubscription).filter(
-                    ChannelSubscription.channel_id == chat_id,
-                    ChannelSubscription.user_id == user.id,
-                    ChannelSubscription.is_banned == False
-                ).first()
+            if media_type.startswith('audio/') and not group.settings.get("allow_voice", True):
+                raise HTTPException(status_code=403, detail="Отправка аудио запрещена в этой группе")
                 
-                if not subscription:
-                    raise HTTPException(status_code=403, detail="Вы не подписаны на этот канал")
-            
-            query = query.filter(Message.channel_id == chat_id)
-            
+    elif channel_id:
+        chat_type = "channel"
+        channel = db.query(Channel).filter(
+            Channel.id == channel_id,
+            Channel.is_active == True
+        ).first()
+        
+        if not channel:
+            raise HTTPException(status_code=404, detail="Канал не найден")
+        
+        # Проверяем доступ
+        subscription = db.query(ChannelSubscription).filter(
+            ChannelSubscription.channel_id == channel_id,
+            ChannelSubscription.user_id == user.id,
+            ChannelSubscription.is_banned == False
+        ).first()
+        
+        if not subscription and not channel.is_public:
+            raise HTTPException(status_code=403, detail="Вы не подписаны на этот канал")
+        
+        # Проверяем права на отправку сообщений (в каналах обычно только владелец и админы могут писать)
+        if channel.settings and channel.settings.get("admin_only_posting", True):
+            if user.id != channel.owner_id:
+                if not subscription or subscription.role not in ["admin", "moderator"]:
+                    raise HTTPException(status_code=403, detail="Только администраторы могут отправлять сообщения в этот канал")
+    else:
+        raise HTTPException(status_code=400, detail="Не указан получатель")
+    
+    # Проверяем reply_to_id
+    if reply_to_id:
+        replied_message = db.query(Message).filter(
+            Message.id == reply_to_id,
+            Message.is_deleted == False
+        ).first()
+        
+        if not replied_message:
+            raise HTTPException(status_code=404, detail="Сообщение для ответа не найдено")
+        
+        # Проверяем, что сообщение находится в том же чате
+        if chat_type == "private":
+            if replied_message.dialog_key != make_dialog_key(user.id, to_user_id):
+                raise HTTPException(status_code=400, detail="Нельзя ответить на сообщение из другого чата")
+        elif chat_type == "group":
+            if replied_message.group_id != group_id:
+                raise HTTPException(status_code=400, detail="Нельзя ответить на сообщение из другой группы")
+        elif chat_type == "channel":
+            if replied_message.channel_id != channel_id:
+                raise HTTPException(status_code=400, detail="Нельзя ответить на сообщение из другого канала")
+    
+    # Обработка медиа файла
+    if media:
+        # Проверяем размер файла
+        file_size = 0
+        media.file.seek(0, 2)
+        file_size = media.file.tell()
+        media.file.seek(0)
+        
+        if file_size > MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Размер файла не должен превышать {MAX_UPLOAD_SIZE // (1024*1024)} MB"
+            )
+        
+        # Проверяем тип файла
+        mime_type = media.content_type or mimetypes.guess_type(media.filename)[0]
+        is_allowed, error_msg = FileHandler.is_allowed_file(media)
+        
+        if not is_allowed:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=error_msg
+            )
+        
+        filename = media.filename
+        file_type = FileHandler.get_file_type(mime_type)
+        
+        # Определяем тип сообщения
+        if mime_type.startswith('image/'):
+            message_type = "image"
+            subdir = "images"
+        elif mime_type.startswith('video/'):
+            message_type = "video"
+            subdir = "videos"
+        elif mime_type.startswith('audio/'):
+            message_type = "audio"
+            subdir = "audios"
         else:
-            raise HTTPException(status_code=400, detail="Неверный тип чата")
+            message_type = "file"
+            subdir = "files"
         
-        # Фильтрация по времени
-        if before:
-            try:
-                before_time = datetime.fromisoformat(before.replace('Z', '+00:00'))
-                query = query.filter(Message.created_at < before_time)
-            except:
-                pass
+        # Генерируем уникальное имя файла
+        file_ext = media.filename.split('.')[-1] if '.' in media.filename else 'bin'
+        unique_filename = f"{uuid.uuid4()}.{file_ext}"
+        filepath = UPLOAD_DIR / subdir / unique_filename
         
-        if after:
+        # Сохраняем файл
+        with open(filepath, "wb") as buffer:
+            shutil.copyfileobj(media.file, buffer)
+        
+        media_url = f"/uploads/{subdir}/{unique_filename}"
+        media_size = file_size
+        
+        # Для изображений и видео создаем миниатюру
+        if mime_type.startswith('image/'):
             try:
-                after_time = datetime.fromisoformat(after.replace('Z', '+00:00'))
-                query = query.filter(Message.created_at > after_time)
-            except:
-                pass
+                with Image.open(filepath) as img:
+                    media_width, media_height = img.size
+                
+                # Создаем миниатюру
+                thumb_buffer = FileHandler.generate_thumbnail(filepath)
+                if thumb_buffer:
+                    thumb_filename = f"thumb_{unique_filename}"
+                    thumb_path = UPLOAD_DIR / "thumbnails" / thumb_filename
+                    with open(thumb_path, "wb") as f:
+                        f.write(thumb_buffer.getvalue())
+                    thumbnail_url = f"/uploads/thumbnails/{thumb_filename}"
+            except Exception as e:
+                logger.warning(f"Не удалось обработать изображение: {e}")
         
-        # Поиск по содержимому
-        if search and search.strip():
-            search_filter = f"%{search.strip()}%"
-            query = query.filter(Message.content.ilike(search_filter))
+        elif mime_type.startswith('video/'):
+            # Для видео можно добавить извлечение информации с помощью ffmpeg
+            # Пока просто указываем тип
+            thumbnail_url = None  # Можно добавить генерацию thumbnail для видео
         
-        total = query.count()
-        messages = query.order_by(desc(Message.created_at)) \
-                       .offset((page - 1) * limit) \
-                       .limit(limit) \
-                       .all()
+        # Вычисляем хеши файла
+        md5_hash, sha256_hash = FileHandler.get_file_hash(filepath)
+        
+        # Сохраняем информацию о файле в базу
+        file_record = File(
+            user_id=user.id,
+            filename=unique_filename,
+            original_filename=filename,
+            file_path=str(filepath),
+            file_url=media_url,
+            file_size=file_size,
+            file_type=file_type,
+            mime_type=mime_type,
+            width=media_width,
+            height=media_height,
+            duration=media_duration,
+            hash_md5=md5_hash,
+            hash_sha256=sha256_hash,
+            thumbnail_url=thumbnail_url,
+            is_public=(chat_type in ["group", "channel"])  # В группах и каналах файлы публичные
+        )
+        db.add(file_record)
+    
+    # Шифрование контента если нужно
+    encrypted_content = None
+    encryption_key = None
+    
+    if is_encrypted and content:
+        try:
+            encrypted_content = encryption_helper.encrypt(content)
+            encryption_key = secrets.token_urlsafe(32)
+            content = ""  # Очищаем открытый текст
+        except Exception as e:
+            logger.error(f"Ошибка шифрования: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Ошибка шифрования сообщения"
+            )
+    
+    # Создаем сообщение
+    message = Message(
+        from_user_id=user.id,
+        to_user_id=to_user_id,
+        dialog_key=make_dialog_key(user.id, to_user_id) if to_user_id else None,
+        group_id=group_id,
+        channel_id=channel_id,
+        reply_to_id=reply_to_id,
+        content=content,
+        encrypted_content=encrypted_content,
+        message_type=message_type,
+        media_url=media_url,
+        media_size=media_size,
+        media_width=media_width,
+        media_height=media_height,
+        media_duration=media_duration,
+        thumbnail_url=thumbnail_url,
+        filename=filename,
+        file_size=file_size,
+        file_type=file_type,
+        is_encrypted=is_encrypted,
+        encryption_key=encryption_key,
+        forwarded_from=forwarded_from,
+        forwarded_message_id=forwarded_message_id,
+        reactions_summary={},
+        read_by=[user.id]  # Отправитель сразу прочитал свое сообщение
+    )
+    
+    db.add(message)
+    
+    if client_id:
+        db.flush()
+        db.add(MessageClientId(user_id=user.id, client_id=client_id, message_id=message.id))
+    
+    try:
+        db.commit()
+    except IntegrityError:
+        # Тот же client_id параллельно записал другой запрос
+        db.rollback()
+        existing = find_client_message(db, user.id, client_id) if client_id else None
+        if existing:
+            return existing
+        raise
+    db.refresh(message)
+    
+    # Связываем файл с сообщением если есть
+    if media and 'file_record' in locals():
+        file_record.message_id = message.id
+        db.commit()
+    
+    # Подготавливаем данные для WebSocket (отправитель - текущий пользователь)
+    ws_message = {
+        "type": "message",
+        "chat_type": chat_type,
+        "chat_id": to_user_id or group_id or channel_id,
+        "message": serialize_messages(db, [message], users={user.id: user}, load_reactions=False)[0],
+        "seq": message.seq,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    
+    # Подтверждение для всех устройств отправителя (client_id позволяет заменить черновик);
+    # соединение, из которого пришла отправка, получает вместо него message_ack
+    sent_message = {**ws_message, "type": "message_sent", "message_id": message.id}
+    if client_id:
+        sent_message["client_id"] = client_id
+    
+    # Отправляем через WebSocket
+    if chat_type == "private":
+        # Отправляем отправителю подтверждение
+        await manager.send_to_user(user.id, sent_message, exclude_connection=origin)
         
-        messages_data = []
-        for msg in messages:
-            sender = None
-            if msg.from_user_id:
-                sender = db.query(User).filter(User.id == msg.from_user_id).first()
-            
-            # Получаем информацию о пересланном сообщении
-            forwarded_message_info = None
-            if msg.forwarded_message_id and msg.forwarded_from:
-                forwarded_user = db.query(User).filter(User.id == msg.forwarded_from).first()
-                if forwarded_user:
-                    forwarded_message_info = {
-                        "from_user_id": msg.forwarded_from,
-                        "from_username": forwarded_user.username,
-                        "from_display_name": forwarded_user.display_name,
-                        "message_id": msg.forwarded_message_id
-                    }
-            
-            # Получаем информацию о сообщении, на которое ответили
-            reply_to_info = None
-            if msg.reply_to_id:
-                replied_msg = db.query(Message).filter(Message.id == msg.reply_to_id).first()
-                if replied_msg:
-                    replied_sender = db.query(User).filter(User.id == replied_msg.from_user_id).first()
-                    reply_to_info = {
-                        "message_id": replied_msg.id,
-                        "content": replied_msg.content[:100] + "..." if len(replied_msg.content or "") > 100 else replied_msg.content,
-                        "sender_id": replied_sender.id if replied_sender else None,
-                        "sender_username": replied_sender.username if replied_sender else None,
-                        "sender_display_name": replied_sender.display_name if replied_sender else None
-                    }
-            
-            # Получаем реакции
-            reactions = db.query(MessageReaction).filter(
-                MessageReaction.message_id == msg.id
-            ).all()
+        # Отправляем получателю
+        if to_user_id != user.id:
+            await manager.send_to_user(to_user_id, ws_message)
             
-            reactions_summary = {}
-            for reaction in reactions:
-                if reaction.reaction not in reactions_summary:
-                    reactions_summary[reaction.reaction] = {
-                        "count": 0,
-                        "users": []
-                    }
-                reactions_summary[reaction.reaction]["count"] += 1
-                reactions_summary[reaction.reaction]["users"].append(reaction.user_id)
-            
-            messages_data.append({
-                "id": msg.id,
-                "content": msg.content,
-                "type": msg.message_type,
-                "media_url": msg.media_url,
-                "thumbnail_url": msg.thumbnail_url,
-                "media_size": msg.media_size,
-                "media_width": msg.media_width,
-                "media_height": msg.media_height,
-                "media_duration": msg.media_duration,
-                "filename": msg.filename,
-                "file_size": msg.file_size,
-                "file_type": msg.file_type,
-                "is_my_message": msg.from_user_id == user.id,
-                "is_edited": msg.is_edited,
-                "is_pinned": msg.is_pinned,
-                "is_encrypted": msg.is_encrypted,
-                "from_user_id": msg.from_user_id,
-                "to_user_id": msg.to_user_id,
-                "group_id": msg.group_id,
-                "channel_id": msg.channel_id,
-                "reply_to": reply_to_info,
-                "forwarded_from": forwarded_message_info,
-                "reactions": reactions_summary,
-                "read_by": msg.read_by or [],
-                "sender": {
-                    "id": sender.id if sender else None,
-                    "username": sender.username if sender else None,
-                    "display_name": sender.display_name if sender else None,
-                    "avatar_url": sender.avatar_url if sender else None,
-                    "is_online": sender.is_online if sender else False,
-                    "is_verified": sender.is_verified if sender else False
-                } if sender else None,
-                "created_at": msg.created_at.isoformat() if msg.created_at else None,
-                "updated_at": msg.updated_at.isoformat() if msg.updated_at else None
-            })
-        
-        messages_data.reverse()  # Чтобы старые сообщения были в начале
+    elif chat_type == "group":
+        # Отправляем всем участникам группы
+        await manager.broadcast_to_chat("group", group_id, ws_message, exclude_user_id=user.id)
         
-        # Получаем информацию о чате
-        chat_info = None
-        if chat_type == "private" and other_user:
-            # Проверяем настройки приватности
-            can_see_online = True
-            can_see_last_seen = True
-            
-            if other_user.settings and "privacy" in other_user.settings:
-                privacy = other_user.settings["privacy"]
-                
-                if privacy.get("online_status") == "contacts":
-                    # Проверяем, есть ли в контактах
-                    is_contact = db.query(Contact).filter(
-                        Contact.user_id == other_user.id,
-                        Contact.contact_id == user.id,
-                        Contact.is_blocked == False
-                    ).first() is not None
-                    can_see_online = is_contact
-                
-                if privacy.get("last_seen") == "contacts":
-                    is_contact = db.query(Contact).filter(
-                        Contact.user_id == other_user.id,
-                        Contact.contact_id == user.id,
-                        Contact.is_blocked == False
-                    ).first() is not None
-                    can_see_last_seen = is_contact
-            
-            chat_info = {
-                "type": "private",
-                "id": other_user.id,
-                "name": other_user.display_name or other_user.username,
-                "avatar_url": other_user.avatar_url,
-                "is_online": other_user.is_online if can_see_online else None,
-                "is_verified": other_user.is_verified,
-                "status": other_user.status,
-                "status_message": other_user.status_message,
-                "last_seen": other_user.last_seen.isoformat() if other_user.last_seen and can_see_last_seen else None,
-                "bio": other_user.bio
-            }
-        elif chat_type == "group" and group:
-            chat_info = {
-                "type": "group",
-                "id": group.id,
-                "name": group.name,
-                "avatar_url": group.avatar_url,
-                "banner_url": group.banner_url,
-                "description": group.description,
-                "is_public": group.is_public,
-                "is_encrypted": group.is_encrypted,
-                "owner_id": group.owner_id,
-                "members_count": group.members_count,
-                "online_count": group.online_count,
-                "settings": group.settings,
-                "pinned_message_id": group.pinned_message_id
-            }
-        elif chat_type == "channel" and channel:
-            chat_info = {
-                "type": "channel",
-                "id": channel.id,
-                "name": channel.name,
-                "avatar_url": channel.avatar_url,
-                "banner_url": channel.banner_url,
-                "description": channel.description,
-                "is_public": channel.is_public,
-                "is_verified": channel.is_verified,
-                "is_encrypted": channel.is_encrypted,
-                "owner_id": channel.owner_id,
-                "subscribers_count": channel.subscribers_count,
-                "online_count": channel.online_count,
-                "settings": channel.settings,
-                "pinned_message_id": channel.pinned_message_id
-            }
+        # Отправляем подтверждение отправителю
+        await manager.send_to_user(user.id, sent_message, exclude_connection=origin)
         
-        return {
-            "success": True,
-            "chat_info": chat_info,
-            "messages": messages_data,
-            "pagination": {
-                "page": page,
-                "limit": limit,
-                "total": total,
-                "pages": (total + limit - 1) // limit,
-                "has_more": total > page * limit
-            }
-        }
+    elif chat_type == "channel":
+        # Отправляем всем подписчикам канала
+        await manager.broadcast_to_chat("channel", channel_id, ws_message, exclude_user_id=user.id)
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"❌ Ошибка загрузки сообщений: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка загрузки сообщений: {str(e)}"
-        )
+        # Отправляем подтверждение отправителю
+        await manager.send_to_user(user.id, sent_message, exclude_connection=origin)
+    
+    return serialize_sent_message(message, chat_type, client_id)
 
 @app.post("/api/messages")
 async def create_message(
@@ -3368,408 +7144,33 @@ async def create_message(
     forwarded_from: Optional[int] = Form(None),
     forwarded_message_id: Optional[int] = Form(None),
     is_encrypted: bool = Form(False),
+    client_id: Optional[str] = Form(None),
     media: Optional[UploadFile] = None,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Создание нового сообщения"""
     try:
-        content = content.strip() if content else ""
-        media_url = None
-        media_size = None
-        media_width = None
-        media_height = None
-        media_duration = None
-        thumbnail_url = None
-        filename = None
-        file_size = None
-        file_type = None
-        
-        if not content and not media:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Сообщение не может быть пустым"
-            )
-        
-        # Проверяем получателя
-        chat_type = None
-        if to_user_id:
-            chat_type = "private"
-            recipient = db.query(User).filter(
-                User.id == to_user_id,
-                User.is_active == True
-            ).first()
-            
-            if not recipient:
-                raise HTTPException(status_code=404, detail="Получатель не найден")
-            
-            if to_user_id == user.id:
-                raise HTTPException(status_code=400, detail="Нельзя отправлять сообщения самому себе")
-            
-            # Проверяем, не заблокирован ли пользователь
-            is_blocked = db.query(Contact).filter(
-                or_(
-                    and_(Contact.user_id == user.id, Contact.contact_id == to_user_id, Contact.is_blocked == True),
-                    and_(Contact.user_id == to_user_id, Contact.contact_id == user.id, Contact.is_blocked == True)
-                )
-            ).first() is not None
-            
-            if is_blocked:
-                raise HTTPException(status_code=403, detail="Нельзя отправлять сообщения заблокированному пользователю")
-                
-        elif group_id:
-            chat_type = "group"
-            group = db.query(Group).filter(
-                Group.id == group_id,
-                Group.is_active == True
-            ).first()
-            
-            if not group:
-                raise HTTPException(status_code=404, detail="Группа не найдена")
-            
-            # Проверяем доступ
-            membership = db.query(GroupMember).filter(
-                GroupMember.group_id == group_id,
-                GroupMember.user_id == user.id,
-                GroupMember.is_banned == False
-            ).first()
-            
-            if not membership and not group.is_public:
-                raise HTTPException(status_code=403, detail="Вы не состоите в этой группе")
-            
-            # Проверяем права на отправку сообщений
-            if membership and not membership.permissions.get("send_messages", True):
-                raise HTTPException(status_code=403, detail="У вас нет прав на отправку сообщений в этой группе")
-            
-            # Проверяем slow mode
-            if group.settings and group.settings.get("slow_mode", 0) > 0:
-                # Проверяем время последнего сообщения
-                last_message = db.query(Message).filter(
-                    Message.group_id == group_id,
-                    Message.from_user_id == user.id
-                ).order_by(desc(Message.created_at)).first()
-                
-                if last_message:
-                    time_diff = (datetime.utcnow() - last_message.created_at).total_seconds()
-                    slow_mode_seconds = group.settings.get("slow_mode", 0)
-                    
-                    if time_diff < slow_mode_seconds:
-                        wait_time = slow_mode_seconds - int(time_diff)
-                        raise HTTPException(
-                            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                            detail=f"Slow mode активен. Подождите {wait_time} секунд"
-                        )
-            
-            # Проверяем, разрешено ли отправлять медиа
-            if media and group.settings:
-                media_type = media.content_type or ""
-                
-                if media_type.startswith('image/') and not group.settings.get("allow_photos", True):
-                    raise HTTPException(status_code=403, detail="Отправка фото запрещена в этой группе")
-                
-                if media_type.startswith('video/') and not group.settings.get("allow_videos", True):
-                    raise HTTPException(status_code=403, detail="Отправка видео запрещена в этой группе")
-                
-                if media_type.startswith('audio/') and not group.settings.get("allow_voice", True):
-                    raise HTTPException(status_code=403, detail="Отправка аудио запрещена в этой группе")
-                    
-        elif channel_id:
-            chat_type = "channel"
-            channel = db.query(Channel).filter(
-                Channel.id == channel_id,
-                Channel.is_active == True
-            ).first()
-            
-            if not channel:
-                raise HTTPException(status_code=404, detail="Канал не найден")
-            
-            # Проверяем доступ
-            subscription = db.query(ChannelSubscription).filter(
-                ChannelSubscription.channel_id == channel_id,
-                ChannelSubscription.user_id == user.id,
-                ChannelSubscription.is_banned == False
-            ).first()
-            
-            if not subscription and not channel.is_public:
-                raise HTTPException(status_code=403, detail="Вы не подписаны на этот канал")
-            
-            # Проверяем права на отправку сообщений (в каналах обычно только владелец и админы могут писать)
-            if channel.settings and channel.settings.get("admin_only_posting", True):
-                if user.id != channel.owner_id:
-                    if not subscription or subscription.role not in ["admin", "moderator"]:
-                        raise HTTPException(status_code=403, detail="Только администраторы могут отправлять сообщения в этот канал")
-        else:
-            raise HTTPException(status_code=400, detail="Не указан получатель")
-        
-        # Проверяем reply_to_id
-        if reply_to_id:
-            replied_message = db.query(Message).filter(
-                Message.id == reply_to_id,
-                Message.is_deleted == False
-            ).first()
-            
-            if not replied_message:
-                raise HTTPException(status_code=404, detail="Сообщение для ответа не найдено")
-            
-            # Проверяем, что сообщение находится в том же чате
-            if chat_type == "private":
-                if not (
-                    (replied_message.from_user_id == user.id and replied_message.to_user_id == to_user_id) or
-                    (replied_message.from_user_id == to_user_id and replied_message.to_user_id == user.id)
-                ):
-                    raise HTTPException(status_code=400, detail="Нельзя ответить на сообщение из другого чата")
-            elif chat_type == "group":
-                if replied_message.group_id != group_id:
-                    raise HTTPException(status_code=400, detail="Нельзя ответить на сообщение из другой группы")
-            elif chat_type == "channel":
-                if replied_message.channel_id != channel_id:
-                    raise HTTPException(status_code=400, detail="Нельзя ответить на сообщение из другого канала")
-        
-        # Обработка медиа файла
-        if media:
-            # Проверяем размер файла
-            file_size = 0
-            media.file.seek(0, 2)
-            file_size = media.file.tell()
-            media.file.seek(0)
-            
-            if file_size > MAX_UPLOAD_SIZE:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"Размер файла не должен превышать {MAX_UPLOAD_SIZE // (1024*1024)} MB"
-                )
-            
-            # Проверяем тип файла
-            mime_type = media.content_type or mimetypes.guess_type(media.filename)[0]
-            is_allowed, error_msg = FileHandler.is_allowed_file(media)
-            
-            if not is_allowed:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=error_msg
-                )
-            
-            filename = media.filename
-            file_type = FileHandler.get_file_type(mime_type)
-            
-            # Определяем тип сообщения
-            if mime_type.startswith('image/'):
-                message_type = "image"
-                subdir = "images"
-            elif mime_type.startswith('video/'):
-                message_type = "video"
-                subdir = "videos"
-            elif mime_type.startswith('audio/'):
-                message_type = "audio"
-                subdir = "audios"
-            else:
-                message_type = "file"
-                subdir = "files"
-            
-            # Генерируем уникальное имя файла
-            file_ext = media.filename.split('.')[-1] if '.' in media.filename else 'bin'
-            unique_filename = f"{uuid.uuid4()}.{file_ext}"
-            filepath = UPLOAD_DIR / subdir / unique_filename
-            
-            # Сохраняем файл
-            with open(filepath, "wb") as buffer:
-                shutil.copyfileobj(media.file, buffer)
-            
-            media_url = f"/uploads/{subdir}/{unique_filename}"
-            media_size = file_size
-            
-            # Для изображений и видео создаем миниатюру
-            if mime_type.startswith('image/'):
-                try:
-                    with Image.open(filepath) as img:
-                        media_width, media_height = img.size
-                    
-                    # Создаем миниатюру
-                    thumb_buffer = FileHandler.generate_thumbnail(filepath)
-                    if thumb_buffer:
-                        thumb_filename = f"thumb_{unique_filename}"
-                        thumb_path = UPLOAD_DIR / "thumbnails" / thumb_filename
-                        with open(thumb_path, "wb") as f:
-                            f.write(thumb_buffer.getvalue())
-                        thumbnail_url = f"/uploads/thumbnails/{thumb_filename}"
-                except Exception as e:
-                    logger.warning(f"Не удалось обработать изображение: {e}")
-            
-            elif mime_type.startswith('video/'):
-                # Для видео можно добавить извлечение информации с помощью ffmpeg
-                # Пока просто указываем тип
-                thumbnail_url = None  # Можно добавить генерацию thumbnail для видео
-            
-            # Вычисляем хеши файла
-            md5_hash, sha256_hash = FileHandler.get_file_hash(filepath)
-            
-            # Сохраняем информацию о файле в базу
-            file_record = File(
-                user_id=user.id,
-                filename=unique_filename,
-                original_filename=filename,
-                file_path=str(filepath),
-                file_url=media_url,
-                file_size=file_size,
-                file_type=file_type,
-                mime_type=mime_type,
-                width=media_width,
-                height=media_height,
-                duration=media_duration,
-                hash_md5=md5_hash,
-                hash_sha256=sha256_hash,
-                thumbnail_url=thumbnail_url,
-                is_public=(chat_type in ["group", "channel"])  # В группах и каналах файлы публичные
-            )
-            db.add(file_record)
-        
-        # Шифрование контента если нужно
-        encrypted_content = None
-        encryption_key = None
-        
-        if is_encrypted and content:
-            try:
-                encrypted_content = encryption_helper.encrypt(content)
-                encryption_key = secrets.token_urlsafe(32)
-                content = ""  # Очищаем открытый текст
-            except Exception as e:
-                logger.error(f"Ошибка шифрования: {e}")
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Ошибка шифрования сообщения"
-                )
-        
-        # Создаем сообщение
-        message = Message(
-            from_user_id=user.id,
+        data = await send_chat_message(
+            db,
+            user,
+            content=content,
+            message_type=message_type,
             to_user_id=to_user_id,
             group_id=group_id,
             channel_id=channel_id,
             reply_to_id=reply_to_id,
-            content=content,
-            encrypted_content=encrypted_content,
-            message_type=message_type,
-            media_url=media_url,
-            media_size=media_size,
-            media_width=media_width,
-            media_height=media_height,
-            media_duration=media_duration,
-            thumbnail_url=thumbnail_url,
-            filename=filename,
-            file_size=file_size,
-            file_type=file_type,
-            is_encrypted=is_encrypted,
-            encryption_key=encryption_key,
             forwarded_from=forwarded_from,
             forwarded_message_id=forwarded_message_id,
-            reactions_summary={},
-            read_by=[user.id]  # Отправитель сразу прочитал свое сообщение
+            is_encrypted=is_encrypted,
+            media=media,
+            client_id=client_id
         )
         
-        db.add(message)
-        db.commit()
-        db.refresh(message)
-        
-        # Связываем файл с сообщением если есть
-        if media and 'file_record' in locals():
-            file_record.message_id = message.id
-            db.commit()
-        
-        # Получаем информацию об отправителе
-        sender = db.query(User).filter(User.id == user.id).first()
-        
-        # Подготавливаем данные для WebSocket
-        ws_message = {
-            "type": "message",
-            "chat_type": chat_type,
-            "chat_id": to_user_id or group_id or channel_id,
-            "message": {
-                "id": message.id,
-                "content": message.content,
-                "type": message.message_type,
-                "media_url": message.media_url,
-                "thumbnail_url": message.thumbnail_url,
-                "filename": message.filename,
-                "file_size": message.file_size,
-                "file_type": message.file_type,
-                "is_my_message": False,
-                "is_edited": False,
-                "is_pinned": False,
-                "is_encrypted": message.is_encrypted,
-                "from_user_id": message.from_user_id,
-                "to_user_id": message.to_user_id,
-                "group_id": message.group_id,
-                "channel_id": message.channel_id,
-                "reply_to_id": message.reply_to_id,
-                "forwarded_from": message.forwarded_from,
-                "forwarded_message_id": message.forwarded_message_id,
-                "reactions": message.reactions_summary or {},
-                "read_by": message.read_by or [],
-                "sender": {
-                    "id": sender.id,
-                    "username": sender.username,
-                    "display_name": sender.display_name,
-                    "avatar_url": sender.avatar_url,
-                    "is_online": sender.is_online,
-                    "is_verified": sender.is_verified
-                } if sender else None,
-                "created_at": message.created_at.isoformat() if message.created_at else datetime.utcnow().isoformat(),
-                "updated_at": message.updated_at.isoformat() if message.updated_at else None
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        
-        # Отправляем через WebSocket
-        if chat_type == "private":
-            # Отправляем отправителю подтверждение
-            await manager.send_to_user(user.id, {
-                **ws_message,
-                "type": "message_sent",
-                "message_id": message.id
-            })
-            
-            # Отправляем получателю
-            if to_user_id != user.id:
-                await manager.send_to_user(to_user_id, ws_message)
-                
-        elif chat_type == "group":
-            # Отправляем всем участникам группы
-            await manager.broadcast_to_chat("group", group_id, ws_message, exclude_user_id=user.id)
-            
-            # Отправляем подтверждение отправителю
-            await manager.send_to_user(user.id, {
-                **ws_message,
-                "type": "message_sent",
-                "message_id": message.id
-            })
-            
-        elif chat_type == "channel":
-            # Отправляем всем подписчикам канала
-            await manager.broadcast_to_chat("channel", channel_id, ws_message, exclude_user_id=user.id)
-            
-            # Отправляем подтверждение отправителю
-            await manager.send_to_user(user.id, {
-                **ws_message,
-                "type": "message_sent",
-                "message_id": message.id
-            })
-        
         return {
             "success": True,
             "message": "Сообщение отправлено",
-            "data": {
-                "id": message.id,
-                "content": message.content,
-                "type": message.message_type,
-                "media_url": message.media_url,
-                "thumbnail_url": message.thumbnail_url,
-                "filename": message.filename,
-                "is_encrypted": message.is_encrypted,
-                "chat_type": chat_type,
-                "chat_id": to_user_id or group_id or channel_id,
-                "reply_to_id": message.reply_to_id,
-                "created_at": message.created_at.isoformat() if message.created_at else None
-            }
+            "data": data
         }
         
     except HTTPException:
@@ -3818,7 +7219,8 @@ async def update_message(
             "type": "message_updated",
             "message_id": message.id,
             "content": message.content,
-            "updated_at": message.updated_at.isoformat()
+            "updated_at": message.updated_at.isoformat(),
+            "seq": message.seq
         }
         
         # Определяем чат и отправляем уведомление
@@ -3826,8 +7228,7 @@ async def update_message(
             # Личное сообщение
             participants = [message.from_user_id, message.to_user_id]
             for participant in participants:
-                if participant in manager.user_connections:
-                    await manager.send_to_user(participant, ws_message)
+                await manager.send_to_user(participant, ws_message)
         elif message.group_id:
             # Групповое сообщение
             await manager.broadcast_to_chat("group", message.group_id, ws_message)
@@ -3926,7 +7327,8 @@ async def delete_message(
             ws_message = {
                 "type": "message_deleted",
                 "message_id": message.id,
-                "for_everyone": True
+                "for_everyone": True,
+                "seq": message.seq
             }
             
             # Определяем чат и отправляем уведомление
@@ -3934,8 +7336,7 @@ async def delete_message(
                 # Личное сообщение
                 participants = [message.from_user_id, message.to_user_id]
                 for participant in participants:
-                    if participant in manager.user_connections:
-                        await manager.send_to_user(participant, ws_message)
+                    await manager.send_to_user(participant, ws_message)
             elif message.group_id:
                 # Групповое сообщение
                 await manager.broadcast_to_chat("group", message.group_id, ws_message)
@@ -3996,15 +7397,18 @@ async def mark_message_as_read(
         
         if not has_access:
             raise HTTPException(status_code=403, detail="Нет доступа к сообщению")
-        
+
+        # Сдвигаем отметку прочтения чата в списке чатов пользователя
+        mark_dialog_read(db, user.id, message)
+
         # Добавляем пользователя в список прочитавших
         if not message.read_by:
             message.read_by = []
-        
+
         if user.id not in message.read_by:
             message.read_by.append(user.id)
             db.commit()
-            
+
             # Уведомляем отправителя о прочтении (для личных сообщений)
             if message.to_user_id and message.from_user_id != user.id:
                 ws_message = {
@@ -4014,8 +7418,7 @@ async def mark_message_as_read(
                     "timestamp": datetime.utcnow().isoformat()
                 }
                 
-                if message.from_user_id in manager.user_connections:
-                    await manager.send_to_user(message.from_user_id, ws_message)
+                await manager.send_to_user(message.from_user_id, ws_message)
         
         return {
             "success": True,
@@ -4136,6 +7539,7 @@ async def add_message_reaction(
             "user_id": user.id,
             "reaction": reaction,
             "action": action,
+            "seq": message.seq,
             "timestamp": datetime.utcnow().isoformat()
         }
         
@@ -4144,8 +7548,7 @@ async def add_message_reaction(
             # Личное сообщение
             participants = [message.from_user_id, message.to_user_id]
             for participant in participants:
-                if participant in manager.user_connections:
-                    await manager.send_to_user(participant, ws_message)
+                await manager.send_to_user(participant, ws_message)
         elif message.group_id:
             # Групповое сообщение
             await manager.broadcast_to_chat("group", message.group_id, ws_message)
@@ -4249,6 +7652,7 @@ async def pin_message(
             "type": "message_pinned",
             "message_id": message.id,
             "pinned_by": user.id,
+            "seq": message.seq,
             "timestamp": datetime.utcnow().isoformat()
         }
         
@@ -4343,6 +7747,7 @@ async def unpin_message(
             "type": "message_unpinned",
             "message_id": message.id,
             "unpinned_by": user.id,
+            "seq": message.seq,
             "timestamp": datetime.utcnow().isoformat()
         }
         
@@ -4771,24 +8176,7 @@ async def get_group_by_id(
             Message.is_deleted == False
         ).order_by(desc(Message.created_at)).limit(20).all()
         
-        messages_data = []
-        for msg in last_messages:
-            sender = db.query(User).filter(User.id == msg.from_user_id).first()
-            messages_data.append({
-                "id": msg.id,
-                "content": msg.content,
-                "type": msg.message_type,
-                "media_url": msg.media_url,
-                "is_my_message": msg.from_user_id == user.id,
-                "sender": {
-                    "id": sender.id if sender else None,
-                    "username": sender.username if sender else None,
-                    "display_name": sender.display_name if sender else None,
-                    "avatar_url": sender.avatar_url if sender else None
-                } if sender else None,
-                "created_at": msg.created_at.isoformat() if msg.created_at else None
-            })
-        
+        messages_data = serialize_messages(db, last_messages, user.id)
         messages_data.reverse()
         
         # Считаем количество онлайн участников
@@ -5092,6 +8480,7 @@ async def join_group(
         group.members_count += 1
         group.updated_at = datetime.utcnow()
         db.commit()
+        manager.chat_members.add_member("group", group_id, user.id)
         
         # Создаем системное сообщение о вступлении
         system_message = Message(
@@ -5203,6 +8592,7 @@ async def leave_group(
         db.add(system_message)
         
         db.commit()
+        manager.chat_members.remove_member("group", group_id, user.id)
         
         # Уведомляем участников группы
         ws_message = {
@@ -5628,6 +9018,7 @@ async def ban_group_member(
         group.updated_at = datetime.utcnow()
         
         db.commit()
+        manager.chat_members.remove_member("group", group_id, member_id)
         
         # Создаем системное сообщение
         target_user = db.query(User).filter(User.id == member_id).first()
@@ -5737,6 +9128,7 @@ async def unban_group_member(
         group.updated_at = datetime.utcnow()
         
         db.commit()
+        manager.chat_members.add_member("group", group_id, member_id)
         
         # Создаем системное сообщение
         target_user = db.query(User).filter(User.id == member_id).first()
@@ -5936,6 +9328,7 @@ async def delete_group(
         }
         
         await manager.broadcast_to_chat("group", group_id, ws_message)
+        manager.chat_members.invalidate("group", group_id)
         
         return {
             "success": True,
@@ -6327,23 +9720,7 @@ async def get_channel_by_id(
             Message.is_deleted == False
         ).order_by(desc(Message.created_at)).limit(20).all()
         
-        messages_data = []
-        for msg in last_messages:
-            sender = db.query(User).filter(User.id == msg.from_user_id).first()
-            messages_data.append({
-                "id": msg.id,
-                "content": msg.content,
-                "type": msg.message_type,
-                "media_url": msg.media_url,
-                "sender": {
-                    "id": sender.id if sender else None,
-                    "username": sender.username if sender else None,
-                    "display_name": sender.display_name if sender else None,
-                    "avatar_url": sender.avatar_url if sender else None
-                } if sender else None,
-                "created_at": msg.created_at.isoformat() if msg.created_at else None
-            })
-        
+        messages_data = serialize_messages(db, last_messages, user.id)
         messages_data.reverse()
         
         # Считаем количество онлайн подписчиков
@@ -6650,6 +10027,7 @@ async def subscribe_to_channel(
         channel.subscribers_count += 1
         channel.updated_at = datetime.utcnow()
         db.commit()
+        manager.chat_members.add_member("channel", channel_id, user.id)
         
         # Создаем системное сообщение о подписке
         system_message = Message(
@@ -6674,7 +10052,7 @@ async def subscribe_to_channel(
             "timestamp": datetime.utcnow().isoformat()
         }
         
-        if channel.owner_id in manager.user_connections:
+        if manager.is_user_online(channel.owner_id):
             await manager.send_to_user(channel.owner_id, ws_message)
         
         # Отправляем информацию о канале новому подписчику
@@ -6762,6 +10140,7 @@ async def unsubscribe_from_channel(
         db.add(system_message)
         
         db.commit()
+        manager.chat_members.remove_member("channel", channel_id, user.id)
         
         # Уведомляем владельца канала
         ws_message = {
@@ -6771,7 +10150,7 @@ async def unsubscribe_from_channel(
             "timestamp": datetime.utcnow().isoformat()
         }
         
-        if channel.owner_id in manager.user_connections:
+        if manager.is_user_online(channel.owner_id):
             await manager.send_to_user(channel.owner_id, ws_message)
         
         return {
@@ -7136,6 +10515,7 @@ async def ban_channel_subscriber(
         channel.updated_at = datetime.utcnow()
         
         db.commit()
+        manager.chat_members.remove_member("channel", channel_id, subscriber_id)
         
         # Создаем системное сообщение
         target_user = db.query(User).filter(User.id == subscriber_id).first()
@@ -7240,6 +10620,7 @@ async def unban_channel_subscriber(
         channel.updated_at = datetime.utcnow()
         
         db.commit()
+        manager.chat_members.add_member("channel", channel_id, subscriber_id)
         
         # Создаем системное сообщение
         target_user = db.query(User).filter(User.id == subscriber_id).first()
@@ -7431,6 +10812,7 @@ async def delete_channel(
         }
         
         await manager.broadcast_to_chat("channel", channel_id, ws_message)
+        manager.chat_members.invalidate("channel", channel_id)
         
         return {
             "success": True,
@@ -7447,96 +10829,94 @@ async def delete_channel(
             detail=f"Ошибка удаления канала: {str(e)}"
         )
 
+# ========== СПИСОК ЧАТОВ БЕЗ DIALOG_SUMMARIES ==========
+# Запасной путь для /api/chats/all (CHAT_LIST_SOURCE=window), запросы - в chat_list_queries.py
+
+chat_list_queries = ChatListQueries(Message, GroupMember, ChannelSubscription, DialogSummary, DIALOG_PREVIEW_LENGTH)
+
 # ========== ЧАТЫ ==========
 
-@app.get("/api/chats/all")
-async def get_all_chats(
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    """Получение всех чатов пользователя"""
-    try:
-        all_chats = []
-        
-        # Личные чаты (пользователи, с которыми есть переписка)
-        private_chats = []
-        
-        # Получаем пользователей, с которыми есть переписка
-        chat_partners_query = db.query(Message.from_user_id).filter(
-            Message.to_user_id == user.id,
-            Message.is_deleted == False
-        ).union(
-            db.query(Message.to_user_id).filter(
-                Message.from_user_id == user.id,
-                Message.is_deleted == False
-            )
-        ).distinct()
-        
-        chat_partners = [row[0] for row in chat_partners_query.all() if row[0] is not None]
-        
-        for partner_id in chat_partners:
-            if partner_id == user.id:
-                continue
-                
-            partner = db.query(User).filter(
-                User.id == partner_id,
+def build_dialog_entries(db: Session, user_id: int, summaries: List["DialogSummary"]) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Элементы списка чатов по строкам dialog_summaries (собеседники, группы и каналы догружаются пачками)"""
+    ids_by_type = {"private": set(), "group": set(), "channel": set()}
+    for summary in summaries:
+        if summary.chat_type in ids_by_type:
+            ids_by_type[summary.chat_type].add(summary.chat_id)
+    ids_by_type["private"].discard(user_id)
+    
+    partners = {}
+    blocked_ids = set()
+    contact_of_ids = set()
+    if ids_by_type["private"]:
+        partner_ids = list(ids_by_type["private"])
+        partners = {
+            partner.id: partner for partner in db.query(User).filter(
+                User.id.in_(partner_ids),
                 User.is_active == True
-            ).first()
-            
-            if not partner:
-                continue
-            
-            # Проверяем, не заблокирован ли пользователь
-            is_blocked = db.query(Contact).filter(
-                Contact.user_id == user.id,
-                Contact.contact_id == partner_id,
+            ).all()
+        }
+        blocked_ids = {
+            contact_id for (contact_id,) in db.query(Contact.contact_id).filter(
+                Contact.user_id == user_id,
+                Contact.contact_id.in_(partner_ids),
                 Contact.is_blocked == True
-            ).first() is not None
-            
-            if is_blocked:
+            ).all()
+        }
+        # Собеседники, у которых пользователь в контактах (для настроек приватности)
+        contact_of_ids = {
+            owner_id for (owner_id,) in db.query(Contact.user_id).filter(
+                Contact.user_id.in_(partner_ids),
+                Contact.contact_id == user_id,
+                Contact.is_blocked == False
+            ).all()
+        }
+    
+    groups = {}
+    if ids_by_type["group"]:
+        groups = {
+            group.id: group for group in db.query(Group).filter(
+                Group.id.in_(list(ids_by_type["group"])),
+                Group.is_active == True
+            ).all()
+        }
+    
+    channels = {}
+    if ids_by_type["channel"]:
+        channels = {
+            channel.id: channel for channel in db.query(Channel).filter(
+                Channel.id.in_(list(ids_by_type["channel"])),
+                Channel.is_active == True
+            ).all()
+        }
+    
+    entries = []
+    stats = {"private": 0, "groups": 0, "channels": 0}
+    
+    for summary in summaries:
+        last_message = dialog_last_message(summary.chat_type, user_id, {
+            "message_id": summary.last_message_id,
+            "preview": summary.last_message_preview,
+            "message_type": summary.last_message_type,
+            "sender_id": summary.last_message_sender_id,
+            "created_at": summary.last_message_at
+        })
+        
+        if summary.chat_type == "private":
+            partner = partners.get(summary.chat_id)
+            # Личный чат без сообщений не показываем, как и раньше
+            if not partner or partner.id in blocked_ids or last_message is None:
                 continue
             
-            # Получаем последнее сообщение
-            last_message = db.query(Message).filter(
-                or_(
-                    and_(Message.from_user_id == user.id, Message.to_user_id == partner_id),
-                    and_(Message.from_user_id == partner_id, Message.to_user_id == user.id)
-                ),
-                Message.is_deleted == False
-            ).order_by(desc(Message.created_at)).first()
-            
-            # Считаем непрочитанные сообщения
-            unread_count = db.query(Message).filter(
-                Message.from_user_id == partner_id,
-                Message.to_user_id == user.id,
-                Message.is_deleted == False
-            ).count()  # В реальном приложении нужно хранить статус прочтения
-            
-            # Проверяем настройки приватности партнера
             can_see_online = True
             can_see_last_seen = True
-            
-            if partner.settings and "privacy" in partner.settings:
-                privacy = partner.settings["privacy"]
-                
+            privacy = (partner.settings or {}).get("privacy")
+            if isinstance(privacy, dict):
                 if privacy.get("online_status") == "contacts":
-                    # Проверяем, есть ли в контактах
-                    is_contact = db.query(Contact).filter(
-                        Contact.user_id == partner.id,
-                        Contact.contact_id == user.id,
-                        Contact.is_blocked == False
-                    ).first() is not None
-                    can_see_online = is_contact
-                
+                    can_see_online = partner.id in contact_of_ids
                 if privacy.get("last_seen") == "contacts":
-                    is_contact = db.query(Contact).filter(
-                        Contact.user_id == partner.id,
-                        Contact.contact_id == user.id,
-                        Contact.is_blocked == False
-                    ).first() is not None
-                    can_see_last_seen = is_contact
+                    can_see_last_seen = partner.id in contact_of_ids
             
-            private_chats.append({
+            chat = {
                 "id": partner.id,
                 "type": "private",
                 "name": partner.display_name or partner.username,
@@ -7544,129 +10924,106 @@ async def get_all_chats(
                 "is_online": partner.is_online if can_see_online else None,
                 "is_verified": partner.is_verified,
                 "last_seen": partner.last_seen.isoformat() if partner.last_seen and can_see_last_seen else None,
-                "last_message": {
-                    "content": last_message.content if last_message else None,
-                    "type": last_message.message_type if last_message else None,
-                    "timestamp": last_message.created_at.isoformat() if last_message else None,
-                    "is_my_message": last_message.from_user_id == user.id if last_message else False
-                } if last_message else None,
-                "unread_count": unread_count
-            })
-        
-        # Групповые чаты
-        group_chats = []
-        user_groups = db.query(Group).join(GroupMember).filter(
-            GroupMember.user_id == user.id,
-            GroupMember.is_banned == False,
-            Group.is_active == True
-        ).all()
-        
-        for group in user_groups:
-            last_message = db.query(Message).filter(
-                Message.group_id == group.id,
-                Message.is_deleted == False
-            ).order_by(desc(Message.created_at)).first()
-            
-            # Считаем количество непрочитанных сообщений
-            membership = db.query(GroupMember).filter(
-                GroupMember.group_id == group.id,
-                GroupMember.user_id == user.id
-            ).first()
-            
-            last_read_id = membership.last_message_read_id if membership else 0
-            unread_count = db.query(Message).filter(
-                Message.group_id == group.id,
-                Message.id > last_read_id,
-                Message.is_deleted == False
-            ).count()
+                "last_message": last_message,
+                "unread_count": summary.unread_count
+            }
+            stats["private"] += 1
+        elif summary.chat_type == "group":
+            group = groups.get(summary.chat_id)
+            if not group:
+                continue
             
-            group_chats.append({
+            chat = {
                 "id": group.id,
                 "type": "group",
                 "name": group.name,
                 "avatar_url": group.avatar_url,
                 "members_count": group.members_count,
                 "online_count": group.online_count,
-                "last_message": {
-                    "content": last_message.content if last_message else None,
-                    "type": last_message.message_type if last_message else None,
-                    "timestamp": last_message.created_at.isoformat() if last_message else None,
-                    "sender_id": last_message.from_user_id if last_message else None
-                } if last_message else None,
-                "unread_count": unread_count,
+                "last_message": last_message,
+                "unread_count": summary.unread_count,
                 "is_encrypted": group.is_encrypted,
                 "is_public": group.is_public
-            })
-        
-        # Каналы
-        channel_chats = []
-        user_channels = db.query(Channel).join(ChannelSubscription).filter(
-            ChannelSubscription.user_id == user.id,
-            ChannelSubscription.is_banned == False,
-            Channel.is_active == True
-        ).all()
-        
-        for channel in user_channels:
-            last_message = db.query(Message).filter(
-                Message.channel_id == channel.id,
-                Message.is_deleted == False
-            ).order_by(desc(Message.created_at)).first()
-            
-            # Считаем количество непрочитанных сообщений
-            subscription = db.query(ChannelSubscription).filter(
-                ChannelSubscription.channel_id == channel.id,
-                ChannelSubscription.user_id == user.id
-            ).first()
-            
-            last_read_id = subscription.last_message_read_id if subscription else 0
-            unread_count = db.query(Message).filter(
-                Message.channel_id == channel.id,
-                Message.id > last_read_id,
-                Message.is_deleted == False
-            ).count()
+            }
+            stats["groups"] += 1
+        elif summary.chat_type == "channel":
+            channel = channels.get(summary.chat_id)
+            if not channel:
+                continue
             
-            channel_chats.append({
+            chat = {
                 "id": channel.id,
                 "type": "channel",
                 "name": channel.name,
                 "avatar_url": channel.avatar_url,
                 "subscribers_count": channel.subscribers_count,
                 "online_count": channel.online_count,
-                "last_message": {
-                    "content": last_message.content if last_message else None,
-                    "type": last_message.message_type if last_message else None,
-                    "timestamp": last_message.created_at.isoformat() if last_message else None
-                } if last_message else None,
-                "unread_count": unread_count,
+                "last_message": last_message,
+                "unread_count": summary.unread_count,
                 "is_encrypted": channel.is_encrypted,
                 "is_public": channel.is_public,
                 "is_verified": channel.is_verified
-            })
+            }
+            stats["channels"] += 1
+        else:
+            continue
         
-        # Объединяем все чаты
-        all_chats = private_chats + group_chats + channel_chats
+        chat["unread_badge"] = unread_badge(summary.unread_count)
+        chat["is_muted"] = bool(summary.is_muted)
+        chat["is_pinned"] = bool(summary.is_pinned)
+        entries.append(chat)
+    
+    return entries, stats
+
+def load_dialog_entries(keys: List[Tuple[int, str, int]]) -> Dict[Tuple[int, str, int], Dict[str, Any]]:
+    """Полные элементы списка для новых чатов (кадр dialog_updated с added)"""
+    db = SessionLocal()
+    try:
+        keys_by_user: Dict[int, Set[Tuple[str, int]]] = {}
+        for user_id, chat_type, chat_id in keys:
+            keys_by_user.setdefault(user_id, set()).add((chat_type, chat_id))
+        
+        entries = {}
+        for user_id, chats in keys_by_user.items():
+            summaries = [
+                summary for summary in db.query(DialogSummary).filter(
+                    DialogSummary.user_id == user_id,
+                    DialogSummary.chat_id.in_([chat_id for _, chat_id in chats])
+                ).all()
+                if (summary.chat_type, summary.chat_id) in chats
+            ]
+            for entry in build_dialog_entries(db, user_id, summaries)[0]:
+                entries[(user_id, entry["type"], entry["id"])] = entry
+        return entries
+    finally:
+        db.close()
+
+@app.get("/api/chats/all")
+async def get_all_chats(
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Получение всех чатов пользователя (одно чтение списка чатов + пакетная догрузка)"""
+    try:
+        if CHAT_LIST_SOURCE == "window":
+            summaries = chat_list_queries.load_rows(db, user.id)
+        else:
+            # Строки списка в порядке последнего сообщения (индекс user_id, last_message_at)
+            summaries = db.query(DialogSummary).filter(
+                DialogSummary.user_id == user.id
+            ).order_by(desc(DialogSummary.last_message_at), desc(DialogSummary.id)).all()
         
-        # Сортируем по времени последнего сообщения
-        def get_chat_timestamp(chat):
-            if chat.get('last_message') and chat['last_message'].get('timestamp'):
-                try:
-                    return datetime.fromisoformat(chat['last_message']['timestamp'].replace('Z', '+00:00'))
-                except:
-                    return datetime.min
-            return datetime.min
+        entries, stats = build_dialog_entries(db, user.id, summaries)
         
-        all_chats.sort(key=get_chat_timestamp, reverse=True)
+        # Закрепленные чаты - сверху, остальные по времени последнего сообщения
+        all_chats = sorted(entries, key=lambda chat: not chat["is_pinned"])
         
-        return {
+        return FastJSONResponse({
             "success": True,
             "chats": all_chats,
             "count": len(all_chats),
-            "stats": {
-                "private": len(private_chats),
-                "groups": len(group_chats),
-                "channels": len(channel_chats)
-            }
-        }
+            "stats": stats
+        })
         
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки чатов: {str(e)}")
@@ -7675,6 +11032,51 @@ async def get_all_chats(
             detail=f"Ошибка загрузки чатов: {str(e)}"
         )
 
+@app.put("/api/chats/{chat_type}/{chat_id}/dialog")
+async def update_dialog_settings(
+    chat_type: str,
+    chat_id: int,
+    is_muted: Optional[bool] = Form(None),
+    is_pinned: Optional[bool] = Form(None),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Отключение уведомлений и закрепление чата в списке чатов"""
+    try:
+        summary = db.query(DialogSummary).filter(
+            DialogSummary.user_id == user.id,
+            DialogSummary.chat_type == chat_type,
+            DialogSummary.chat_id == chat_id
+        ).first()
+        
+        if not summary:
+            raise HTTPException(status_code=404, detail="Чат не найден в списке чатов")
+        
+        if is_muted is not None:
+            summary.is_muted = is_muted
+        if is_pinned is not None:
+            summary.is_pinned = is_pinned
+        summary.updated_at = datetime.utcnow()
+        db.commit()
+        
+        return {
+            "success": True,
+            "chat_type": summary.chat_type,
+            "chat_id": summary.chat_id,
+            "is_muted": summary.is_muted,
+            "is_pinned": summary.is_pinned
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Ошибка обновления настроек чата: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Ошибка обновления настроек чата: {str(e)}"
+        )
+
 @app.get("/api/chats/search")
 async def search_chats(
     query: str = Query(..., min_length=1),
@@ -8492,8 +11894,7 @@ async def vote_in_poll(
             # Личное сообщение
             participants = [message.from_user_id, message.to_user_id]
             for participant in participants:
-                if participant in manager.user_connections:
-                    await manager.send_to_user(participant, ws_message)
+                await manager.send_to_user(participant, ws_message)
         elif message.group_id:
             # Групповое сообщение
             await manager.broadcast_to_chat("group", message.group_id, ws_message)
@@ -8567,8 +11968,7 @@ async def close_poll(
             # Личное сообщение
             participants = [message.from_user_id, message.to_user_id]
             for participant in participants:
-                if participant in manager.user_connections:
-                    await manager.send_to_user(participant, ws_message)
+                await manager.send_to_user(participant, ws_message)
         elif message.group_id:
             # Групповое сообщение
             await manager.broadcast_to_chat("group", message.group_id, ws_message)
@@ -9068,18 +12468,22 @@ async def websocket_endpoint(
     websocket: WebSocket,
     user_id: int,
     token: Optional[str] = None,
-    device_id: Optional[str] = None
+    device_id: Optional[str] = None,
+    last_event_id: Optional[str] = None
 ):
-    """WebSocket endpoint для реального времени"""
-    # Проверяем авторизацию
-    db = SessionLocal()
+    """WebSocket endpoint для реального времени (last_event_id - повтор пропущенных событий)"""
+    # Проверяем авторизацию; сессия БД нужна только на время проверки
     try:
-        user = db.query(User).filter(
-            User.id == user_id,
-            User.is_active == True
-        ).first()
+        db = SessionLocal()
+        try:
+            user_exists = db.query(User.id).filter(
+                User.id == user_id,
+                User.is_active == True
+            ).first() is not None
+        finally:
+            db.close()
         
-        if not user:
+        if not user_exists:
             await websocket.close(code=1008)
             return
         
@@ -9090,86 +12494,168 @@ async def websocket_endpoint(
                 await websocket.close(code=1008)
                 return
         
+        # Бинарный протокол включается, только если клиент сам его запросил
+        subprotocol = None
+        if msgpack is not None and WS_MSGPACK_PROTOCOL in websocket.scope.get("subprotocols", []):
+            subprotocol = WS_MSGPACK_PROTOCOL
+        
         # Подключаем пользователя
-        await manager.connect(websocket, user_id, device_id)
+        await manager.connect(websocket, user_id, device_id, subprotocol, last_event_id)
         
         try:
+            # Обработчики сами открывают короткую сессию, если им нужна БД
             while True:
-                data = await websocket.receive_json()
-                await handle_websocket_message(data, user_id, db)
+                data = await receive_ws_message(websocket)
+                manager.touch(websocket)
+                await handle_websocket_message(data, user_id, websocket)
                 
         except WebSocketDisconnect:
             logger.info(f"📴 User disconnected: {user_id}")
-            manager.disconnect(websocket)
+            await manager.disconnect(websocket)
         except Exception as e:
             logger.error(f"❌ WebSocket error: {e}")
-            manager.disconnect(websocket)
+            await manager.disconnect(websocket)
     except Exception as e:
         logger.error(f"❌ WebSocket auth error: {e}")
         await websocket.close(code=1011)
-    finally:
-        db.close()
 
-async def handle_websocket_message(data: Dict[str, Any], user_id: int, db: Session):
+async def receive_ws_message(websocket: WebSocket) -> Dict[str, Any]:
+    """Чтение кадра: текстовый - JSON, бинарный - devnet.msgpack.v1"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    
+    if message.get("bytes") is not None:
+        if msgpack is None:
+            raise ValueError("Binary frames are not supported")
+        return expand_ws_payload(msgpack.unpackb(message["bytes"], raw=False))
+    
+    return json.loads(message["text"])
+
+async def handle_websocket_message(data: Dict[str, Any], user_id: int, websocket: Optional[WebSocket] = None):
     """Обработка сообщений WebSocket"""
     message_type = data.get("type")
     
     if message_type == "typing":
-        await handle_typing_indicator(data, user_id, db)
+        await handle_typing_indicator(data, user_id)
     elif message_type == "ping":
         # Ответ на ping
         await manager.send_to_user(user_id, {"type": "pong", "timestamp": datetime.utcnow().isoformat()})
+    elif message_type == "send_message":
+        await handle_send_message(data, user_id, websocket)
+    elif message_type == "presence_subscribe":
+        # Статусы пользователей, которых клиент сейчас показывает
+        if websocket is not None:
+            await manager.subscribe_presence(websocket, data.get("user_ids") or [])
     elif message_type == "call_offer":
-        await handle_call_offer(data, user_id, db)
+        await handle_call_offer(data, user_id)
     elif message_type == "call_answer":
-        await handle_call_answer(data, user_id, db)
+        await handle_call_answer(data, user_id)
     elif message_type == "ice_candidate":
         await handle_ice_candidate(data, user_id)
     elif message_type == "call_end":
-        await handle_call_end(data, user_id, db)
+        await handle_call_end(data, user_id)
     else:
         logger.warning(f"⚠️ Unknown WebSocket message type: {message_type}")
 
-async def handle_typing_indicator(data: Dict[str, Any], user_id: int, db: Session):
+async def handle_send_message(data: Dict[str, Any], user_id: int, websocket: Optional[WebSocket]):
+    """Отправка сообщения через WebSocket; результат - кадр message_ack в это же соединение"""
+    client_id = data.get("client_id")
+    ack: Dict[str, Any] = {"type": "message_ack", "client_id": client_id}
+    
+    def as_int(value):
+        return int(value) if value not in (None, "") else None
+    
+    db = SessionLocal()
+    try:
+        # Тот же лимит, что и для HTTP запросов, но по пользователю, а не по IP
+        allowed, wait_time = rate_limiter.is_allowed(f"ws_send_{user_id}")
+        if not allowed:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"Слишком много запросов. Попробуйте через {wait_time} секунд"
+            )
+        
+        user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
+        if not user:
+            raise HTTPException(status_code=401, detail="Пользователь не найден")
+        
+        result = await send_chat_message(
+            db,
+            user,
+            content=data.get("content"),
+            message_type=data.get("message_type") or "text",
+            to_user_id=as_int(data.get("to_user_id")),
+            group_id=as_int(data.get("group_id")),
+            channel_id=as_int(data.get("channel_id")),
+            reply_to_id=as_int(data.get("reply_to_id")),
+            forwarded_from=as_int(data.get("forwarded_from")),
+            forwarded_message_id=as_int(data.get("forwarded_message_id")),
+            is_encrypted=bool(data.get("is_encrypted", False)),
+            client_id=str(client_id) if client_id is not None else None,
+            origin=websocket
+        )
+        ack.update({"ok": True, "message_id": result["id"], "message": result})
+    except HTTPException as e:
+        db.rollback()
+        ack.update({"ok": False, "status": e.status_code, "error": e.detail})
+    except (TypeError, ValueError):
+        ack.update({"ok": False, "status": 400, "error": "Некорректные параметры сообщения"})
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Ошибка отправки сообщения через WebSocket: {e}")
+        ack.update({"ok": False, "status": 500, "error": "Ошибка отправки сообщения"})
+    finally:
+        db.close()
+    
+    ack["timestamp"] = datetime.utcnow().isoformat()
+    if websocket is not None:
+        await manager.send_to_connection(websocket, ack)
+    else:
+        await manager.send_to_user(user_id, ack)
+
+async def handle_typing_indicator(data: Dict[str, Any], user_id: int):
     """Обработка индикатора набора текста"""
     chat_type = data.get("chat_type")
-    chat_id = data.get("chat_id")
     is_typing = data.get("is_typing", True)
     
-    # Проверяем доступ к чату
-    has_access = False
+    try:
+        chat_id = int(data.get("chat_id"))
+    except (TypeError, ValueError):
+        return
     
-    if chat_type == "private":
-        # Проверяем, не заблокирован ли пользователь
-        is_blocked = db.query(Contact).filter(
-            Contact.user_id == chat_id,
-            Contact.contact_id == user_id,
-            Contact.is_blocked == True
-        ).first() is not None
+    if is_typing:
+        # Уже печатает и рассылка была недавно - только продлеваем, доступ проверен ранее
+        if manager.refresh_typing(user_id, chat_type, chat_id):
+            return
         
-        if not is_blocked:
-            has_access = True
-    elif chat_type == "group":
-        membership = db.query(GroupMember).filter(
-            GroupMember.group_id == chat_id,
-            GroupMember.user_id == user_id,
-            GroupMember.is_banned == False
-        ).first()
-        has_access = membership is not None
-    elif chat_type == "channel":
-        subscription = db.query(ChannelSubscription).filter(
-            ChannelSubscription.channel_id == chat_id,
-            ChannelSubscription.user_id == user_id,
-            ChannelSubscription.is_banned == False
-        ).first()
-        has_access = subscription is not None
-    
-    if not has_access:
-        return
+        # Проверяем доступ к чату
+        has_access = False
+        
+        if chat_type == "private":
+            # Проверяем, не заблокирован ли пользователь
+            db = SessionLocal()
+            try:
+                is_blocked = db.query(Contact.id).filter(
+                    Contact.user_id == chat_id,
+                    Contact.contact_id == user_id,
+                    Contact.is_blocked == True
+                ).first() is not None
+            finally:
+                db.close()
+            
+            if not is_blocked:
+                has_access = True
+        elif chat_type in ("group", "channel"):
+            # Индекс участников содержит только незабаненных
+            has_access = user_id in await manager.chat_members.get_members(chat_type, chat_id)
+        
+        if not has_access:
+            return
     
     await manager.update_typing_indicator(user_id, chat_type, chat_id, is_typing)
 
-async def handle_call_offer(data: Dict[str, Any], user_id: int, db: Session):
+async def handle_call_offer(data: Dict[str, Any], user_id: int):
     """Обработка предложения звонка"""
     call_type = data.get("call_type", "audio")
     to_user_id = data.get("to_user_id")
@@ -9222,7 +12708,7 @@ async def handle_call_offer(data: Dict[str, Any], user_id: int, db: Session):
         # Отправляем всем подписчикам канала кроме инициатора
         await manager.broadcast_to_chat("channel", channel_id, call_message, exclude_user_id=user_id)
 
-async def handle_call_answer(data: Dict[str, Any], user_id: int, db: Session):
+async def handle_call_answer(data: Dict[str, Any], user_id: int):
     """Обработка ответа на звонок"""
     call_id = data.get("call_id")
     answer = data.get("answer")
@@ -9267,7 +12753,7 @@ async def handle_ice_candidate(data: Dict[str, Any], user_id: int):
         if participant_id != user_id:
             await manager.send_to_user(participant_id, ice_message)
 
-async def handle_call_end(data: Dict[str, Any], user_id: int, db: Session):
+async def handle_call_end(data: Dict[str, Any], user_id: int):
     """Обработка завершения звонка"""
     call_id = data.get("call_id")
     reason = data.get("reason", "ended")
@@ -9277,6 +12763,7 @@ async def handle_call_end(data: Dict[str, Any], user_id: int, db: Session):
         return
     
     # Создаем запись о звонке в базе данных
+    db = SessionLocal()
     try:
         call_log = CallLog(
             call_id=call_id,
@@ -9301,7 +12788,10 @@ async def handle_call_end(data: Dict[str, Any], user_id: int, db: Session):
         db.add(call_log)
         db.commit()
     except Exception as e:
+        db.rollback()
         logger.error(f"Ошибка сохранения лога звонка: {e}")
+    finally:
+        db.close()
     
     # Отправляем уведомление о завершении звонка
     end_message = {
@@ -9681,10 +13171,13 @@ if __name__ == "__main__":
     print("   - GET  /api/channels        - Каналы")
     print("=" * 60)
     
+    from ws_server import DeflateWebSocketProtocol
+    
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
         reload=not IS_PRODUCTION,
-        log_level="info"
+        log_level="info",
+        ws=DeflateWebSocketProtocol
             )
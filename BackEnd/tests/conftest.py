@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# main.py создает базу, папку uploads и лог при импорте - уводим их во временную папку
+WORK_DIR = Path(tempfile.mkdtemp(prefix="devnet-tests-"))
+os.environ["DATABASE_URL"] = f"sqlite:///{WORK_DIR / 'devnet.db'}"
+os.environ["BACKPLANE_URL"] = ""
+os.environ["UNREAD_RECONCILE_INTERVAL"] = "0"
+os.chdir(WORK_DIR)
+sys.path.insert(0, str(BACKEND_DIR))
+
+
+@pytest.fixture(scope="session")
+def main():
+    import main as app_module
+    app_module.rate_limiter.max_requests = 10 ** 9
+    return app_module
+
+
+@pytest.fixture
+def db(main):
+    session = main.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def login(main):
+    """Клиент, вошедший под тестовым пользователем (пароль - имя + "123")"""
+    from fastapi.testclient import TestClient
+
+    def login_as(username):
+        client = TestClient(main.app)
+        response = client.post("/api/login", json={"username": username, "password": username + "123"})
+        assert response.status_code == 200, response.text
+        return client, response.json()["user"]
+    return login_as
+
+
+@pytest.fixture
+def count_queries(main):
+    """Контекстный менеджер, собирающий SQL, выполненный внутри блока"""
+    from sqlalchemy import event
+
+    @contextmanager
+    def counter():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(main.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(main.engine, "before_cursor_execute", before_cursor_execute)
+    return counter
@@ -0,0 +1,206 @@
+"""Доставка между воркерами: два процесса uvicorn с общей базой и backplane"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+from cryptography.fernet import Fernet
+from websockets.sync.client import connect
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+class RespStandIn:
+    """Заменитель Redis для тестов: AUTH, PING, SUBSCRIBE и PUBLISH по протоколу RESP"""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.port = None
+        self.published = 0
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, "127.0.0.1", 0), self.loop
+        ).result(5)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+    @staticmethod
+    def encode(*parts):
+        chunks = [b"*%d\r\n" % len(parts)]
+        for part in parts:
+            chunks.append(b"$%d\r\n%s\r\n" % (len(part), part))
+        return b"".join(chunks)
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        assert line[:1] == b"*", line
+        parts = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            parts.append((await reader.readexactly(length + 2))[:-2])
+        return parts
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                command = await self.read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper()
+                if name in (b"AUTH", b"PING"):
+                    writer.write(b"+OK\r\n")
+                elif name == b"SUBSCRIBE":
+                    for channel in command[1:]:
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(b"*3\r\n$9\r\nsubscribe\r\n$%d\r\n%s\r\n:1\r\n" % (len(channel), channel))
+                elif name == b"PUBLISH":
+                    channel, payload = command[1], command[2]
+                    receivers = self.subscribers.get(channel, set())
+                    for subscriber in list(receivers):
+                        subscriber.write(self.encode(b"message", channel, payload))
+                    self.published += 1
+                    writer.write(b":%d\r\n" % len(receivers))
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for receivers in self.subscribers.values():
+                receivers.discard(writer)
+            writer.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_worker(workdir, env, name):
+    port = free_port()
+    log = open(workdir / f"{name}.log", "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError((workdir / f"{name}.log").read_text(errors="replace")[-3000:])
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url, port
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"worker {name} did not start")
+
+
+@pytest.fixture(params=["unix", "redis"])
+def workers(request, tmp_path):
+    """Два воркера с общей SQLite базой и backplane выбранного типа"""
+    stand_in = None
+    if request.param == "unix":
+        backplane_url = f"unix://{tmp_path / 'backplane'}"
+    else:
+        stand_in = RespStandIn().start()
+        backplane_url = f"redis://:secret@127.0.0.1:{stand_in.port}"
+
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(BACKEND_DIR),
+        "DATABASE_URL": f"sqlite:///{tmp_path / 'devnet.db'}",
+        "BACKPLANE_URL": backplane_url,
+        "BACKPLANE_HEARTBEAT_SECONDS": "0.5",
+        "UNREAD_RECONCILE_INTERVAL": "0",
+        "SECRET_KEY": "backplane-test-secret",
+        "ENCRYPTION_KEY": Fernet.generate_key().decode(),
+    }
+    processes = []
+    try:
+        # Первый воркер создает и заполняет базу, второй запускается на готовой
+        process_a, url_a, _ = start_worker(tmp_path, env, "worker-a")
+        processes.append(process_a)
+        process_b, url_b, port_b = start_worker(tmp_path, env, "worker-b")
+        processes.append(process_b)
+        yield url_a, url_b, port_b, stand_in
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if stand_in is not None:
+            stand_in.stop()
+
+
+def login(base_url, username):
+    response = httpx.post(f"{base_url}/api/login", json={"username": username, "password": username + "123"})
+    assert response.status_code == 200, response.text
+    data = response.json()
+    return data["user"]["id"], data["tokens"]["access_token"]
+
+
+def receive_until(websocket, predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            frame = json.loads(websocket.recv(timeout=remaining))
+        except TimeoutError:
+            return None
+        if predicate(frame):
+            return frame
+
+
+def test_message_sent_on_worker_a_reaches_socket_on_worker_b(workers):
+    url_a, url_b, port_b, stand_in = workers
+    bob_id, bob_token = login(url_b, "bob")
+    alice_id, alice_token = login(url_a, "alice")
+
+    with connect(f"ws://127.0.0.1:{port_b}/ws/{bob_id}?token={bob_token}") as websocket:
+        # Unix backplane перечитывает список сокетов соседей раз в секунду
+        time.sleep(1.2)
+        content = f"cross-worker {time.time()}"
+        response = httpx.post(
+            f"{url_a}/api/messages",
+            data={"content": content, "to_user_id": bob_id},
+            headers={"Authorization": f"Bearer {alice_token}"}
+        )
+        assert response.status_code == 200, response.text
+
+        frame = receive_until(
+            websocket,
+            lambda frame: frame.get("type") == "message" and frame["message"]["content"] == content
+        )
+
+    assert frame is not None, "message from worker A was not delivered to the socket on worker B"
+    assert frame["message"]["from_user_id"] == alice_id
+    if stand_in is not None:
+        assert stand_in.published > 0
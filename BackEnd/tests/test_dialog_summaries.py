@@ -0,0 +1,170 @@
+"""Строки списка чатов (dialog_summaries): последнее сообщение, непрочитанные и сверка счетчиков"""
+import asyncio
+import uuid
+from datetime import datetime
+
+from sqlalchemy import text
+
+
+def create_users(main, session, *names):
+    suffix = uuid.uuid4().hex[:8]
+    users = [
+        main.User(username=f"{name}_{suffix}", email=f"{name}_{suffix}@devnet.local", display_name=name, password_hash="-")
+        for name in names
+    ]
+    session.add_all(users)
+    session.commit()
+    return [user.id for user in users]
+
+
+def summary(main, session, user_id, chat_type, chat_id):
+    session.expire_all()
+    row = session.query(main.DialogSummary).filter_by(user_id=user_id, chat_type=chat_type, chat_id=chat_id).one()
+    return row.last_message_id, row.last_message_preview, row.unread_count
+
+
+def send(main, session, sender, content, **chat):
+    if "to_user_id" in chat:
+        chat["dialog_key"] = main.make_dialog_key(sender, chat["to_user_id"])
+    message = main.Message(from_user_id=sender, content=content, **chat)
+    session.add(message)
+    session.commit()
+    return message
+
+
+def test_private_summary_follows_create_edit_delete_and_read(main, db):
+    a, b = create_users(main, db, "summary_a", "summary_b")
+    first, second, third = (send(main, db, a, f"private {i}", to_user_id=b) for i in range(3))
+
+    assert summary(main, db, b, "private", a) == (third.id, "private 2", 3)
+    assert summary(main, db, a, "private", b) == (third.id, "private 2", 0)
+
+    third.content = "private 2 edited"
+    db.commit()
+    assert summary(main, db, b, "private", a) == (third.id, "private 2 edited", 3)
+
+    # Удаление последнего сообщения: его место занимает предыдущее, непрочитанных меньше
+    third.is_deleted = True
+    db.commit()
+    assert summary(main, db, b, "private", a) == (second.id, "private 1", 2)
+    assert summary(main, db, a, "private", b) == (second.id, "private 1", 0)
+
+    main.mark_dialog_read(db, b, first)
+    db.commit()
+    assert summary(main, db, b, "private", a)[2] == 1
+    main.mark_dialog_read(db, b, second)
+    db.commit()
+    assert summary(main, db, b, "private", a)[2] == 0
+
+    # Ответ сбрасывает непрочитанные отвечающего и добавляет собеседнику
+    reply = send(main, db, b, "reply", to_user_id=a)
+    assert summary(main, db, b, "private", a) == (reply.id, "reply", 0)
+    assert summary(main, db, a, "private", b) == (reply.id, "reply", 1)
+
+
+def test_group_summary_counts_unread_per_member(main, db):
+    a, b, c = create_users(main, db, "summary_ga", "summary_gb", "summary_gc")
+    group = main.Group(name=f"summary group {uuid.uuid4().hex[:8]}", owner_id=a)
+    db.add(group)
+    db.commit()
+    db.add_all([main.GroupMember(group_id=group.id, user_id=user_id) for user_id in (a, b, c)])
+    db.commit()
+
+    from_a = send(main, db, a, "from a", group_id=group.id)
+    from_c = send(main, db, c, "from c", group_id=group.id)
+    unread = {user_id: summary(main, db, user_id, "group", group.id)[2] for user_id in (a, b, c)}
+    assert unread == {a: 1, b: 2, c: 0}
+    assert summary(main, db, b, "group", group.id)[0] == from_c.id
+
+    from_a.is_deleted = True
+    db.commit()
+    unread = {user_id: summary(main, db, user_id, "group", group.id)[2] for user_id in (a, b, c)}
+    assert unread == {a: 1, b: 1, c: 0}
+
+
+def test_reconcile_corrects_drifted_unread_counts(main, db):
+    a, b = create_users(main, db, "drift_a", "drift_b")
+    for i in range(2):
+        send(main, db, a, f"drift {i}", to_user_id=b)
+    assert summary(main, db, b, "private", a)[2] == 2
+
+    with main.engine.begin() as conn:
+        conn.execute(
+            text("UPDATE dialog_summaries SET unread_count = 42 WHERE user_id = :user_id AND chat_type = 'private'"),
+            {"user_id": b}
+        )
+    assert summary(main, db, b, "private", a)[2] == 42
+
+    assert main.reconcile_unread_counts(batch_size=50) >= 1
+    assert summary(main, db, b, "private", a)[2] == 2
+    assert main.reconcile_unread_counts(batch_size=50) == 0
+
+
+def test_added_dialog_entries_are_loaded_off_the_event_loop(main, db, monkeypatch):
+    a, b = create_users(main, db, "entry_a", "entry_b")
+    calls = []
+    load_entries = main.load_dialog_entries
+
+    def load_dialog_entries(keys):
+        try:
+            asyncio.get_running_loop()
+            calls.append("loop")
+        except RuntimeError:
+            calls.append("thread")
+        return load_entries(keys)
+
+    monkeypatch.setattr(main, "load_dialog_entries", load_dialog_entries)
+
+    async def first_message_on_loop():
+        # Коммит в цикле событий: новые строки списка чатов рассылаются кадром "added"
+        session = main.SessionLocal()
+        try:
+            send(main, session, a, "first", to_user_id=b)
+        finally:
+            session.close()
+        for _ in range(200):
+            if calls and not main.manager.dialog_queue and main.manager.dialog_task.done():
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(first_message_on_loop())
+    assert calls == ["thread"]
+
+
+def test_chat_list_caps_the_unread_badge(main, db, login):
+    client, alice = login("alice")
+    _, bob = login("bob")
+    group = main.Group(name=f"badge group {uuid.uuid4().hex[:8]}", owner_id=bob["id"])
+    db.add(group)
+    db.commit()
+    db.add_all([main.GroupMember(group_id=group.id, user_id=user["id"]) for user in (alice, bob)])
+    db.commit()
+    db.add_all([main.Message(from_user_id=bob["id"], group_id=group.id, content=f"badge {i}") for i in range(main.UNREAD_DISPLAY_CAP + 1)])
+    db.commit()
+
+    chats = {(chat["type"], chat["id"]): chat for chat in client.get("/api/chats/all").json()["chats"]}
+    chat = chats[("group", group.id)]
+    assert chat["unread_count"] == main.UNREAD_DISPLAY_CAP + 1
+    assert chat["unread_badge"] == f"{main.UNREAD_DISPLAY_CAP}+"
+    assert [main.unread_badge(count) for count in (0, 1, main.UNREAD_DISPLAY_CAP)] == [None, "1", str(main.UNREAD_DISPLAY_CAP)]
+
+
+def test_join_watermark_is_the_highest_id_not_the_newest_time(main, db):
+    a, b = create_users(main, db, "watermark_a", "watermark_b")
+    group = main.Group(name=f"watermark group {uuid.uuid4().hex[:8]}", owner_id=a)
+    db.add(group)
+    db.commit()
+    db.add(main.GroupMember(group_id=group.id, user_id=a))
+    db.commit()
+    send(main, db, a, "recent", group_id=group.id)
+    # Импортированное сообщение: id больше, время раньше
+    backdated = main.Message(from_user_id=a, group_id=group.id, content="imported", created_at=datetime(2020, 1, 1))
+    db.add(backdated)
+    db.commit()
+
+    # Вступивший видит всю историю прочитанной, в том числе сообщение с более поздним id
+    db.add(main.GroupMember(group_id=group.id, user_id=b))
+    db.commit()
+    assert summary(main, db, b, "group", group.id)[2] == 0
+    send(main, db, a, "after join", group_id=group.id)
+    assert summary(main, db, b, "group", group.id)[2] == 1
@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+
+def test_export_holds_one_pooled_connection(main, db, login, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_BATCH_SIZE", 10)
+    client, alice = login("alice")
+    _, bob = login("bob")
+    dialog_key = main.make_dialog_key(alice["id"], bob["id"])
+    db.add_all([
+        main.Message(from_user_id=alice["id"], to_user_id=bob["id"], content=f"export {i}", dialog_key=dialog_key)
+        for i in range(30)
+    ])
+    db.commit()
+
+    checked_out = [0]
+    peak = [0]
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out[0] += 1
+        peak[0] = max(peak[0], checked_out[0])
+
+    def checkin(dbapi_connection, connection_record):
+        checked_out[0] -= 1
+
+    event.listen(main.engine, "checkout", checkout)
+    event.listen(main.engine, "checkin", checkin)
+    try:
+        response = client.get(f"/api/messages/chat/private/{bob['id']}/export")
+    finally:
+        event.remove(main.engine, "checkout", checkout)
+        event.remove(main.engine, "checkin", checkin)
+
+    assert response.status_code == 200, response.text
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert sum(row["content"].startswith("export ") for row in rows) >= 30
+    # Сессия запроса не живет рядом с сессией потока, и после потока все соединения возвращены
+    assert peak[0] == 1
+    assert checked_out[0] == 0
+
+
+def test_export_filters_by_time_and_streams_both_formats(main, db, login):
+    users = [
+        main.User(
+            username=name, email=f"{name}@devnet.local", display_name=name.title(),
+            password_hash=main.PasswordHelper.hash_password(name + "123")
+        )
+        for name in ("export_a", "export_b")
+    ]
+    db.add_all(users)
+    db.commit()
+    a, b = users
+    dialog_key = main.make_dialog_key(a.id, b.id)
+    start = datetime(2024, 3, 1)
+    messages = [
+        main.Message(
+            from_user_id=(a, b)[i % 2].id, to_user_id=(b, a)[i % 2].id, content=f"line {i}, \"quoted\"",
+            dialog_key=dialog_key, created_at=start + timedelta(hours=i), is_deleted=i == 3
+        )
+        for i in range(6)
+    ]
+    db.add_all(messages)
+    db.commit()
+
+    client, _ = login("export_a")
+    url = f"/api/messages/chat/private/{b.id}/export"
+    rows = [json.loads(line) for line in client.get(url).text.splitlines()]
+    # По времени, без удаленных, с именами отправителей
+    assert [row["id"] for row in rows] == [messages[i].id for i in (0, 1, 2, 4, 5)]
+    assert [row["sender_username"] for row in rows[:2]] == ["export_a", "export_b"]
+
+    # since включительно, until не включительно
+    window = client.get(url, params={"since": "2024-03-01T01:00:00", "until": "2024-03-01T05:00:00Z"})
+    assert [json.loads(line)["id"] for line in window.text.splitlines()] == [messages[i].id for i in (1, 2, 4)]
+
+    response = client.get(url, params={"format": "csv", "since": "2024-03-01T04:00:00"})
+    assert response.headers["content-type"].startswith("text/csv")
+    header, *records = csv.reader(io.StringIO(response.text.lstrip("\ufeff")))
+    assert header == list(main.EXPORT_COLUMNS)
+    assert [record[header.index("content")] for record in records] == ['line 4, "quoted"', 'line 5, "quoted"']
+
+    assert client.get(url, params={"format": "xml"}).status_code == 400
+    assert client.get(url, params={"since": "yesterday"}).status_code == 400
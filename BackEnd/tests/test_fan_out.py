@@ -0,0 +1,88 @@
+"""Рассылка кадра: одна сериализация на всех получателей, медленный сокет не задерживает остальных"""
+import asyncio
+import json
+
+
+class RecordingWebSocket:
+    def __init__(self, stall=None):
+        self.texts = []
+        self.stall = stall
+        self.close_code = None
+
+    async def send_text(self, text):
+        if self.stall is not None:
+            await self.stall.wait()
+        self.texts.append(text)
+
+    async def close(self, code=None, reason=None):
+        self.close_code = code
+
+
+def register(main, manager, user_id, websocket, **options):
+    """Соединение с настоящей задачей-писателем, без сети"""
+    client = main.ClientConnection(websocket, user_id, **options)
+    manager.clients[id(websocket)] = client
+    manager.user_connections.setdefault(user_id, []).append(websocket)
+    client.start(manager.disconnect)
+    return client
+
+
+async def wait_until(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.001)
+
+
+def test_frame_is_encoded_once_and_slow_socket_does_not_stall_others(main, monkeypatch):
+    encoded = []
+    encode_frame = main.encode_frame
+    monkeypatch.setattr(main, "encode_frame", lambda message: encoded.append(message) or encode_frame(message))
+
+    async def run():
+        manager = main.ConnectionManager()
+        stall = asyncio.Event()
+        slow = RecordingWebSocket(stall)
+        fast = [RecordingWebSocket() for _ in range(50)]
+        clients = [register(main, manager, 1, slow)]
+        clients += [register(main, manager, 100 + i, websocket) for i, websocket in enumerate(fast)]
+
+        for i in range(3):
+            await manager.broadcast({"type": "message", "message": {"id": i}})
+        # Быстрые получатели получают все кадры, пока первый кадр медленного сокета висит в send_text
+        await wait_until(lambda: all(len(websocket.texts) == 3 for websocket in fast))
+        assert slow.texts == []
+
+        stall.set()
+        await wait_until(lambda: len(slow.texts) == 3)
+        for client in clients:
+            await client.close()
+        return slow, fast
+
+    slow, fast = asyncio.run(run())
+    assert len(encoded) == 3
+    # Все получатели отправляют одну и ту же строку, а не свою сериализацию
+    for position in range(3):
+        assert all(websocket.texts[position] is slow.texts[position] for websocket in fast)
+    assert [json.loads(text)["message"]["id"] for text in slow.texts] == [0, 1, 2]
+
+
+def test_overflowing_send_queue_closes_only_that_socket(main):
+    async def run():
+        manager = main.ConnectionManager()
+        slow = RecordingWebSocket(asyncio.Event())
+        fast = RecordingWebSocket()
+        register(main, manager, 1, slow, max_queue=4)
+        fast_client = register(main, manager, 2, fast, max_queue=4)
+
+        # Первый кадр медленного сокета ушел в send_text, следующие четыре заполняют очередь, шестой не помещается
+        for i in range(6):
+            await manager.broadcast({"type": "message", "message": {"id": i}})
+            await asyncio.sleep(0.001)
+        await wait_until(lambda: slow.close_code is not None and len(fast.texts) == 6)
+        await fast_client.close()
+        return slow, fast
+
+    slow, fast = asyncio.run(run())
+    assert slow.close_code == main.WS_CLOSE_RESYNC
+    assert fast.close_code is None
@@ -0,0 +1,51 @@
+"""FastJSONResponse: orjson и стандартный json дают один результат, горячие эндпоинты минуют jsonable_encoder"""
+import json
+import uuid
+from datetime import datetime
+
+import fastapi.routing
+
+
+def test_render_encodes_native_types_with_and_without_orjson(main, monkeypatch):
+    identifier = uuid.uuid4()
+    content = {
+        "at": datetime(2024, 5, 6, 7, 8, 9),
+        "id": identifier,
+        "tags": {"a"},
+        "by_id": {7: "seven"},
+        "text": "привет",
+    }
+    expected = {"at": "2024-05-06T07:08:09", "id": str(identifier), "tags": ["a"], "by_id": {"7": "seven"}, "text": "привет"}
+
+    assert main.orjson is not None
+    assert json.loads(main.FastJSONResponse(content).body) == expected
+    monkeypatch.setattr(main, "orjson", None)
+    assert json.loads(main.FastJSONResponse(content).body) == expected
+
+
+def test_hot_endpoints_skip_jsonable_encoder(main, login, monkeypatch):
+    client, _ = login("alice")
+    _, bob = login("bob")
+    calls = []
+    jsonable_encoder = fastapi.routing.jsonable_encoder
+
+    def counting_encoder(*args, **kwargs):
+        calls.append(args)
+        return jsonable_encoder(*args, **kwargs)
+
+    monkeypatch.setattr(fastapi.routing, "jsonable_encoder", counting_encoder)
+
+    for url, params in (
+        ("/api/chats/all", None),
+        (f"/api/messages/chat/private/{bob['id']}", None),
+        ("/api/sync", {"since": f"private:{bob['id']}:0"}),
+    ):
+        response = client.get(url, params=params)
+        assert response.status_code == 200, response.text
+        assert response.headers["content-type"] == "application/json"
+        assert response.json()["success"] is True
+    assert calls == []
+
+    # Обычные эндпоинты по-прежнему проходят через jsonable_encoder
+    assert client.get("/api/me").status_code == 200
+    assert calls
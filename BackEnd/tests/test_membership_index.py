@@ -0,0 +1,99 @@
+"""Индекс участников чатов: поддержка при изменениях участия, LRU и загрузка вне цикла событий"""
+import asyncio
+import threading
+import uuid
+
+
+def create_chats(main, session, owner_id):
+    """Открытые группа и канал, где владелец - единственный участник"""
+    suffix = uuid.uuid4().hex[:8]
+    group = main.Group(name=f"index group {suffix}", owner_id=owner_id, members_count=1)
+    channel = main.Channel(name=f"index channel {suffix}", owner_id=owner_id, subscribers_count=1)
+    session.add_all([group, channel])
+    session.commit()
+    session.add_all([
+        main.GroupMember(group_id=group.id, user_id=owner_id, role="owner"),
+        main.ChannelSubscription(channel_id=channel.id, user_id=owner_id, role="owner"),
+    ])
+    session.commit()
+    return group.id, channel.id
+
+
+def test_index_follows_join_leave_ban_and_delete(main, db, login):
+    alice_client, alice = login("alice")
+    bob_client, bob = login("bob")
+    group_id, channel_id = create_chats(main, db, alice["id"])
+    index = main.manager.chat_members
+
+    def indexed(chat_type, chat_id):
+        return index.peek(chat_type, chat_id)
+
+    def ok(response):
+        assert response.status_code == 200, response.text
+
+    assert asyncio.run(index.get_members("group", group_id)) == {alice["id"]}
+    assert asyncio.run(index.get_members("channel", channel_id)) == {alice["id"]}
+
+    ok(bob_client.post(f"/api/groups/{group_id}/join"))
+    assert indexed("group", group_id) == {alice["id"], bob["id"]}
+    ok(bob_client.post(f"/api/groups/{group_id}/leave"))
+    assert indexed("group", group_id) == {alice["id"]}
+    ok(bob_client.post(f"/api/groups/{group_id}/join"))
+    ok(alice_client.post(f"/api/groups/{group_id}/members/{bob['id']}/ban"))
+    assert indexed("group", group_id) == {alice["id"]}
+
+    ok(bob_client.post(f"/api/channels/{channel_id}/subscribe"))
+    assert indexed("channel", channel_id) == {alice["id"], bob["id"]}
+    ok(bob_client.post(f"/api/channels/{channel_id}/unsubscribe"))
+    assert indexed("channel", channel_id) == {alice["id"]}
+    ok(bob_client.post(f"/api/channels/{channel_id}/subscribe"))
+    ok(alice_client.post(f"/api/channels/{channel_id}/subscribers/{bob['id']}/ban"))
+    assert indexed("channel", channel_id) == {alice["id"]}
+
+    ok(alice_client.delete(f"/api/groups/{group_id}"))
+    ok(alice_client.delete(f"/api/channels/{channel_id}"))
+    assert indexed("group", group_id) is None
+    assert indexed("channel", channel_id) is None
+
+
+def test_index_lru_counters_and_loads_off_the_loop(main):
+    index = main.ChatMembershipIndex(max_chats=2)
+    loads = []
+    release = threading.Event()
+
+    def load(chat_type, chat_id):
+        loads.append((chat_id, threading.get_ident()))
+        release.wait(5)
+        return {chat_id * 10}
+
+    index._load = load
+
+    async def scenario():
+        loop_thread = threading.get_ident()
+        delivered = []
+        # Три кадра одного незагруженного чата: одна загрузка, доставка по порядку после нее
+        for frame in range(3):
+            index.with_members("group", 1, lambda members, frame=frame: delivered.append((frame, members)))
+        # Вступление во время загрузки не теряется
+        index.add_member("group", 1, 11, propagate=False)
+        await asyncio.sleep(0.05)
+        assert delivered == [] and index.get_stats()["loading"] == 1
+        release.set()
+        assert await index.get_members("group", 1) == {10, 11}
+        assert delivered == [(0, {10, 11}), (1, {10, 11}), (2, {10, 11})]
+
+        await index.get_members("group", 2)
+        await index.get_members("group", 1)
+        # Третий чат вытесняет давно не использованный второй
+        await index.get_members("group", 3)
+        return loop_thread
+
+    loop_thread = asyncio.run(scenario())
+
+    assert [chat_id for chat_id, _ in loads] == [1, 2, 3]
+    assert all(thread != loop_thread for _, thread in loads)
+    assert index.peek("group", 2) is None
+    stats = index.get_stats()
+    assert (stats["chats"], stats["misses"], stats["evictions"], stats["loading"]) == (2, 3, 1, 0)
+    # Ожидавшие загрузку не считаются попаданием; попадание одно - повторный чат 1
+    assert stats["hits"] == 1
@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+PAGE_SIZES = (1, 50, 500)
+
+
+@pytest.fixture(scope="module")
+def dialog(main):
+    """Личный чат на 500 сообщений; самое новое - ответ, пересылка и с реакцией"""
+    db = main.SessionLocal()
+    try:
+        users = [
+            main.User(
+                username=name, email=f"{name}@devnet.local", display_name=name,
+                password_hash=main.PasswordHelper.hash_password(name + "123")
+            )
+            for name in ("hydra_a", "hydra_b", "hydra_c")
+        ]
+        db.add_all(users)
+        db.commit()
+        a, b, c = users
+        
+        previous = None
+        for i in range(500):
+            sender, recipient = (a, b) if i % 2 else (b, a)
+            message = main.Message(
+                from_user_id=sender.id, to_user_id=recipient.id, content=f"message {i}",
+                dialog_key=main.make_dialog_key(sender.id, recipient.id),
+                reply_to_id=previous.id if previous is not None and i % 3 == 1 else None,
+                forwarded_from=c.id if i % 5 == 4 else None,
+                forwarded_message_id=1 if i % 5 == 4 else None
+            )
+            db.add(message)
+            db.flush()
+            if i % 4 == 3:
+                db.add(main.MessageReaction(message_id=message.id, user_id=recipient.id, reaction="👍"))
+            previous = message
+        db.commit()
+        return a.id, b.id
+    finally:
+        db.close()
+
+
+def test_serialize_messages_query_count_is_constant(main, dialog, count_queries):
+    a_id, b_id = dialog
+    counts = {}
+    for size in PAGE_SIZES:
+        db = main.SessionLocal()
+        try:
+            messages = db.query(main.Message).filter(
+                main.Message.dialog_key == main.make_dialog_key(a_id, b_id)
+            ).order_by(main.Message.id.desc()).limit(size).all()
+            assert len(messages) == size
+            with count_queries() as statements:
+                payloads = main.serialize_messages(db, messages, a_id)
+            counts[size] = len(statements)
+        finally:
+            db.close()
+        assert len(payloads) == size
+        assert payloads[0]["reply_to"] and payloads[0]["forwarded_from"] and payloads[0]["reactions"]
+    
+    # Ответы, пользователи и реакции - по одному IN-запросу на страницу
+    assert len(set(counts.values())) == 1, counts
+    assert counts[500] <= 3, counts
+
+
+def test_chat_page_query_count_is_constant(main, dialog, login, count_queries):
+    client, user = login("hydra_a")
+    _, b_id = dialog
+    counts = {}
+    for size in PAGE_SIZES:
+        # before= обходит кэш хвоста чата, страница читается из базы
+        with count_queries() as statements:
+            response = client.get(
+                f"/api/messages/chat/private/{b_id}",
+                params={"limit": size, "before": "2999-01-01T00:00:00"}
+            )
+        assert response.status_code == 200, response.text
+        assert len(response.json()["messages"]) == size
+        counts[size] = len(statements)
+    
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_chat_tail_hit_matches_database_page(main, dialog, login, monkeypatch):
+    client, user = login("hydra_a")
+    _, b_id = dialog
+    tail = main.manager.message_tail
+    url = f"/api/messages/chat/private/{b_id}"
+    
+    def database_page():
+        response = client.get(url, params={"limit": 50, "before": "2999-01-01T00:00:00"})
+        assert response.status_code == 200, response.text
+        return response.json()["messages"]
+    
+    def tail_page():
+        hits = tail.counters["hits"]
+        response = client.get(url, params={"limit": 50})
+        assert response.status_code == 200, response.text
+        assert tail.counters["hits"] == hits + 1
+        return response.json()["messages"]
+    
+    client.get(url, params={"limit": 50})
+    assert tail_page() == database_page()
+    
+    # Статус отправителя в сети - на момент ответа, а не на момент заполнения кэша
+    monkeypatch.setattr(main.manager, "is_user_online", lambda user_id: user_id == b_id)
+    page = tail_page()
+    assert {message["sender"]["id"]: message["sender"]["is_online"] for message in page} == {user["id"]: False, b_id: True}
+    assert page == database_page()
+    
+    # Правка, закоммиченная в цикле событий, пересериализуется в потоке
+    threads = []
+    refresh = tail.refresh
+    
+    def tracked_refresh(changed):
+        try:
+            asyncio.get_running_loop()
+            where = "loop"
+        except RuntimeError:
+            where = "thread"
+        refresh(changed)
+        threads.append(where)
+    
+    monkeypatch.setattr(tail, "refresh", tracked_refresh)
+    
+    async def edit_on_loop():
+        db = main.SessionLocal()
+        try:
+            message = db.query(main.Message).filter(main.Message.id == page[-1]["id"]).one()
+            message.content = "edited on the loop"
+            message.is_edited = True
+            db.commit()
+        finally:
+            db.close()
+        # Даем задаче пересериализации завершиться
+        for _ in range(100):
+            if threads:
+                break
+            await asyncio.sleep(0.01)
+    
+    asyncio.run(edit_on_loop())
+    assert threads == ["thread"]
+    page = tail_page()
+    assert page[-1]["content"] == "edited on the loop"
+    assert page == database_page()
@@ -0,0 +1,82 @@
+"""Курсорная пагинация истории чата по (created_at, id)"""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def dialog(main):
+    """Личный чат на 25 сообщений, по три сообщения на одну метку времени"""
+    db = main.SessionLocal()
+    try:
+        users = [
+            main.User(
+                username=name, email=f"{name}@devnet.local", display_name=name,
+                password_hash=main.PasswordHelper.hash_password(name + "123")
+            )
+            for name in ("pager_a", "pager_b")
+        ]
+        db.add_all(users)
+        db.commit()
+        a, b = users
+        start = datetime(2024, 1, 1)
+        messages = [
+            main.Message(
+                from_user_id=a.id, to_user_id=b.id, content=f"page {i}",
+                dialog_key=main.make_dialog_key(a.id, b.id), created_at=start + timedelta(seconds=i // 3)
+            )
+            for i in range(25)
+        ]
+        db.add_all(messages)
+        db.commit()
+        return b.id, [message.id for message in messages]
+    finally:
+        db.close()
+
+
+def test_cursor_pages_cover_history_without_gaps(main, dialog, login):
+    client, _ = login("pager_a")
+    b_id, ids = dialog
+    url = f"/api/messages/chat/private/{b_id}"
+
+    pages, params = [], {"limit": 10}
+    while True:
+        body = client.get(url, params=params).json()
+        pagination = body["pagination"]
+        pages.insert(0, [message["id"] for message in body["messages"]])
+        assert pagination["total"] is None
+        if not pagination["has_more"]:
+            assert pagination["next_cursor"] is None
+            break
+        params = {"limit": 10, "cursor": pagination["next_cursor"]}
+
+    # Страницы идут подряд, без пропусков и повторов, несмотря на равные created_at
+    assert [len(page) for page in pages] == [5, 10, 10]
+    assert sum(pages, []) == ids
+
+    # prev_cursor самой старой страницы ведет обратно к более новым сообщениям
+    oldest = client.get(url, params=params).json()["pagination"]
+    newer = client.get(url, params={"limit": 10, "cursor": oldest["prev_cursor"]}).json()
+    assert [message["id"] for message in newer["messages"]] == pages[1]
+
+    assert client.get(url, params={"limit": 10, "with_total": True}).json()["pagination"]["total"] == 25
+    assert client.get(url, params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+def test_around_anchor_returns_both_sides(main, dialog, login):
+    client, _ = login("pager_a")
+    b_id, ids = dialog
+    url = f"/api/messages/chat/private/{b_id}"
+
+    body = client.get(url, params={"limit": 6, "around": ids[12]}).json()
+    assert [message["id"] for message in body["messages"]] == ids[10:16]
+    pagination = body["pagination"]
+    assert pagination["anchor_id"] == ids[12]
+    assert pagination["has_more"] and pagination["has_newer"]
+
+    older = client.get(url, params={"limit": 6, "cursor": pagination["next_cursor"]}).json()["messages"]
+    newer = client.get(url, params={"limit": 6, "cursor": pagination["prev_cursor"]}).json()["messages"]
+    assert [message["id"] for message in older] == ids[4:10]
+    assert [message["id"] for message in newer] == ids[16:22]
+
+    assert client.get(url, params={"around": 10 ** 9}).status_code == 404
@@ -0,0 +1,181 @@
+import asyncio
+import threading
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event, insert
+
+
+def test_presence_audience_is_loaded_off_the_event_loop(main, db):
+    users = [
+        main.User(
+            username=name, email=f"{name}@devnet.local", display_name=name,
+            password_hash=main.PasswordHelper.hash_password(name + "123")
+        )
+        for name in ("presence_subject", "presence_partner", "presence_contact", "presence_blocked")
+    ]
+    db.add_all(users)
+    db.commit()
+    subject, partner, contact, blocked = users
+
+    db.add(main.Message(
+        from_user_id=partner.id, to_user_id=subject.id, content="hi",
+        dialog_key=main.make_dialog_key(partner.id, subject.id)
+    ))
+    db.add_all([
+        main.Contact(user_id=subject.id, contact_id=contact.id),
+        main.Contact(user_id=subject.id, contact_id=blocked.id, is_blocked=True),
+        main.GroupMember(group_id=1, user_id=subject.id),
+        main.GroupMember(group_id=1, user_id=blocked.id),
+    ])
+    db.commit()
+    group_members = {row[0] for row in db.query(main.GroupMember.user_id).filter(main.GroupMember.group_id == 1)}
+    subject_id, partner_id, contact_id, blocked_id = (user.id for user in users)
+
+    query_threads = set()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        query_threads.add(threading.get_ident())
+
+    async def load():
+        loop_thread = threading.get_ident()
+        main.manager.presence_audience.pop(subject_id, None)
+        main.manager.chat_members.invalidate("group", 1, propagate=False)
+        audiences = await main.manager._get_presence_audiences([subject_id])
+        return loop_thread, audiences[subject_id]
+
+    event.listen(main.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        loop_thread, audience = asyncio.run(load())
+    finally:
+        event.remove(main.engine, "before_cursor_execute", before_cursor_execute)
+
+    assert query_threads and loop_thread not in query_threads
+    assert partner_id in audience
+    assert contact_id in audience
+    assert group_members - {subject_id, blocked_id} <= audience
+    assert blocked_id not in audience
+    assert subject_id not in audience
+
+
+class FakeWebSocket:
+    async def send_text(self, text):
+        pass
+
+
+@contextmanager
+def connected(main, user_ids):
+    """Соединения пользователей в менеджере без сети и задач-писателей"""
+    clients = {}
+    for user_id in user_ids:
+        websocket = FakeWebSocket()
+        clients[user_id] = main.ClientConnection(websocket, user_id)
+        main.manager.clients[id(websocket)] = clients[user_id]
+        main.manager.user_connections.setdefault(user_id, []).append(websocket)
+    try:
+        yield clients
+    finally:
+        for user_id, client in clients.items():
+            main.manager._unwatch_presence(id(client.websocket), client.presence_subscriptions)
+            main.manager.clients.pop(id(client.websocket), None)
+            main.manager.user_connections.pop(user_id, None)
+
+
+def frames_of(client, frame_type):
+    return [frame.message for frame in client.queue if frame.message.get("type") == frame_type]
+
+
+def test_presence_subscription_follows_audience_block_and_privacy(main, db):
+    suffix = uuid.uuid4().hex[:8]
+    users = [
+        main.User(username=f"{name}_{suffix}", email=f"{name}_{suffix}@devnet.local", display_name=name, password_hash="-")
+        for name in ("private_subject", "open_subject", "contact", "partner", "blocked", "stranger")
+    ]
+    users[0].settings = {"privacy": {"online_status": "contacts"}}
+    db.add_all(users)
+    db.commit()
+    private_id, open_id, contact_id, partner_id, blocked_id, stranger_id = (user.id for user in users)
+    db.add_all([
+        main.Message(
+            from_user_id=partner_id, to_user_id=subject_id, content="hi",
+            dialog_key=main.make_dialog_key(partner_id, subject_id)
+        )
+        for subject_id in (private_id, open_id)
+    ])
+    db.add_all([
+        main.Contact(user_id=private_id, contact_id=contact_id),
+        main.Contact(user_id=open_id, contact_id=contact_id),
+        main.Contact(user_id=private_id, contact_id=blocked_id, is_blocked=True),
+        main.Contact(user_id=open_id, contact_id=blocked_id, is_blocked=True),
+    ])
+    db.commit()
+
+    query_threads = set()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        query_threads.add(threading.get_ident())
+
+    async def subscribe(clients):
+        for client in clients.values():
+            await main.manager.subscribe_presence(client.websocket, [private_id, open_id, stranger_id])
+        main.manager.pending_presence[private_id] = {"user_id": private_id, "is_online": True, "last_seen": None}
+        main.manager.pending_presence[open_id] = {"user_id": open_id, "is_online": True, "last_seen": None}
+        await main.manager.flush_presence()
+        return threading.get_ident()
+
+    with connected(main, [contact_id, partner_id, blocked_id, stranger_id]) as clients:
+        event.listen(main.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            loop_thread = asyncio.run(subscribe(clients))
+        finally:
+            event.remove(main.engine, "before_cursor_execute", before_cursor_execute)
+
+        # Приватный статус видят только контакты; заблокированный и посторонний не видят никого
+        expected = {contact_id: {private_id, open_id}, partner_id: {open_id}, blocked_id: set(), stranger_id: set()}
+        for user_id, subjects in expected.items():
+            client = clients[user_id]
+            assert client.presence_subscriptions == subjects
+            snapshot = {update["user_id"] for frame in frames_of(client, "presence_batch")[:1] for update in frame["users"]}
+            batched = {update["user_id"] for frame in frames_of(client, "presence_batch") for update in frame["users"]}
+            assert snapshot <= subjects and batched == subjects, user_id
+
+    assert query_threads and loop_thread not in query_threads
+
+
+def test_reconnect_wave_sends_one_batch_per_connection(main, db):
+    """5000 пользователей в 50 группах по 100 переподключаются одновременно"""
+    suffix = uuid.uuid4().hex[:8]
+    total, group_size = 5000, 100
+    db.execute(insert(main.User), [
+        {"username": f"wave_{suffix}_{i}", "email": f"wave_{suffix}_{i}@devnet.local", "password_hash": "-"}
+        for i in range(total)
+    ])
+    db.commit()
+    user_ids = [row[0] for row in db.query(main.User.id).filter(main.User.username.like(f"wave_{suffix}_%")).order_by(main.User.id)]
+    groups = [main.Group(name=f"wave {suffix} {i}") for i in range(total // group_size)]
+    db.add_all(groups)
+    db.commit()
+    db.execute(insert(main.GroupMember), [
+        {"group_id": groups[index // group_size].id, "user_id": user_id} for index, user_id in enumerate(user_ids)
+    ])
+    db.commit()
+
+    async def reconnect_wave():
+        for user_id in user_ids:
+            main.manager.presence_audience.pop(user_id, None)
+            main.manager.pending_presence[user_id] = {"user_id": user_id, "is_online": True, "last_seen": None}
+        await main.manager.flush_presence()
+
+    counters = main.manager.presence_counters
+    frames_before = counters["frames"]
+    with connected(main, user_ids) as clients:
+        asyncio.run(reconnect_wave())
+        frames = counters["frames"] - frames_before
+        delivered = sum(len(frame["users"]) for client in clients.values() for frame in frames_of(client, "presence_batch"))
+        first = clients[user_ids[0]]
+        members = set(user_ids[:group_size]) - {user_ids[0]}
+        assert {update["user_id"] for frame in frames_of(first, "presence_batch") for update in frame["users"]} == members
+
+    # Один кадр на соединение (вместо 5000 * 5000 кадров user_status), в кадре - только участники общей группы
+    assert frames == total
+    assert delivered == total * (group_size - 1)
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+
+def test_only_data_frames_are_recorded(main):
+    log = main.ReplayLog(size=16)
+    for frame_type in ("pong", "call_offer", "call_answer", "ice_candidate", "call_end", "typing"):
+        frame = log.record(("user", 1), {"type": frame_type})
+        assert "event_id" not in frame
+    assert not log.streams
+
+    frame = log.record(("user", 1), {"type": "message", "message": {"id": 1}})
+    assert log.parse(frame["event_id"]) == log.last_id
+    assert log.since(str(log.evicted_id), 1, [("user", 1)]) == [frame]
+
+
+def test_event_id_from_one_worker_is_replayed_by_another(main):
+    # Оба воркера запущены до подключения клиента
+    worker_b = main.ReplayLog(size=16)
+    worker_a = main.ReplayLog(size=16)
+    position = str(worker_a.last_id)
+
+    # Воркер A назначает номер до публикации, B записывает событие из backplane с тем же номером
+    frame = worker_a.stamp({"type": "message", "message": {"id": 7}})
+    worker_a.record(("user", 2), frame)
+    worker_b.record(("user", 2), frame)
+    pong = worker_b.record(("user", 2), worker_b.stamp({"type": "pong"}))
+
+    assert "event_id" not in pong
+    assert worker_b.since(position, 2, [("user", 2)]) == [frame]
+    assert worker_b.since(frame["event_id"], 2, [("user", 2)]) == []
+
+
+def test_worker_started_after_last_event_requires_resync(main):
+    worker_a = main.ReplayLog(size=16)
+    frame = worker_a.record(("user", 3), {"type": "message", "message": {"id": 1}})
+    time.sleep(0.002)
+    worker_b = main.ReplayLog(size=16)
+    assert worker_b.since(frame["event_id"], 3, [("user", 3)]) is None
+
+
+def test_only_data_frames_are_published_for_offline_users(main, monkeypatch):
+    published = []
+    monkeypatch.setattr(main.manager, "remote_workers", {"worker-b": {"users": {}, "seen": time.monotonic()}})
+    monkeypatch.setattr(main.manager, "_publish", published.append)
+
+    async def send():
+        await main.manager.send_to_user(999001, {"type": "pong"})
+        await main.manager.send_to_user(999001, {"type": "call_offer", "call_id": "x"})
+        await main.manager.broadcast_to_chat("private", 999001, {"type": "typing"})
+        await main.manager.send_to_user(999001, {"type": "message", "message": {"id": 1}})
+
+    asyncio.run(send())
+    assert [event["message"]["type"] for event in published] == ["message"]
+    assert published[0]["message"]["event_id"]
+
+
+def test_replay_keys_are_loaded_off_the_event_loop(main, login, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    client, alice = login("alice")
+    token = client.cookies.get("access_token")
+    calls = []
+    load_keys = main.manager._replay_keys
+
+    def replay_keys(user_id):
+        try:
+            asyncio.get_running_loop()
+            calls.append("loop")
+        except RuntimeError:
+            calls.append("thread")
+        return load_keys(user_id)
+
+    monkeypatch.setattr(main.manager, "_replay_keys", replay_keys)
+    with TestClient(main.app) as ws_client:
+        with ws_client.websocket_connect(f"/ws/{alice['id']}?token={token}&last_event_id=1") as websocket:
+            frame = websocket.receive_json()
+            assert frame["type"] == "resync_required"
+
+    assert calls == ["thread"]
+
+
+class FakeWebSocket:
+    async def send_text(self, text):
+        pass
+
+
+def test_gap_larger_than_send_queue_requires_resync(main, monkeypatch):
+    log = main.ReplayLog(size=64)
+    position = str(log.last_id)
+    for i in range(10):
+        log.record(("user", 4), log.stamp({"type": "message", "message": {"id": i}}))
+    monkeypatch.setattr(main.manager, "replay_log", log)
+
+    # Пропуск помещается в очередь: события и replay_complete
+    client = main.ClientConnection(FakeWebSocket(), 4, max_queue=16)
+    main.manager._replay(client, position, [("user", 4)])
+    assert [frame.message["type"] for frame in client.queue] == ["message"] * 10 + ["replay_complete"]
+
+    # Пропуск длиннее очереди: только resync_required, без частичного повтора
+    client = main.ClientConnection(FakeWebSocket(), 4, max_queue=4)
+    main.manager._replay(client, position, [("user", 4)])
+    assert [frame.message["type"] for frame in client.queue] == ["resync_required"]
+
+    # То же при ограничении очереди по байтам
+    client = main.ClientConnection(FakeWebSocket(), 4, max_queue=16, max_bytes=200)
+    main.manager._replay(client, position, [("user", 4)])
+    assert [frame.message["type"] for frame in client.queue] == ["resync_required"]
+    assert log.counters["resyncs"] == 2
@@ -0,0 +1,48 @@
+"""Создание и миграция схемы при импорте: один воркер мигрирует, остальные пропускают"""
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+REPORT = "import main; print(main.MESSAGE_SEARCH_BACKEND)"
+
+
+def import_env(database):
+    return {
+        **os.environ,
+        "PYTHONPATH": str(BACKEND_DIR),
+        "DATABASE_URL": f"sqlite:///{database}",
+        "BACKPLANE_URL": "",
+        "UNREAD_RECONCILE_INTERVAL": "0",
+    }
+
+
+def finish(worker):
+    stdout, stderr = worker.communicate(timeout=300)
+    stderr = stderr.decode(errors="replace")
+    assert worker.returncode == 0, stderr[-2000:]
+    return stdout.decode().strip().splitlines()[-1], stderr
+
+
+def test_simultaneous_workers_migrate_the_schema_once(tmp_path):
+    database = tmp_path / "devnet.db"
+    workers = [
+        subprocess.Popen([sys.executable, "-c", REPORT], cwd=tmp_path, env=import_env(database), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for _ in range(4)
+    ]
+    results = [finish(worker) for worker in workers]
+
+    assert [backend for backend, _ in results] == ["fts5"] * 4
+    migrated = [stderr for _, stderr in results if "Database tables created successfully" in stderr]
+    skipped = [stderr for _, stderr in results if "Database schema is up to date" in stderr]
+    assert (len(migrated), len(skipped)) == (1, 3)
+
+    # Отпечаток другой версии схемы - следующий запуск снова мигрирует
+    with sqlite3.connect(database) as conn:
+        assert conn.execute("SELECT COUNT(*), MAX(search_backend) FROM schema_state").fetchone() == (1, "fts5")
+        conn.execute("UPDATE schema_state SET fingerprint = 'previous'")
+    worker = subprocess.Popen([sys.executable, "-c", REPORT], cwd=tmp_path, env=import_env(database), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    backend, stderr = finish(worker)
+    assert backend == "fts5" and "Database tables created successfully" in stderr
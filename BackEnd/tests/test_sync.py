@@ -0,0 +1,60 @@
+"""Номера изменений сообщений (seq) и дельта-синхронизация /api/sync"""
+import uuid
+
+
+def test_seq_grows_on_every_change_and_sync_returns_the_delta(main, db, login):
+    alice_client, alice = login("alice")
+    bob_client, bob = login("bob")
+    group = main.Group(name=f"sync group {uuid.uuid4().hex[:8]}", owner_id=alice["id"])
+    db.add(group)
+    db.commit()
+    db.add_all([main.GroupMember(group_id=group.id, user_id=user_id) for user_id in (alice["id"], bob["id"])])
+    messages = [main.Message(from_user_id=alice["id"], group_id=group.id, content=f"sync {i}") for i in range(4)]
+    db.add_all(messages)
+    db.commit()
+    edited, reacted, pinned, deleted = (message.id for message in messages)
+
+    def seq_of(message_id):
+        db.expire_all()
+        return db.query(main.Message.seq).filter(main.Message.id == message_id).scalar()
+
+    def chat_seq():
+        db.expire_all()
+        return db.query(main.func.max(main.Message.seq)).filter(main.Message.group_id == group.id).scalar()
+
+    position = chat_seq()
+    assert len({seq_of(message_id) for message_id in (edited, reacted, pinned, deleted)}) == 4
+
+    # Каждое изменение получает номер больше всех прежних номеров чата
+    changes = (
+        (edited, lambda: alice_client.put(f"/api/messages/{edited}", data={"content": "sync 0 edited"})),
+        (reacted, lambda: bob_client.post(f"/api/messages/{reacted}/reaction", data={"reaction": "👍"})),
+        (pinned, lambda: alice_client.post(f"/api/messages/{pinned}/pin")),
+        (deleted, lambda: alice_client.delete(f"/api/messages/{deleted}", params={"for_everyone": True})),
+    )
+    for message_id, change in changes:
+        before = chat_seq()
+        response = change()
+        assert response.status_code == 200, response.text
+        assert seq_of(message_id) > before, message_id
+
+    response = bob_client.get("/api/sync", params={"since": f"group:{group.id}:{position}"})
+    assert response.status_code == 200, response.text
+    chat = response.json()["chats"][0]
+    assert chat["seq"] == chat_seq() and chat["has_more"] is False
+    assert {message["id"] for message in chat["messages"]} == {edited, reacted, pinned}
+    assert [tombstone["id"] for tombstone in chat["deleted"]] == [deleted]
+    by_id = {message["id"]: message for message in chat["messages"]}
+    assert by_id[edited]["content"] == "sync 0 edited" and by_id[edited]["is_edited"]
+    assert by_id[reacted]["reactions"]["👍"]["count"] == 1
+    assert by_id[pinned]["is_pinned"]
+
+    # С последней позиции изменений нет; limit режет дельту и оставляет has_more
+    response = bob_client.get("/api/sync", params={"since": f"group:{group.id}:{chat['seq']}"})
+    assert response.json()["chats"][0] == {
+        "chat_type": "group", "chat_id": group.id, "seq": chat["seq"], "messages": [], "deleted": [], "has_more": False
+    }
+    response = bob_client.get("/api/sync", params={"since": f"group:{group.id}:{position}", "limit": 2})
+    partial = response.json()["chats"][0]
+    assert partial["has_more"] is True and partial["seq"] < chat["seq"]
+    assert len(partial["messages"]) + len(partial["deleted"]) == 2
@@ -0,0 +1,8 @@
+def test_users_list(login):
+    client, user = login("alice")
+    response = client.get("/api/users", params={"limit": 5})
+    assert response.status_code == 200, response.text
+    data = response.json()
+    assert data["users"] and len(data["users"]) <= 5
+    assert all(item["id"] != user["id"] for item in data["users"])
+    assert data["pagination"]["total"] >= len(data["users"])
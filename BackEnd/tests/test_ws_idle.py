@@ -0,0 +1,73 @@
+"""Простаивающие WebSocket соединения не держат соединения пула БД и не замедляют HTTP"""
+import asyncio
+import os
+import statistics
+import subprocess
+import time
+
+import httpx
+from cryptography.fernet import Fernet
+from websockets.client import connect
+
+from test_backplane import BACKEND_DIR, login, start_worker
+
+# Пул SQLite по умолчанию - 5 + 10 соединений: сессия на сокет исчерпала бы его уже на первом шаге
+IDLE_STEPS = (0, 500, 2000)
+
+
+async def close_sockets(sockets):
+    await asyncio.gather(*(websocket.close() for websocket in sockets), return_exceptions=True)
+
+
+async def open_sockets(url, count):
+    sockets = []
+    for start in range(0, count, 100):
+        sockets += await asyncio.gather(*(connect(url, open_timeout=30) for _ in range(min(100, count - start))))
+    return sockets
+
+
+def test_http_latency_stays_flat_as_idle_sockets_grow(tmp_path):
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(BACKEND_DIR),
+        "DATABASE_URL": f"sqlite:///{tmp_path / 'devnet.db'}",
+        "BACKPLANE_URL": "",
+        "UNREAD_RECONCILE_INTERVAL": "0",
+        "SECRET_KEY": "idle-test-secret",
+        "ENCRYPTION_KEY": Fernet.generate_key().decode(),
+    }
+    process, base_url, port = start_worker(tmp_path, env, "worker")
+    loop = asyncio.new_event_loop()
+    sockets = []
+    try:
+        user_id, token = login(base_url, "alice")
+        ws_url = f"ws://127.0.0.1:{port}/ws/{user_id}?token={token}"
+
+        def http_latency(client):
+            timings = []
+            for _ in range(20):
+                started = time.perf_counter()
+                response = client.get("/api/chats/all")
+                timings.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+            return statistics.median(timings)
+
+        latencies = {}
+        with httpx.Client(base_url=base_url, headers={"Authorization": f"Bearer {token}"}, timeout=10) as client:
+            for idle in IDLE_STEPS:
+                sockets += loop.run_until_complete(open_sockets(ws_url, idle - len(sockets)))
+                # Сокеты подключены и простаивают: даем серверу закончить обработку подключений
+                time.sleep(1)
+                latencies[idle] = http_latency(client)
+    finally:
+        loop.run_until_complete(close_sockets(sockets))
+        loop.close()
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    baseline = latencies[0]
+    for idle, latency in latencies.items():
+        assert latency < baseline * 2 + 0.01, latencies
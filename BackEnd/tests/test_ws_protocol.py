@@ -0,0 +1,68 @@
+"""Подпротокол devnet.msgpack.v1 и настройки permessage-deflate"""
+import asyncio
+from datetime import datetime
+
+import msgpack
+from fastapi.testclient import TestClient
+
+
+def receive_packed_until(websocket, frame_type):
+    """Бинарные кадры до первого кадра указанного типа (короткий ключ "t")"""
+    while True:
+        frame = msgpack.unpackb(websocket.receive_bytes(), raw=False)
+        if frame.get("t") == frame_type:
+            return frame
+
+
+def test_compact_payload_uses_short_keys_and_epoch_time(main):
+    payload = {
+        "type": "message",
+        "message": {"id": 5, "content": "hi", "created_at": "2024-01-02T03:04:05.678000", "custom": [datetime(2024, 1, 1)]},
+    }
+    compact = main.compact_ws_payload(payload)
+    assert compact == {
+        "t": "message",
+        "m": {"id": 5, "co": "hi", "ca": 1704164645678, "custom": [1704067200000]},
+    }
+    # Входящий кадр разворачивается обратно в те же ключи, что и JSON
+    assert main.expand_ws_payload({"t": "ping", "c": 3, "m": {"co": "x"}}) == {"type": "ping", "chat_id": 3, "message": {"content": "x"}}
+
+
+def test_msgpack_subprotocol_is_opt_in(main, login):
+    alice_client, alice = login("alice")
+    url = f"/ws/{alice['id']}?token={alice_client.cookies.get('access_token')}"
+
+    with TestClient(main.app) as client:
+        with client.websocket_connect(url, subprotocols=[main.WS_MSGPACK_PROTOCOL]) as binary, \
+                client.websocket_connect(url) as text:
+            assert binary.accepted_subprotocol == main.WS_MSGPACK_PROTOCOL
+            assert text.accepted_subprotocol is None
+
+            binary.send_bytes(msgpack.packb({"t": "ping"}))
+            pong = receive_packed_until(binary, "pong")
+            assert isinstance(pong["ts"], int)
+
+            # Клиент без подпротокола получает тот же pong в JSON
+            while True:
+                frame = text.receive_json()
+                if frame.get("type") == "pong":
+                    break
+            assert isinstance(frame["timestamp"], str)
+
+
+def test_deflate_protocol_offers_tuned_window(main):
+    import uvicorn
+    from uvicorn.server import ServerState
+
+    from ws_server import WS_DEFLATE_MEM_LEVEL, WS_DEFLATE_WINDOW_BITS, DeflateWebSocketProtocol
+
+    async def offered():
+        config = uvicorn.Config(main.app)
+        config.load()
+        protocol = DeflateWebSocketProtocol(config=config, server_state=ServerState(), app_state={})
+        return protocol.available_extensions
+
+    (factory,) = asyncio.run(offered())
+    assert factory.server_max_window_bits == WS_DEFLATE_WINDOW_BITS == 11
+    assert factory.client_max_window_bits == WS_DEFLATE_WINDOW_BITS
+    assert factory.compress_settings == {"memLevel": WS_DEFLATE_MEM_LEVEL}
@@ -0,0 +1,57 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+def receive_until(websocket, frame_type):
+    """Кадры до первого кадра указанного типа включительно"""
+    frames = []
+    while True:
+        frame = websocket.receive_json()
+        frames.append(frame)
+        if frame.get("type") == frame_type:
+            return frames
+
+
+@pytest.fixture
+def ws_client(main, login):
+    alice_client, alice = login("alice")
+    _, bob = login("bob")
+    token = alice_client.cookies.get("access_token")
+    with TestClient(main.app) as client:
+        yield client, f"/ws/{alice['id']}?token={token}", bob["id"]
+
+
+def test_ws_send_acks_origin_only_and_retry_is_idempotent(main, db, ws_client):
+    client, url, bob_id = ws_client
+    client_id = uuid.uuid4().hex
+    payload = {"type": "send_message", "client_id": client_id, "to_user_id": bob_id, "content": "over ws"}
+
+    with client.websocket_connect(url + "&device_id=phone") as origin, \
+            client.websocket_connect(url + "&device_id=laptop") as other_device:
+        origin.send_json(payload)
+        frames = receive_until(origin, "message_ack")
+        ack = frames[-1]
+        assert ack["ok"] is True and ack["client_id"] == client_id
+
+        # Пинг после ack: все, что было поставлено в очередь для отправки, пришло до pong
+        origin.send_json({"type": "ping"})
+        frames += receive_until(origin, "pong")
+        assert not [frame for frame in frames if frame.get("type") == "message_sent"]
+
+        # Остальные устройства отправителя получают message_sent как раньше
+        sent = receive_until(other_device, "message_sent")[-1]
+        assert sent["client_id"] == client_id and sent["message_id"] == ack["message_id"]
+
+        # Повтор с тем же client_id возвращает то же сообщение и ничего не рассылает
+        origin.send_json(payload)
+        retry = receive_until(origin, "message_ack")[-1]
+        assert retry["ok"] is True and retry["message_id"] == ack["message_id"]
+
+        # Первый pong - ответ на пинг origin (pong приходит во все соединения пользователя)
+        other_device.send_json({"type": "ping"})
+        later = receive_until(other_device, "pong") + receive_until(other_device, "pong")
+        assert not [frame for frame in later if frame.get("type") in ("message_sent", "message")]
+
+    assert db.query(main.Message).filter(main.Message.content == "over ws").count() == 1
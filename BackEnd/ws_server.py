@@ -0,0 +1,35 @@
+import os
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+# Окно 2^11 и memLevel 4 - около 16 KB памяти zlib на соединение вместо ~256 KB по умолчанию;
+# кадры мессенджера маленькие, поэтому степень сжатия почти не меняется
+WS_DEFLATE_WINDOW_BITS = int(os.environ.get("WS_DEFLATE_WINDOW_BITS", 11))
+WS_DEFLATE_MEM_LEVEL = int(os.environ.get("WS_DEFLATE_MEM_LEVEL", 4))
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    """WebSocket протокол uvicorn с настроенным permessage-deflate"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [
+                ServerPerMessageDeflateFactory(
+                    server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+                    client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+                    compress_settings={"memLevel": WS_DEFLATE_MEM_LEVEL}
+                )
+            ]
+
+
+try:
+    from uvicorn.workers import UvicornWorker
+except ImportError:  # gunicorn не установлен - запуск через python main.py
+    UvicornWorker = None
+
+if UvicornWorker is not None:
+    class DevNetUvicornWorker(UvicornWorker):
+        """Gunicorn воркер с настроенным WebSocket протоколом"""
+        CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "ws": DeflateWebSocketProtocol}